@@ -20,11 +20,85 @@ Core Features:
 """
 
 import os
-from flask import Flask, render_template, request, redirect, url_for, session
-from supabase import create_client, Client
+import json
+import base64
+import binascii
+import click
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, g
+from jinja2 import FileSystemBytecodeCache
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+import re
 import uuid
+import time
+import shutil
+
+from conditional_fragments import conditional_fragment, fetch_fingerprint
+from download_cache import DOWNLOAD_CACHE_DIR, DOWNLOAD_CHUNK_SIZE, DownloadCache
+from event_hub import create_event_hub, format_sse
+from fragment_cache import FragmentCache
+from job_queue import JOB_WORKER_THREADS, UNEXPECTED_JOB_ERROR, JobFailed, create_job_queue, parse_queue_limits
+from memberships import MembershipCache
+from query_shapes import shaped_query
+from request_auth import AUTH_REFRESH_MARGIN, AuthUnavailable, InvalidToken, TokenRefresher, TokenVerifier
+from resumable_uploads import (
+    REFERRAL_MAX_BYTES,
+    UPLOAD_CHUNK_SIZE,
+    ChecksumMismatch,
+    OffsetMismatch,
+    UploadError,
+    create_upload,
+    download_object,
+    get_upload_offset,
+    open_object,
+    read_chunk,
+    stream_upload,
+    upload_chunk,
+    verify_chunk,
+)
+from session_store import ServerSideSessionInterface, create_session_store
+from sleep_data import (
+    EPOCH_SECONDS,
+    SLEEP_DATA_EXTENSIONS,
+    SLEEP_DATA_MAX_BYTES,
+    SLEEP_DATA_STAGING_DIR,
+    SUMMARY_STATS,
+    append_chunk,
+    describe_signals,
+    discard_staged,
+    encode_summary,
+    get_staged_offset,
+    get_staging_path,
+    summarize_edf,
+)
+from signed_urls import SignedUrlCache, get_object_path
+from signal_tiles import (
+    PYRAMID_VERSION,
+    SIGNAL_TILES_DIR,
+    RecordingAccessCache,
+    TileStore,
+    build_pyramid,
+    list_pyramid_files,
+)
+from sleep_analysis import ANALYSIS_TIMEOUT_SECONDS, analyze_recording, get_ahi_severity, get_analysis_pool
+from slot_engine import SlotEngine
+from staff_assignment import AssignmentEngine
+from study_reports import (
+    REPORT_TEMPLATE,
+    collect_report_inputs,
+    encode_report,
+    get_report_hash,
+    get_report_job_id,
+    get_report_path,
+)
+from supabase_clients import (
+    AuthenticatedClientPool,
+    create_auth_client,
+    get_anon_client,
+    get_service_client,
+    init_clients,
+    is_token_expired,
+)
 
 # Load environment variables
 load_dotenv('.env.local')
@@ -32,6 +106,17 @@ load_dotenv('.env.local')
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-production')
 
+# Hard cap on any request body: a whole referral (plus multipart overhead) or
+# one resumable upload chunk. Larger bodies are rejected with 413 before they
+# are read.
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv(
+    'MAX_CONTENT_LENGTH', max(REFERRAL_MAX_BYTES, UPLOAD_CHUNK_SIZE) + 1024 * 1024
+))
+
+# Server-side sessions: the cookie holds only an opaque session id, while
+# tokens, the user dict and booking wizard state live in the session store
+app.session_interface = ServerSideSessionInterface(create_session_store(app))
+
 # Supabase configuration (following HTMX example pattern)
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_ANON_KEY = os.getenv('SUPABASE_ANON_KEY')
@@ -39,10 +124,175 @@ SUPABASE_ANON_KEY = os.getenv('SUPABASE_ANON_KEY')
 if not SUPABASE_URL or not SUPABASE_ANON_KEY:
     raise ValueError("Missing Supabase credentials in environment variables")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+# Connection layer: one bounded HTTP pool plus anon/service-role singletons
+# per worker. The shared anon client never holds user auth state - sign-in,
+# sign-up and sign-out use short-lived clients from create_auth_client().
+init_clients(SUPABASE_URL, SUPABASE_ANON_KEY, os.getenv('SUPABASE_SERVICE_ROLE_KEY'))
+supabase = get_anon_client()
+
+# Process-wide pool of per-user clients (keyed by access token hash)
+client_pool = AuthenticatedClientPool(SUPABASE_URL, SUPABASE_ANON_KEY)
+
+def get_privileged_client():
+    """
+    Get the service-role client, falling back to the anon client.
+    
+    Used for server-side reads that span users (rosters, workload counts)
+    which RLS would otherwise hide from the requesting user.
+    
+    Returns:
+        AuthenticatedClient: Service-role client if configured, else anon client
+    """
+    try:
+        return get_service_client()
+    except ValueError:
+        return supabase
+
+# Workload-balanced staff/doctor assignment with a TTL-cached roster
+assignment_engine = AssignmentEngine(get_privileged_client)
+
+# Capacity-aware appointment slots with a per-day occupancy index
+slot_engine = SlotEngine(get_privileged_client)
+
+# Per-user organization memberships for tenant-scoped staff queries
+membership_cache = MembershipCache(get_privileged_client)
+
+# Change notifications pushed to dashboards over SSE (fanned out across workers)
+event_hub = create_event_hub(app)
+
+# Durable background jobs, processed by `flask worker`
+job_queue = create_job_queue(app, get_client=get_service_client)
+
+# Rendered HTML of user-independent booking steps, keyed by the context they read
+fragment_cache = FragmentCache({
+    'fragments/booking/step-1-intro.html': (),
+    'fragments/booking/step-5-epworth.html': ('epworth_questions',),
+    'fragments/booking/step-6-osa50.html': ('osa50_questions',)
+})
+
+def get_authenticated_client():
+    """
+    Get the pooled Supabase client for the current session's access token.
+    
+    Replaces the per-request create_client() + auth.set_session() pattern.
+    Clients are cached per token until shortly before the JWT expires, so
+    polling HTMX fragments reuse a warm client and HTTP connection.
+    
+    The token was verified (and refreshed if close to expiry) by
+    authenticate_request before the route ran.
+    
+    Returns:
+        AuthenticatedClient: Pooled user client, or the anon client
+            when the session carries no access token
+    """
+    access_token = session.get('access_token')
+    if not access_token:
+        return supabase
+    
+    return client_pool.get(access_token)
+
+def exchange_refresh_token(refresh_token):
+    """
+    Exchange a refresh token for new session tokens.
+    
+    Uses a short-lived auth client so the refreshed session never lands on
+    a shared client.
+    
+    Returns:
+        tuple|None: (access_token, refresh_token), or None if the refresh failed
+    """
+    try:
+        response = create_auth_client().refresh_session(refresh_token)
+        if not response.session:
+            return None
+        return response.session.access_token, response.session.refresh_token
+    except Exception as e:
+        print(f"Error refreshing session tokens: {e}")
+        return None
+
+# Local JWT verification with memoized claims (no auth round trip per request);
+# `flask auth-check` verifies SUPABASE_JWT_SECRET is set where it is required
+token_verifier = TokenVerifier(SUPABASE_URL, SUPABASE_ANON_KEY)
+
+# One refresh per refresh token, however many requests of a session need it
+token_refresher = TokenRefresher(exchange_refresh_token)
+
+def refresh_session_tokens():
+    """
+    Refresh the session's tokens (single-flight per refresh token).
+    
+    Returns:
+        str|None: New access token, or None if the refresh failed
+    """
+    tokens = token_refresher.refresh(session['refresh_token'])
+    if not tokens:
+        return None
+    
+    if tokens[0] != session['access_token']:
+        client_pool.discard(session['access_token'])
+    session['access_token'], session['refresh_token'] = tokens
+    return tokens[0]
+
+@app.before_request
+def authenticate_request():
+    """
+    Verify the signed-in user's access token before every request.
+    
+    The token is refreshed first if it expires within AUTH_REFRESH_MARGIN
+    seconds, then verified locally (claims are memoized per token, so this
+    is a dict lookup in the steady state). If the token is invalid, cannot
+    be refreshed, or belongs to another user, the session is signed out
+    and the route sees no 'user' in the session. If the token needed a
+    remote check and Auth could not answer, the request fails with 503
+    and the session is kept.
+    """
+    g.auth_claims = None
+    if 'user' not in session or request.endpoint == 'static':
+        return
+    
+    access_token = session.get('access_token')
+    if access_token and session.get('refresh_token') and is_token_expired(access_token, AUTH_REFRESH_MARGIN):
+        access_token = refresh_session_tokens() or access_token
+    
+    try:
+        claims = token_verifier.verify(access_token) if access_token else None
+    except InvalidToken as e:
+        print(f"Rejected session token: {e}")
+        claims = None
+    except AuthUnavailable as e:
+        print(f"Could not verify session token: {e}")
+        return "Authentication is temporarily unavailable. Please try again.", 503
+    
+    if not claims or claims['sub'] != session['user'].get('id'):
+        if access_token:
+            client_pool.discard(access_token)
+        session.clear()
+        return
+    
+    g.auth_claims = claims
+
+# ============================================================================
+# STORAGE BUCKET BOOTSTRAP
+# ============================================================================
+
+# Local marker written by `flask storage-init` once buckets are provisioned
+STORAGE_MARKER_PATH = os.getenv('STORAGE_MARKER_PATH',
+                                os.path.join(app.instance_path, 'storage-buckets.json'))
+
+def get_storage_bucket_names():
+    """
+    Get the configured storage bucket names.
+    
+    Returns:
+        dict: Bucket names keyed by purpose (referrals, sleep_data, reports)
+    """
+    return {
+        'referrals': os.getenv('NEXT_PUBLIC_REFERRALS_BUCKET', 'referrals'),
+        'sleep_data': os.getenv('NEXT_PUBLIC_SLEEP_DATA_BUCKET', 'sleep-data'),
+        'reports': os.getenv('NEXT_PUBLIC_REPORTS_BUCKET', 'reports')
+    }
 
-# Initialize storage buckets for file uploads
-def initialize_storage_buckets():
+def initialize_storage_buckets(client):
     """
     Initialize Supabase Storage buckets for the sleep study application.
     
@@ -51,55 +301,152 @@ def initialize_storage_buckets():
     - sleep-data: Sleep study result files (private) 
     - reports: Generated reports (private)
     
-    Based on environment configuration from .env.local
+    Existence is probed with get_bucket() (bucket metadata, one small
+    response) rather than listing objects, which slows down as buckets grow.
+    
+    Args:
+        client: Supabase client used for provisioning (service role preferred)
+        
+    Returns:
+        dict: Provisioning status per bucket name ('exists', 'created', 'failed')
+    """
+    results = {}
+    
+    for bucket_name in get_storage_bucket_names().values():
+        try:
+            client.storage.get_bucket(bucket_name)
+            results[bucket_name] = 'exists'
+            print(f"✅ Storage bucket '{bucket_name}' already exists")
+        except Exception:
+            # Bucket doesn't exist, create it
+            try:
+                client.storage.create_bucket(bucket_name, options={'public': False})
+                results[bucket_name] = 'created'
+                print(f"✅ Created storage bucket '{bucket_name}'")
+            except Exception as e:
+                results[bucket_name] = 'failed'
+                print(f"⚠️  Could not create bucket '{bucket_name}': {e}")
+                print("   This may require admin privileges or manual "
+                      "setup in Supabase Dashboard")
+    
+    print("🗂️  Storage bucket initialization completed")
+    return results
+
+def read_storage_marker():
+    """
+    Read the local storage provisioning marker.
+    
+    Returns:
+        dict|None: Marker contents, or None if missing or unreadable
     """
     try:
-        # Get bucket names from environment variables
-        referrals_bucket = os.getenv('NEXT_PUBLIC_REFERRALS_BUCKET', 'referrals')
-        sleep_data_bucket = os.getenv('NEXT_PUBLIC_SLEEP_DATA_BUCKET',
-                                      'sleep-data')
-        reports_bucket = os.getenv('NEXT_PUBLIC_REPORTS_BUCKET', 'reports')
-        
-        buckets_to_create = [
-            {'name': referrals_bucket, 'public': False},
-            {'name': sleep_data_bucket, 'public': False},
-            {'name': reports_bucket, 'public': False}
-        ]
-        
-        # Create buckets if they don't exist
-        for bucket_config in buckets_to_create:
-            try:
-                # Check if bucket exists by trying to list it
-                supabase.storage.from_(bucket_config['name']).list()
-                bucket_name = bucket_config['name']
-                print(f"✅ Storage bucket '{bucket_name}' already exists")
-            except Exception:
-                # Bucket doesn't exist, create it
-                try:
-                    supabase.storage.create_bucket(
-                        bucket_config['name'],
-                        options={'public': bucket_config['public']}
-                    )
-                    bucket_name = bucket_config['name']
-                    print(f"✅ Created storage bucket '{bucket_name}'")
-                except Exception as e:
-                    bucket_name = bucket_config['name']
-                    print(f"⚠️  Could not create bucket '{bucket_name}': {e}")
-                    print("   This may require admin privileges or manual "
-                          "setup in Supabase Dashboard")
-        
-        print("🗂️  Storage bucket initialization completed")
+        with open(STORAGE_MARKER_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_storage_marker(results):
+    """
+    Record successfully provisioned buckets in the local marker.
+    
+    Args:
+        results (dict): Output of initialize_storage_buckets()
+    """
+    os.makedirs(os.path.dirname(STORAGE_MARKER_PATH), exist_ok=True)
+    marker = {
+        'buckets': sorted(name for name, status in results.items() if status != 'failed'),
+        'initialized_at': datetime.utcnow().isoformat()
+    }
+    with open(STORAGE_MARKER_PATH, 'w') as f:
+        json.dump(marker, f, indent=2)
+
+def check_storage_marker():
+    """
+    Check at startup that storage buckets have been provisioned.
+    
+    Reads only the local marker - worker boot makes no storage round trips.
+    Missing buckets are reported so operators know to run `flask storage-init`.
+    """
+    marker = read_storage_marker()
+    provisioned = set(marker.get('buckets', [])) if marker else set()
+    missing = set(get_storage_bucket_names().values()) - provisioned
+    if missing:
+        print(f"⚠️  Storage buckets not provisioned: {', '.join(sorted(missing))}")
+        print("   Run `flask storage-init` to create them")
+
+check_storage_marker()
+
+# Signed links to private objects, reused until shortly before they expire
+signed_url_cache = SignedUrlCache()
+
+def sign_storage_urls(objects):
+    """
+    Get signed URLs for private Storage objects (one batch per bucket).
+    
+    Only call this for objects the user was already authorized to see (rows
+    read with their own client): signing uses the privileged client.
+    
+    Args:
+        objects (iterable): (bucket_purpose, object_path) pairs, e.g. ('referrals', path)
         
-    except Exception as e:
-        print(f"⚠️  Storage initialization error: {e}")
-        print("   File uploads may not work until storage buckets are "
-              "created manually")
+    Returns:
+        dict: (bucket_purpose, object_path) -> signed URL
+    """
+    buckets = get_storage_bucket_names()
+    objects = [(purpose, path) for purpose, path in objects if path]
+    urls = signed_url_cache.get_many(get_privileged_client(),
+                                     [(buckets[purpose], path) for purpose, path in objects])
+    return {(purpose, path): urls[(buckets[purpose], path)]
+            for purpose, path in objects if (buckets[purpose], path) in urls}
+
+# ============================================================================
+# TEMPLATE PRECOMPILATION
+# ============================================================================
+
+# Jinja bytecode written by `flask templates-compile` and read at startup
+TEMPLATE_BYTECODE_DIR = os.getenv('TEMPLATE_BYTECODE_DIR',
+                                  os.path.join(app.instance_path, 'jinja-bytecode'))
+
+# Load every template at import (before gunicorn forks with --preload)
+TEMPLATE_PRELOAD = os.getenv('TEMPLATE_PRELOAD', 'true').lower() == 'true'
+
+def configure_template_bytecode_cache():
+    """
+    Point Jinja at the on-disk bytecode cache.
+    
+    Must run before the first template is loaded. Jinja validates each
+    cached entry against the template source checksum, so edited templates
+    are recompiled instead of served stale.
+    """
+    os.makedirs(TEMPLATE_BYTECODE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_BYTECODE_DIR)
 
-# Initialize storage on app startup
-try:
-    initialize_storage_buckets()
-except Exception as e:
-    print(f"Storage initialization skipped: {e}")
+def preload_templates():
+    """
+    Load every template into Jinja's in-memory template cache.
+    
+    With a bytecode cache from `flask templates-compile` this only
+    unmarshals code objects (no parsing or compiling). Under gunicorn
+    --preload the loaded templates are shared by all forked workers, so
+    their first dashboard or booking step renders at steady-state latency.
+    
+    Returns:
+        dict: {'loaded': [...], 'failed': {name: error}}
+    """
+    results = {'loaded': [], 'failed': {}}
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        try:
+            app.jinja_env.get_template(name)
+            results['loaded'].append(name)
+        except Exception as e:
+            results['failed'][name] = str(e)
+    return results
+
+configure_template_bytecode_cache()
+if TEMPLATE_PRELOAD:
+    preload_results = preload_templates()
+    if preload_results['failed']:
+        print(f"⚠️  Templates failed to load: {', '.join(preload_results['failed'])}")
 
 # ============================================================================
 # AUTHENTICATION ROUTES
@@ -143,13 +490,14 @@ def signin():
     password = request.form.get('password')
     
     try:
-        response = supabase.auth.sign_in_with_password({
+        response = create_auth_client().sign_in_with_password({
             "email": email,
             "password": password
         })
         
         if response.user:
-            # Store user in session
+            # Store user in session (under a fresh session id)
+            session.rotate()
             session['user'] = {
                 'id': response.user.id,
                 'email': response.user.email
@@ -206,7 +554,7 @@ def signup():
         if organization_id:
             user_metadata['organization_id'] = organization_id
             
-        response = supabase.auth.sign_up({
+        response = create_auth_client().sign_up({
             "email": email,
             "password": password,
             "options": {
@@ -231,10 +579,14 @@ def signout():
     Returns:
         Response: Redirect to index page
     """
-    try:
-        supabase.auth.sign_out()
-    except:
-        pass  # Ignore errors during signout
+    access_token = session.get('access_token')
+    if access_token:
+        try:
+            # Revoke this user's refresh tokens server-side
+            create_auth_client().admin.sign_out(access_token)
+        except:
+            pass  # Ignore errors during signout
+        client_pool.discard(access_token)
     
     session.clear()
     return redirect(url_for('index'))
@@ -268,7 +620,7 @@ def auth_callback():
                                  error="Invalid verification link. Please request a new one.")
         
         # HTMX Pattern: Exchange code for session (PKCE flow)
-        response = supabase.auth.exchange_code_for_session(code)
+        response = create_auth_client().exchange_code_for_session({'auth_code': code})
         
         if not response.user:
             return render_template('auth.html', 
@@ -282,11 +634,8 @@ def auth_callback():
             role = user_metadata.get('role', 'patient')
             organization_id = user_metadata.get('organization_id')
             
-            # Use service role client to create profile
-            service_supabase = create_client(
-                supabase_url=os.getenv('SUPABASE_URL'),
-                supabase_key=os.getenv('SUPABASE_SERVICE_ROLE_KEY')
-            )
+            # Use the shared service role client to create profile
+            service_supabase = get_service_client()
             
             # Create user profile in app_users table
             profile_data = {
@@ -306,12 +655,14 @@ def auth_callback():
                     'role_details': {'position': 'staff', 'permissions': ['manage_studies']},
                     'created_at': datetime.utcnow().isoformat()
                 }
-                service_supabase.table('staff_memberships').insert(staff_membership_data).execute()
+                service_supabase.table('organization_memberships').insert(staff_membership_data).execute()
+                membership_cache.invalidate(response.user.id)
             
             # Refresh profile after creation
             profile = {'role': role}
         
         # Enhanced: Create rich session with role-based data
+        session.rotate()
         session['user'] = {
             'id': response.user.id,
             'email': response.user.email,
@@ -379,14 +730,7 @@ def dashboard():
     just_verified = request.args.get('verified') == 'true'
     
     # Create authenticated client for dashboard data
-    if 'access_token' in session:
-        auth_client = create_client(
-            supabase_url=os.getenv('SUPABASE_URL'),
-            supabase_key=os.getenv('SUPABASE_ANON_KEY')
-        )
-        auth_client.auth.set_session(session['access_token'], session['refresh_token'])
-    else:
-        auth_client = supabase
+    auth_client = get_authenticated_client()
     
     # Enhanced: Get role-specific data
     dashboard_data = get_dashboard_data(user, auth_client)
@@ -454,7 +798,7 @@ def htmx_book_study_form():
     }
     session.modified = True
     
-    return render_template('fragments/booking/step-1-intro.html')
+    return fragment_cache.render('fragments/booking/step-1-intro.html')
 
 @app.route('/htmx/booking/step/<int:step>')
 def htmx_booking_step(step):
@@ -519,7 +863,8 @@ def htmx_booking_step(step):
     # Get additional data needed for the step
     context = get_booking_step_context(step)
 
-    return render_template(template, **context)
+    # Intro and questionnaire steps are served from the rendered-fragment cache
+    return fragment_cache.render(template, **context)
 
 @app.route('/htmx/booking/save-step', methods=['POST'])
 def htmx_save_booking_step():
@@ -606,32 +951,23 @@ def htmx_upload_referral():
         return render_template('fragments/booking/upload-error.html',
                              error="No file selected")
 
-    # Simple file type validation
-    allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.pdf'}
-    if not any(file.filename.lower().endswith(ext) for ext in allowed_extensions):
-        return render_template('fragments/booking/upload-error.html',
-                             error="Invalid file type. Please use PDF, JPG, PNG, or GIF.")
+    # Werkzeug spools large uploads to a temporary file; measure it there
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+
+    error = validate_referral_upload(file.filename, size)
+    if error:
+        return render_template('fragments/booking/upload-error.html', error=error)
 
     try:
-        # Healthcare security: user-specific folder with UUID
-        user_id = session['user']['id']
-        unique_filename = f"{uuid.uuid4()}-{file.filename}"
-        file_path = f"{user_id}/{unique_filename}"  # RLS policy expects: {user_id}/{filename}
+        file_path = get_referral_file_path(file.filename)
         
-        # Simple Supabase upload using helper function
-        file_url = upload_file_to_supabase(file, file_path, 'referrals')
+        # Streamed to Supabase in fixed-size chunks
+        upload_file_to_supabase(file, file_path, 'referrals')
         
         # Store in session for booking completion
-        if 'booking_data' not in session:
-            session['booking_data'] = {}
-        
-        session['booking_data']['referral'] = {
-            'filename': file.filename,
-            'file_path': file_path,
-            'file_url': file_url,
-            'uploaded_at': datetime.utcnow().isoformat()
-        }
-        session.modified = True
+        record_referral_upload(file.filename, file_path)
         
         # Return success HTML (HTMX way)
         return render_template('fragments/booking/upload-success.html',
@@ -642,17 +978,202 @@ def htmx_upload_referral():
         return render_template('fragments/booking/upload-error.html',
                              error=str(e))
 
+# ============================================================================
+# RESUMABLE REFERRAL UPLOADS
+# ============================================================================
+
+REFERRAL_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.pdf'}
+
+def validate_referral_upload(filename, size):
+    """
+    Check a referral's file type and size before any bytes are stored.
+    
+    Args:
+        filename (str): Original file name
+        size (int): File size in bytes
+        
+    Returns:
+        str|None: Error message, or None if the upload is acceptable
+    """
+    if not any(filename.lower().endswith(ext) for ext in REFERRAL_EXTENSIONS):
+        return "Invalid file type. Please use PDF, JPG, PNG, or GIF."
+    if size <= 0:
+        return "The selected file is empty."
+    if size > REFERRAL_MAX_BYTES:
+        return f"File is too large. The maximum size is {REFERRAL_MAX_BYTES // (1024 * 1024)}MB."
+    return None
+
+def get_referral_file_path(filename):
+    """
+    Build the storage path for a referral upload.
+    
+    Healthcare security: user-specific folder with a UUID prefix, as the
+    referrals bucket RLS policy expects {user_id}/{filename}.
+    """
+    return f"{session['user']['id']}/{uuid.uuid4()}-{filename}"
+
+def record_referral_upload(filename, file_path):
+    """
+    Store a completed referral upload in the booking session.
+    
+    The bucket is private, so the referral row keeps the object path
+    (file_url) and links are signed when they are shown.
+    """
+    if 'booking_data' not in session:
+        session['booking_data'] = {}
+    
+    session['booking_data']['referral'] = {
+        'filename': filename,
+        'file_path': file_path,
+        'file_url': file_path,
+        'uploaded_at': datetime.utcnow().isoformat()
+    }
+    session.modified = True
+
+@app.route('/htmx/booking/upload-referral/resumable', methods=['POST'])
+def htmx_start_referral_upload():
+    """
+    Start (or resume) a chunked referral upload.
+    
+    Form fields: filename, size, content_type. If the session already holds
+    an unfinished upload of the same file, it is resumed from the offset
+    Storage has durably received, so a dropped connection only repeats the
+    chunk that was in flight.
+    
+    Returns:
+        JSON: upload_id, offset and chunk_size for the client
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+
+    filename = request.form.get('filename', '')
+    content_type = request.form.get('content_type') or 'application/octet-stream'
+    try:
+        size = int(request.form.get('size', ''))
+    except ValueError:
+        return {'error': "Invalid file size"}, 400
+
+    if not filename:
+        return {'error': "No file selected"}, 400
+    error = validate_referral_upload(filename, size)
+    if error:
+        return {'error': error}, 413 if size > REFERRAL_MAX_BYTES else 400
+
+    client = get_authenticated_client()
+    upload = session.get('referral_upload')
+
+    try:
+        if upload and upload['filename'] == filename and upload['size'] == size:
+            try:
+                upload['offset'] = get_upload_offset(client, upload['location'])
+            except UploadError:
+                # Expired or already completed upload - start a new one
+                upload = None
+        else:
+            upload = None
+
+        if upload is None:
+            file_path = get_referral_file_path(filename)
+            bucket_name = get_storage_bucket_names()['referrals']
+            upload = {
+                'id': str(uuid.uuid4()),
+                'filename': filename,
+                'size': size,
+                'file_path': file_path,
+                'location': create_upload(client, bucket_name, file_path, size, content_type),
+                'offset': 0
+            }
+
+        session['referral_upload'] = upload
+        session.modified = True
+        return {'upload_id': upload['id'], 'offset': upload['offset'], 'chunk_size': UPLOAD_CHUNK_SIZE}
+
+    except UploadError as e:
+        print(f"Error starting referral upload: {e}")
+        return {'error': "Could not start the upload. Please try again."}, 502
+
+@app.route('/htmx/booking/upload-referral/resumable/<upload_id>', methods=['HEAD', 'PATCH'])
+def htmx_referral_upload_chunk(upload_id):
+    """
+    Report the offset of (HEAD) or append one chunk to (PATCH) an upload.
+    
+    PATCH requests carry the raw chunk with Upload-Offset and
+    Upload-Checksum ('sha256 <base64>') headers. The chunk is read into a
+    single UPLOAD_CHUNK_SIZE buffer, verified, then forwarded to Storage.
+    
+    Responses:
+        204: chunk stored, Upload-Offset header holds the new offset
+        200: last chunk stored, body is the upload-success fragment
+        409: wrong offset, Upload-Offset header holds where to resume
+        460: checksum mismatch, resend the chunk
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+
+    upload = session.get('referral_upload')
+    if not upload or upload['id'] != upload_id:
+        return "Upload not found", 404
+
+    client = get_authenticated_client()
+
+    try:
+        if request.method == 'HEAD':
+            offset = get_upload_offset(client, upload['location'])
+            upload['offset'] = offset
+            session.modified = True
+            return '', 200, {'Upload-Offset': str(offset), 'Cache-Control': 'no-store'}
+
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return "Missing Upload-Offset header", 400
+        if offset != upload['offset']:
+            return "Offset mismatch", 409, {'Upload-Offset': str(upload['offset'])}
+
+        expected = min(UPLOAD_CHUNK_SIZE, upload['size'] - offset)
+        data = read_chunk(request.stream, expected + 1)
+        if len(data) != expected:
+            return f"Chunk must be exactly {expected} bytes", 400
+
+        verify_chunk(data, request.headers.get('Upload-Checksum'))
+        offset = upload_chunk(client, upload['location'], offset, data)
+
+    except ChecksumMismatch as e:
+        return str(e), 460
+    except OffsetMismatch as e:
+        upload['offset'] = e.offset
+        session.modified = True
+        return "Offset mismatch", 409, {'Upload-Offset': str(e.offset)}
+    except UploadError as e:
+        print(f"Error uploading referral chunk: {e}")
+        return "Upload failed", 502
+
+    upload['offset'] = offset
+    session.modified = True
+
+    if offset < upload['size']:
+        return '', 204, {'Upload-Offset': str(offset)}
+
+    record_referral_upload(upload['filename'], upload['file_path'])
+    session.pop('referral_upload', None)
+
+    return render_template('fragments/booking/upload-success.html',
+                         filename=upload['filename'])
+
 @app.route('/htmx/booking/submit', methods=['POST'])
 def htmx_submit_booking():
     """
     HTMX endpoint for final booking submission with DDL-compliant database operations.
     
-    Creates records in multiple tables:
+    Creates records in multiple tables through the submit_booking() Postgres
+    function, in a single round trip and a single transaction:
     - sleep_studies: Main study record with required foreign keys
     - patient_profiles: Extended patient information
     - survey_responses: Epworth and OSA-50 questionnaire results
     - referrals: Uploaded referral document links
     
+    A failure in any insert rolls back the whole booking.
+    
     Returns:
         str: Success template with study details or error template
         tuple: (error_template, status_code) if submission fails
@@ -673,86 +1194,39 @@ def htmx_submit_booking():
             return render_template('fragments/booking/booking-error.html',
                                  error="Please complete your personal details (Step 3) before submitting."), 400
         
-        # Get required manager and doctor assignments
-        # In production, implement proper assignment logic based on availability/organization
-        default_manager = get_default_staff_member('staff')
-        default_doctor = get_default_staff_member('doctor')
-        
-        # Temporary fallback for testing - use current user if no staff available
-        if not default_manager:
-            default_manager = {'id': user['id']}
-        if not default_doctor:
-            default_doctor = {'id': user['id']}
-        
-        # Create the main sleep study record (DDL compliant)
-        study_id = str(uuid.uuid4())
+        # Only organizations that are open and under capacity for the slot
+        appointment = booking_data['appointment']
+        eligible = slot_engine.organizations_with_capacity(
+            appointment['date'], int(appointment.get('time', '0:00').split(':')[0]))
+        if not eligible:
+            return render_template('fragments/booking/booking-error.html',
+                                 error="The selected appointment time is no longer available. Please choose another time (Step 2)."), 400
         
-        study_data = {
-            'id': study_id,
-            'patient_id': user['id'],
-            'manager_id': default_manager['id'],  # Required by DDL
-            'doctor_id': default_doctor['id'],    # Required by DDL
-            'device_id': None,  # Will be assigned later by staff
-            'current_state': 'booked',
-            'start_date': booking_data['appointment']['date'],  # Required by DDL
-            'end_date': None,  # Will be set when study completes
-            'created_at': datetime.utcnow().isoformat(),
-            'updated_at': datetime.utcnow().isoformat()
-        }
+        # Pick the least-loaded staff member and doctor from the cached roster
+        # (None lets submit_booking() resolve it; passed ids are validated there)
+        organization_ids = [org_id for org_id in eligible if org_id]
+        assignment = assignment_engine.assign(eligible=organization_ids or None) or {}
         
         # Create authenticated client using user's session token
-        if 'access_token' in session:
-            auth_client = create_client(
-                supabase_url=os.getenv('SUPABASE_URL'),
-                supabase_key=os.getenv('SUPABASE_ANON_KEY')
-            )
-            # Set the user's session for proper authentication
-            auth_client.auth.set_session(session['access_token'], session['refresh_token'])
-        else:
-            auth_client = supabase
-        
-        # Insert sleep study using authenticated client
-        result = auth_client.table('sleep_studies').insert(study_data).execute()
-        
-        # Store patient profile details if provided
-        if booking_data.get('personal_details'):
-            upsert_patient_profile(user['id'], booking_data['personal_details'])
-        
-        # Store Epworth survey response
-        if booking_data.get('epworth_responses'):
-            epworth_score = sum(booking_data['epworth_responses'].values())
-            survey_data = {
-                'id': str(uuid.uuid4()),
-                'sleep_study_id': study_id,
-                'type': 'epworth',
-                'answers': booking_data['epworth_responses'],
-                'score': epworth_score,
-                'created_at': datetime.utcnow().isoformat()
-            }
-            auth_client.table('survey_responses').insert(survey_data).execute()
-        
-        # Store OSA-50 survey response  
-        if booking_data.get('osa50_responses'):
-            osa50_score = sum(1 for v in booking_data['osa50_responses'].values() if v == 'yes')
-            survey_data = {
-                'id': str(uuid.uuid4()),
-                'sleep_study_id': study_id,
-                'type': 'osa50',
-                'answers': booking_data['osa50_responses'],
-                'score': osa50_score,
-                'created_at': datetime.utcnow().isoformat()
-            }
-            auth_client.table('survey_responses').insert(survey_data).execute()
-        
-        # Store referral document
-        if booking_data.get('referral', {}).get('file_url'):
-            referral_data = {
-                'id': str(uuid.uuid4()),
-                'sleep_study_id': study_id,
-                'file_url': booking_data['referral']['file_url'],
-                'created_at': datetime.utcnow().isoformat()
-            }
-            auth_client.table('referrals').insert(referral_data).execute()
+        auth_client = get_authenticated_client()
+        
+        # Persist the whole booking in one transactional RPC call:
+        # sleep_studies, patient_profiles, survey_responses and referrals are
+        # written together (see migration 20261016090000_submit_booking_function)
+        try:
+            result = auth_client.rpc('submit_booking', {
+                'booking_data': booking_data,
+                'manager_id': assignment.get('manager_id'),
+                'doctor_id': assignment.get('doctor_id'),
+                'organization_id': assignment.get('organization_id')
+            }).execute()
+        except Exception:
+            if assignment:
+                assignment_engine.release(assignment)
+            raise
+        study_id = result.data['study_id']
+        slot_engine.record_booking(result.data.get('organization_id'), appointment['date'])
+        notify_study_changed({'id': study_id, 'patient_id': user['id'], **result.data})
         
         # Clear booking session data
         session.pop('booking_data', None)
@@ -769,13 +1243,21 @@ def htmx_submit_booking():
         error_details += f"Traceback: {traceback.format_exc()}\n"
         error_details += f"Booking data: {booking_data}\n"
         
-        # Write debug info to file
-        with open('booking_error_debug.txt', 'w') as f:
-            f.write(error_details)
-            
+        # Debug info is written to file by the worker, off the request path
+        try:
+            job_queue.enqueue('write_booking_debug', {'details': error_details})
+        except Exception as queue_error:
+            print(f"Error queueing booking debug report: {queue_error}\n{error_details}")
+        
         return render_template('fragments/booking/booking-error.html',
                              error=str(e)), 500
 
+@job_queue.task('write_booking_debug')
+def write_booking_debug(details):
+    """Write the last booking submission error to booking_error_debug.txt."""
+    with open('booking_error_debug.txt', 'w') as f:
+        f.write(details)
+
 # ============================================================================
 # HTMX FRAGMENT ROUTES
 # ============================================================================
@@ -785,28 +1267,41 @@ def htmx_studies():
     """
     HTMX fragment to load studies list based on user role and permissions.
     
+    Query Parameters:
+        cursor (str, optional): Cursor of the page to load (from the "load more" row)
+        page_size (int, optional): Studies per page (default STUDIES_PAGE_SIZE)
+        state (str, optional): Only studies in this state (staff/admin lists)
+        from (str, optional): Only studies starting on or after this date (YYYY-MM-DD)
+        to (str, optional): Only studies starting on or before this date (YYYY-MM-DD)
+    
     Returns:
-        str: Rendered studies list template
-        tuple: (error_message, status_code) if unauthorized
+        str: Rendered studies list template (or just the next page's rows)
+        tuple: (error_message, status_code) if unauthorized or a parameter is invalid
     """
     if 'user' not in session:
         return "Unauthorized", 401
     
     user = session['user']
+    cursor = request.args.get('cursor')
+    page_size = get_page_size(request.args.get('page_size'))
+    
+    try:
+        if cursor:
+            decode_study_cursor(cursor)
+        filters = parse_study_filters(request.args)
+    except ValueError as e:
+        return str(e), 400
     
     # Create authenticated client for database queries
-    if 'access_token' in session:
-        auth_client = create_client(
-            supabase_url=os.getenv('SUPABASE_URL'),
-            supabase_key=os.getenv('SUPABASE_ANON_KEY')
-        )
-        auth_client.auth.set_session(session['access_token'], session['refresh_token'])
-    else:
-        auth_client = supabase
+    auth_client = get_authenticated_client()
     
-    studies = get_user_studies(user, auth_client)
+    studies, next_cursor = get_user_studies(user, auth_client, cursor, page_size, filters)
     
-    return render_template('fragments/studies_list.html', studies=studies)
+    # Infinite scroll: follow-up pages replace the "load more" row with
+    # their rows (and the next "load more" row, if any)
+    template = 'fragments/studies_rows.html' if cursor else 'fragments/studies_list.html'
+    return render_template(template, studies=studies,
+                         next_page_url=get_next_page_url(next_cursor, page_size, filters))
 
 @app.route('/htmx/create-study', methods=['POST'])
 def htmx_create_study():
@@ -829,29 +1324,37 @@ def htmx_create_study():
     notes = request.form.get('notes', '')
     
     try:
-        # Get required assignments for DDL compliance
-        default_manager = get_default_staff_member('staff')
-        default_doctor = get_default_staff_member('doctor')
+        # Get required assignments for DDL compliance, preferring the
+        # creating staff member's own organization
+        assignment = assignment_engine.assign(assignment_engine.find_organization(user['id']))
         
-        if not default_manager or not default_doctor:
+        if not assignment:
             return f"Error: No available staff to assign", 500
         
         study_data = {
             'id': str(uuid.uuid4()),
             'patient_id': patient_id,
-            'manager_id': default_manager['id'],
-            'doctor_id': default_doctor['id'],
+            'manager_id': assignment['manager_id'],
+            'doctor_id': assignment['doctor_id'],
+            'organization_id': assignment['organization_id'],
             'current_state': 'booked',
             'start_date': (datetime.utcnow() + timedelta(days=7)).date().isoformat(),
             'created_at': datetime.utcnow().isoformat(),
             'updated_at': datetime.utcnow().isoformat()
         }
         
-        result = supabase.table('sleep_studies').insert(study_data).execute()
+        try:
+            result = supabase.table('sleep_studies').insert(study_data).execute()
+        except Exception:
+            assignment_engine.release(assignment)
+            raise
+        slot_engine.record_booking(assignment['organization_id'], study_data['start_date'])
+        notify_study_changed(study_data)
         
-        # Return updated studies list
-        studies = get_user_studies(user)
-        return render_template('fragments/studies_list.html', studies=studies)
+        # Return updated studies list (first page), read as the user so RLS applies
+        studies, next_cursor = get_user_studies(user, get_authenticated_client())
+        return render_template('fragments/studies_list.html', studies=studies,
+                             next_page_url=get_next_page_url(next_cursor, STUDIES_PAGE_SIZE))
         
     except Exception as e:
         return f"Error creating study: {str(e)}", 400
@@ -901,92 +1404,24 @@ def get_patient_profile(user_id):
         dict|None: Patient profile data or None if not found
     """
     try:
-        result = supabase.table('patient_profiles').select('*').eq('user_id', user_id).execute()
+        result = shaped_query(supabase, 'patient_profile').eq('user_id', user_id).execute()
         return result.data[0] if result.data else None
     except Exception as e:
         print(f"Error fetching patient profile: {e}")
         return None
 
-def upsert_patient_profile(user_id, personal_details):
-    """
-    Create or update patient profile in patient_profiles table.
-    
-    Args:
-        user_id (str): UUID of the user/patient
-        personal_details (dict): Personal information from booking form
-        
-    Returns:
-        None
-    """
-    try:
-        profile_data = {
-            'user_id': user_id,
-            'patient_details': personal_details,
-            'updated_at': datetime.utcnow().isoformat()
-        }
-        
-        # Try to update first, then insert if not exists
-        existing = get_patient_profile(user_id)
-        if existing:
-            supabase.table('patient_profiles').update(profile_data).eq('user_id', user_id).execute()
-        else:
-            profile_data['created_at'] = datetime.utcnow().isoformat()
-            supabase.table('patient_profiles').insert(profile_data).execute()
-    except Exception as e:
-        print(f"Error upserting patient profile: {e}")
-
-def get_default_staff_member(role):
-    """
-    Get a default staff member for study assignment (simplified for demo).
-    
-    In production, this would implement proper assignment logic based on:
-    - Availability schedules
-    - Workload balancing
-    - Organization membership
-    - Specialization areas
-    
-    Args:
-        role (str): Role type ('staff' or 'doctor')
-        
-    Returns:
-        dict|None: Staff member record or None if none available
-    """
-    try:
-        result = supabase.table('app_users').select('id').eq('role', role).limit(1).execute()
-        return result.data[0] if result.data else None
-    except Exception as e:
-        print(f"Error fetching default {role}: {e}")
-        return None
-
 def get_available_appointment_slots():
     """
-    Generate available appointment time slots for the next 2 weeks.
+    Get available appointment time slots for the next 2 weeks.
     
-    In production, this would:
-    - Query actual scheduling system
-    - Check staff availability
-    - Consider facility capacity
-    - Exclude holidays and closures
+    Served from the slot engine's cache: each organization's opening hours
+    are compiled into a schedule, and days where every open organization has
+    reached max_concurrent_studies are excluded.
     
     Returns:
         list: Available appointment slots with dates and times
     """
-    slots = []
-    base_date = datetime.now() + timedelta(days=7)  # Start from next week
-    
-    for i in range(14):  # Next 2 weeks
-        date = base_date + timedelta(days=i)
-        if date.weekday() < 5:  # Monday-Friday only
-            for hour in [9, 11, 14, 16]:  # Available times
-                slots.append({
-                    'id': f"{date.strftime('%Y-%m-%d')}-{hour:02d}",
-                    'date': date.strftime('%Y-%m-%d'),
-                    'time': f"{hour:02d}:00",
-                    'display_date': date.strftime('%A, %B %d'),
-                    'display_time': f"{hour:02d}:00"
-                })
-    
-    return slots
+    return slot_engine.get_available_slots()
 
 def get_epworth_questions():
     """
@@ -1032,40 +1467,33 @@ def upload_file_to_supabase(file, file_path, bucket):
     """
     Upload file using authenticated user with proper RLS policies.
     
+    The file is streamed to Storage's resumable upload endpoint in
+    UPLOAD_CHUNK_SIZE chunks, so at most one chunk is held in memory.
+    
     Args:
         file: Flask file object
         file_path (str): Destination path in bucket
         bucket (str): Storage bucket name
         
     Returns:
-        str: Public URL of uploaded file
+        str: Object path of the uploaded file (the bucket is private)
     """
     try:
         # Get bucket name
         bucket_name = os.getenv('NEXT_PUBLIC_REFERRALS_BUCKET', bucket)
         
         # Create authenticated client using user's session token
-        if 'access_token' in session:
-            auth_client = create_client(
-                supabase_url=os.getenv('SUPABASE_URL'),
-                supabase_key=os.getenv('SUPABASE_ANON_KEY')
-            )
-            # Set the user's session for proper authentication
-            auth_client.auth.set_session(session['access_token'], session['refresh_token'])
-        else:
-            # Fallback to unauthenticated client (will likely fail with RLS)
-            auth_client = supabase
+        auth_client = get_authenticated_client()
         
-        # Read file content
-        file.seek(0)
-        file_content = file.read()
+        # Measure without reading the content into memory
+        file.stream.seek(0, os.SEEK_END)
+        size = file.stream.tell()
+        file.stream.seek(0)
         
         # Upload using authenticated user (proper RLS)
-        auth_client.storage.from_(bucket_name).upload(file_path, file_content)
+        stream_upload(auth_client, bucket_name, file_path, file.stream, size, file.mimetype)
         
-        # Get public URL
-        public_url = auth_client.storage.from_(bucket_name).get_public_url(file_path)
-        return public_url
+        return file_path
         
     except Exception as e:
         raise Exception(f"Upload error: {str(e)}")
@@ -1088,7 +1516,7 @@ def get_user_profile(user_id):
         dict|None: User profile data or None if not found
     """
     try:
-        result = supabase.table('app_users').select('*').eq('id', user_id).execute()
+        result = shaped_query(supabase, 'user_profile').eq('id', user_id).execute()
         return result.data[0] if result.data else None
     except Exception as e:
         print(f"Error fetching user profile: {e}")
@@ -1115,25 +1543,34 @@ def get_dashboard_data(user, client=None):
         data['studies'] = get_patient_studies(user['id'], client)
     elif role == 'staff':
         # Staff can see studies for their organization
-        org_studies = get_organization_studies_for_staff(user['id'], client)
+        org_studies, _ = get_organization_studies_for_staff(user['id'], client)
         data['organization_studies'] = org_studies
     elif role == 'doctor':
         data['assigned_studies'] = get_doctor_studies(user['id'], client)
     elif role == 'admin':
-        data['all_studies'] = get_all_studies(client)
+        data['all_studies'], _ = get_all_studies(client)
+        # Totals are counted server-side now that the list is paginated
+        data['total_studies'] = count_rows(client, 'sleep_studies')
+        data['total_users'] = count_rows(client, 'app_users')
     
     return data
 
-def get_user_studies(user, client=None):
+def get_user_studies(user, client=None, cursor=None, page_size=None, filters=None):
     """
     Get studies list based on user role and permissions.
     
+    Staff and admin lists are keyset-paginated; patient and doctor lists
+    are bounded by their own filters and returned whole.
+    
     Args:
         user (dict): Current user session data
         client: Authenticated Supabase client (optional)
+        cursor (str, optional): Cursor returned with the previous page
+        page_size (int, optional): Studies per page (STUDIES_PAGE_SIZE by default)
+        filters (dict, optional): State/date filters from parse_study_filters()
         
     Returns:
-        list: Studies accessible to the user based on their role
+        tuple: (studies, next_cursor) - next_cursor is None on the last page
     """
     if client is None:
         client = supabase
@@ -1141,13 +1578,13 @@ def get_user_studies(user, client=None):
     role = user.get('role', 'patient')
     
     if role == 'patient':
-        return get_patient_studies(user['id'], client)
+        return get_patient_studies(user['id'], client), None
     elif role == 'staff':
-        return get_organization_studies_for_staff(user['id'], client)
+        return get_organization_studies_for_staff(user['id'], client, cursor, page_size, filters)
     elif role == 'doctor':
-        return get_doctor_studies(user['id'], client)
+        return get_doctor_studies(user['id'], client), None
     else:
-        return get_all_studies(client)
+        return get_all_studies(client, cursor, page_size, filters)
 
 def get_patient_studies(patient_id, client=None):
     """
@@ -1164,70 +1601,527 @@ def get_patient_studies(patient_id, client=None):
         client = supabase
         
     try:
-        result = client.table('sleep_studies').select('*').eq('patient_id', patient_id).execute()
+        result = shaped_query(client, 'study_list').eq('patient_id', patient_id).execute()
         return result.data
     except Exception as e:
         print(f"Error fetching patient studies: {e}")
         return []
 
-def get_organization_studies_for_staff(staff_user_id):
+def get_organization_studies_for_staff(staff_user_id, client=None, cursor=None, page_size=None, filters=None):
     """
-    Get studies for organizations where the staff member has membership.
+    Get one page of studies for organizations where the staff member has membership.
+    
+    Studies are filtered with organization_id IN (memberships), plus the
+    optional state and start-date filters, so only the tenant's rows are
+    read, in page order (sleep_studies_org_created_at_id_idx range scan,
+    or sleep_studies_org_state_start_date_idx when filtered). Memberships
+    come from the per-user membership cache.
     
     Args:
         staff_user_id (str): UUID of the staff user
+        client: Authenticated Supabase client (optional)
+        cursor (str, optional): Cursor returned with the previous page
+        page_size (int, optional): Studies per page (STUDIES_PAGE_SIZE by default)
+        filters (dict, optional): State/date filters from parse_study_filters()
         
     Returns:
-        list: Studies for the staff member's organization(s)
+        tuple: (studies, next_cursor) - next_cursor is None on the last page
     """
-    try:
-        # First get the staff member's organization memberships
-        memberships = supabase.table('staff_memberships').select('organization_id').eq('user_id', staff_user_id).execute()
+    if client is None:
+        client = supabase
         
-        if not memberships.data:
-            return []
+    try:
+        org_ids = membership_cache.get(staff_user_id)
         
-        # Get organization IDs
-        org_ids = [membership['organization_id'] for membership in memberships.data]
+        if not org_ids:
+            return [], None
         
-        # For now, return all studies (would need organization_id in sleep_studies table for proper filtering)
-        # This is a limitation of the current DDL - sleep_studies doesn't have organization_id
-        result = supabase.table('sleep_studies').select('*').execute()
-        return result.data
+        query = shaped_query(client, 'study_list').in_('organization_id', list(org_ids))
+        query = apply_study_filters(query, filters)
+        return fetch_studies_page(query, cursor, page_size)
     except Exception as e:
         print(f"Error fetching organization studies: {e}")
-        return []
+        return [], None
 
-def get_doctor_studies(doctor_id):
+def get_doctor_studies(doctor_id, client=None):
     """
     Get studies assigned to a specific doctor (DDL compliant).
     
     Args:
         doctor_id (str): UUID of the doctor
+        client: Authenticated Supabase client (optional)
         
     Returns:
         list: Studies assigned to the doctor
     """
+    if client is None:
+        client = supabase
+        
     try:
-        result = supabase.table('sleep_studies').select('*').eq('doctor_id', doctor_id).execute()
+        result = shaped_query(client, 'study_list').eq('doctor_id', doctor_id).execute()
         return result.data
     except Exception as e:
         print(f"Error fetching doctor studies: {e}")
         return []
 
-def get_all_studies():
+def get_all_studies(client=None, cursor=None, page_size=None, filters=None):
     """
-    Get all studies in the system (admin access only).
+    Get one page of all studies in the system (admin access only).
+    
+    Args:
+        client: Authenticated Supabase client (optional)
+        cursor (str, optional): Cursor returned with the previous page
+        page_size (int, optional): Studies per page (STUDIES_PAGE_SIZE by default)
+        filters (dict, optional): State/date filters from parse_study_filters()
     
     Returns:
-        list: All sleep studies
+        tuple: (studies, next_cursor) - next_cursor is None on the last page
     """
+    if client is None:
+        client = supabase
+        
     try:
-        result = supabase.table('sleep_studies').select('*').execute()
-        return result.data
+        query = apply_study_filters(shaped_query(client, 'study_list'), filters)
+        return fetch_studies_page(query, cursor, page_size)
     except Exception as e:
         print(f"Error fetching all studies: {e}")
-        return []
+        return [], None
+
+def count_rows(client, table):
+    """
+    Count the rows of a table visible to the client without fetching them.
+    
+    Args:
+        client: Supabase client
+        table (str): Table name
+        
+    Returns:
+        int: Row count (0 if the count fails)
+    """
+    try:
+        result = client.table(table).select('id', count='exact').limit(1).execute()
+        return result.count or 0
+    except Exception as e:
+        print(f"Error counting {table}: {e}")
+        return 0
+
+# Share of max_concurrent_studies at which capacity is reported as high
+CAPACITY_WARNING_RATIO = 0.8
+
+def get_staff_organization_summary(staff_user_id, client=None):
+    """
+    Get device, booking and capacity numbers for a staff member's organizations.
+    
+    Reads organization_summaries, which database triggers recompute whenever
+    a device, study or organization changes. Rows from a previous week are
+    refreshed first so "this week" bookings roll over on Mondays. Staff in
+    several organizations see the totals across all of them.
+    
+    Args:
+        staff_user_id (str): UUID of the staff user
+        client: Authenticated Supabase client (optional)
+        
+    Returns:
+        dict: devices (available, assigned, utilization_percent), week_bookings,
+            active_studies, max_concurrent_studies, capacity_status, over_capacity
+    """
+    if client is None:
+        client = supabase
+    
+    org_ids = membership_cache.get(staff_user_id)
+    rows = []
+    if org_ids:
+        rows = shaped_query(client, 'organization_summary').in_('organization_id', list(org_ids)).execute().data
+        
+        today = datetime.utcnow().date()
+        week_start = (today - timedelta(days=today.weekday())).isoformat()
+        stale = [row['organization_id'] for row in rows if row['week_start'] != week_start]
+        if stale:
+            try:
+                get_privileged_client().rpc('refresh_organization_summaries', {'org_ids': stale}).execute()
+                rows = shaped_query(client, 'organization_summary').in_('organization_id', list(org_ids)).execute().data
+            except Exception as e:
+                print(f"Error refreshing organization summaries: {e}")
+    
+    available = sum(row['devices_available'] for row in rows)
+    assigned = sum(row['devices_assigned'] for row in rows)
+    active = sum(row['active_studies'] for row in rows)
+    capacity = sum(row['max_concurrent_studies'] for row in rows)
+    
+    if capacity and active >= capacity:
+        capacity_status = 'Over Capacity' if active > capacity else 'At Capacity'
+    elif capacity and active >= capacity * CAPACITY_WARNING_RATIO:
+        capacity_status = 'High'
+    else:
+        capacity_status = 'Normal'
+    
+    return {
+        'devices': {
+            'available': available,
+            'assigned': assigned,
+            'utilization_percent': round(assigned * 100 / (available + assigned)) if available + assigned else 0
+        },
+        'week_bookings': sum(row['week_bookings'] for row in rows),
+        'active_studies': active,
+        'max_concurrent_studies': capacity,
+        'capacity_status': f"{capacity_status} ({active}/{capacity})" if capacity else capacity_status,
+        'over_capacity': bool(capacity) and active >= capacity
+    }
+
+# Booked studies starting within this many days without a device need action
+PENDING_ACTION_WINDOW_DAYS = 7
+PENDING_ACTIONS_LIMIT = 5
+
+def get_patient_name(study):
+    """
+    Get the patient's full name from a study with an embedded patient profile.
+    
+    Args:
+        study (dict): Study row selected with the patient:app_users(patient_profiles(...)) embed
+        
+    Returns:
+        str: Patient full name, or 'Patient' if unknown
+    """
+    profiles = (study.get('patient') or {}).get('patient_profiles')
+    if isinstance(profiles, list):
+        profiles = profiles[0] if profiles else None
+    return (profiles or {}).get('full_name') or 'Patient'
+
+def get_staff_pending_actions(staff_user_id, client=None):
+    """
+    Get booked studies in the staff member's organizations that still need a device.
+    
+    Studies starting within PENDING_ACTION_WINDOW_DAYS without an assigned
+    device are listed soonest first; those starting within a day are high
+    priority.
+    
+    Args:
+        staff_user_id (str): UUID of the staff user
+        client: Authenticated Supabase client (optional)
+        
+    Returns:
+        tuple: (actions, total) - at most PENDING_ACTIONS_LIMIT actions plus the total count
+    """
+    if client is None:
+        client = supabase
+    
+    org_ids = membership_cache.get(staff_user_id)
+    if not org_ids:
+        return [], 0
+    
+    today = datetime.utcnow().date()
+    result = shaped_query(client, 'staff_pending_actions', count='exact').in_(
+        'organization_id', list(org_ids)
+    ).eq('current_state', 'booked').is_('device_id', 'null').lte(
+        'start_date', (today + timedelta(days=PENDING_ACTION_WINDOW_DAYS)).isoformat()
+    ).order('start_date').limit(PENDING_ACTIONS_LIMIT).execute()
+    
+    actions = []
+    for study in result.data:
+        actions.append({
+            'id': study['id'],
+            'patient_name': get_patient_name(study),
+            'action_needed': 'Assign a device',
+            'due_date': study['start_date'],
+            'priority': 'high' if study['start_date'] <= (today + timedelta(days=1)).isoformat() else 'normal'
+        })
+    
+    return actions, result.count or len(actions)
+
+# ============================================================================
+# FRAGMENT FINGERPRINTS (ETag versions for polled fragments)
+# ============================================================================
+
+def fingerprint_patient_studies(user):
+    """Version of /htmx/patient/my-studies: the patient's studies."""
+    if user.get('role') != 'patient':
+        return None
+    return fetch_fingerprint(
+        shaped_query(get_authenticated_client(), 'study_fingerprint', count='exact').eq('patient_id', user['id'])
+    )
+
+def fingerprint_doctor_reviews(user):
+    """Version of /htmx/doctor/pending-reviews: the doctor's studies awaiting review."""
+    if user.get('role') != 'doctor':
+        return None
+    return fetch_fingerprint(
+        shaped_query(get_authenticated_client(), 'study_fingerprint', count='exact').eq(
+            'doctor_id', user['id']).eq('current_state', 'review')
+    )
+
+def fingerprint_staff_pending_actions(user):
+    """Version of /htmx/staff/pending-actions: booked studies of the staff member's organizations."""
+    if user.get('role') != 'staff':
+        return None
+    org_ids = membership_cache.get(user['id'])
+    if not org_ids:
+        return [org_ids]
+    # The date is part of the version because the due window moves daily
+    return [org_ids, datetime.utcnow().date(), fetch_fingerprint(
+        shaped_query(get_authenticated_client(), 'study_fingerprint', count='exact').in_(
+            'organization_id', list(org_ids)).eq('current_state', 'booked')
+    )]
+
+def fingerprint_staff_device_status(user):
+    """Version of /htmx/staff/device-status: the organizations' summary rows."""
+    if user.get('role') != 'staff':
+        return None
+    org_ids = membership_cache.get(user['id'])
+    if not org_ids:
+        return [org_ids]
+    # The week is part of the version because stale weeks are refreshed on read
+    today = datetime.utcnow().date()
+    return [org_ids, today - timedelta(days=today.weekday()), fetch_fingerprint(
+        shaped_query(get_authenticated_client(), 'organization_summary_fingerprint', count='exact').in_(
+            'organization_id', list(org_ids)),
+        column='refreshed_at'
+    )]
+
+# ============================================================================
+# STUDY LIST PAGINATION (Keyset on created_at, id)
+# ============================================================================
+
+# Studies per page for staff/admin lists (overridable per request up to the max)
+STUDIES_PAGE_SIZE = int(os.getenv('STUDIES_PAGE_SIZE', 25))
+STUDIES_MAX_PAGE_SIZE = 100
+
+def get_page_size(value=None):
+    """
+    Clamp a requested page size to 1..STUDIES_MAX_PAGE_SIZE.
+    
+    Args:
+        value (str|int, optional): Requested page size (e.g. a query parameter)
+        
+    Returns:
+        int: Page size to use
+    """
+    try:
+        size = int(value) if value else STUDIES_PAGE_SIZE
+    except (TypeError, ValueError):
+        size = STUDIES_PAGE_SIZE
+    return max(1, min(size, STUDIES_MAX_PAGE_SIZE))
+
+def encode_study_cursor(study):
+    """
+    Encode the (created_at, id) position of a study as an opaque cursor.
+    
+    Args:
+        study (dict): Last study of a page
+        
+    Returns:
+        str: URL-safe cursor string
+    """
+    position = f"{study['created_at']}|{study['id']}"
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+def decode_study_cursor(cursor):
+    """
+    Decode a cursor produced by encode_study_cursor().
+    
+    Args:
+        cursor (str): Cursor string from the client
+        
+    Returns:
+        tuple: (created_at, id)
+        
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        created_at, study_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return created_at, str(uuid.UUID(study_id))
+    except (UnicodeError, ValueError, binascii.Error):
+        raise ValueError("Invalid studies cursor")
+
+STUDY_STATES = ['booked', 'active', 'review', 'completed', 'cancelled']
+
+def parse_study_filters(args):
+    """
+    Parse and validate studies list filters from query parameters.
+    
+    Args:
+        args: Request query parameters (state, from, to)
+        
+    Returns:
+        dict: Filters with only the provided keys (state, from, to)
+        
+    Raises:
+        ValueError: If the state is unknown or a date is malformed
+    """
+    filters = {}
+    
+    state = args.get('state')
+    if state:
+        if state not in STUDY_STATES:
+            raise ValueError(f"Unknown study state: {state}")
+        filters['state'] = state
+    
+    for key in ('from', 'to'):
+        value = args.get(key)
+        if value:
+            try:
+                filters[key] = datetime.strptime(value, '%Y-%m-%d').date().isoformat()
+            except ValueError:
+                raise ValueError(f"Invalid '{key}' date: {value} (expected YYYY-MM-DD)")
+    
+    return filters
+
+def apply_study_filters(query, filters=None):
+    """
+    Apply state and start-date filters to a sleep_studies query.
+    
+    Args:
+        query: sleep_studies select query
+        filters (dict, optional): Filters from parse_study_filters()
+        
+    Returns:
+        Query with the filters applied
+    """
+    filters = filters or {}
+    if filters.get('state'):
+        query = query.eq('current_state', filters['state'])
+    if filters.get('from'):
+        query = query.gte('start_date', filters['from'])
+    if filters.get('to'):
+        query = query.lte('start_date', filters['to'])
+    return query
+
+def get_next_page_url(next_cursor, page_size, filters=None):
+    """
+    Build the "load more" URL for the next page, keeping the active filters.
+    
+    Args:
+        next_cursor (str|None): Cursor returned with the current page
+        page_size (int): Studies per page
+        filters (dict, optional): Filters from parse_study_filters()
+        
+    Returns:
+        str|None: URL of the next page, or None on the last page
+    """
+    if not next_cursor:
+        return None
+    return url_for('htmx_studies', cursor=next_cursor, page_size=page_size, **(filters or {}))
+
+def fetch_studies_page(query, cursor=None, page_size=None):
+    """
+    Fetch one newest-first page of studies using keyset pagination.
+    
+    Rows are ordered by (created_at desc, id desc) and each page starts
+    strictly after the cursor's position, so every page is an index range
+    scan on sleep_studies_created_at_id_idx no matter how deep the user
+    scrolls (unlike OFFSET, which reads and discards all earlier rows).
+    One extra row is requested to tell whether another page exists.
+    
+    Args:
+        query: sleep_studies select query with any role filters applied
+        cursor (str, optional): Cursor returned with the previous page
+        page_size (int, optional): Studies per page (STUDIES_PAGE_SIZE by default)
+        
+    Returns:
+        tuple: (studies, next_cursor) - next_cursor is None on the last page
+    """
+    page_size = page_size or STUDIES_PAGE_SIZE
+    
+    if cursor:
+        created_at, study_id = decode_study_cursor(cursor)
+        # Row-value comparison (created_at, id) < (cursor) as a PostgREST or=
+        # filter (postgrest-py has no or_() helper in the pinned version)
+        query.params = query.params.add(
+            'or', f'(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{study_id}))'
+        )
+    
+    # One order= param with both keys: chained .order() calls send two params
+    # in the pinned postgrest-py and PostgREST honours only one of them
+    query.params = query.params.set('order', 'created_at.desc,id.desc')
+    
+    result = query.limit(page_size + 1).execute()
+    studies = result.data[:page_size]
+    next_cursor = encode_study_cursor(studies[-1]) if len(result.data) > page_size else None
+    return studies, next_cursor
+
+# ============================================================================
+# SERVER-SENT EVENTS (Dashboard change notifications)
+# ============================================================================
+
+# Keep-alive comment interval and maximum stream lifetime (clients reconnect)
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_STREAM_SECONDS = int(os.getenv('SSE_MAX_STREAM_SECONDS', 300))
+
+def get_event_topics(user):
+    """
+    Get the event topics a user's dashboard listens to.
+    
+    Args:
+        user (dict): Current user session data
+        
+    Returns:
+        list: Topics - the user's own topic, plus their organizations for staff
+    """
+    role = user.get('role', 'patient')
+    if role == 'staff':
+        return [f"org:{org_id}" for org_id in membership_cache.get(user['id'])]
+    if role in ('patient', 'doctor'):
+        return [f"{role}:{user['id']}"]
+    return []
+
+def notify_study_changed(study):
+    """
+    Publish change events for a study to everyone whose dashboard shows it.
+    
+    - The patient's study cards ('studies-changed')
+    - The doctor's pending reviews ('reviews-changed')
+    - The organization's pending actions and device status
+      ('actions-changed', 'devices-changed')
+    
+    Args:
+        study (dict): Study with id, patient_id, doctor_id and organization_id
+    """
+    data = {'study_id': study.get('id')}
+    if study.get('patient_id'):
+        event_hub.publish(f"patient:{study['patient_id']}", 'studies-changed', data)
+    if study.get('doctor_id'):
+        event_hub.publish(f"doctor:{study['doctor_id']}", 'reviews-changed', data)
+    if study.get('organization_id'):
+        event_hub.publish(f"org:{study['organization_id']}", 'actions-changed', data)
+        event_hub.publish(f"org:{study['organization_id']}", 'devices-changed', data)
+
+@app.route('/events')
+def events():
+    """
+    Server-Sent Events stream of dashboard change notifications.
+    
+    Dashboards connect with the HTMX SSE extension and refetch only the
+    fragment named by each event (hx-trigger="sse:<event>"). Streams end
+    after SSE_MAX_STREAM_SECONDS and the browser reconnects, so a worker
+    thread is never held indefinitely.
+    
+    Returns:
+        Response: text/event-stream
+        tuple: (error_message, status_code) if unauthorized
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    topics = get_event_topics(session['user'])
+    
+    def stream():
+        subscription = event_hub.subscribe(topics)
+        try:
+            yield "retry: 5000\n\n"
+            deadline = time.time() + SSE_MAX_STREAM_SECONDS
+            while time.time() < deadline:
+                message = subscription.get(timeout=SSE_HEARTBEAT_SECONDS)
+                if message is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(message['event'], message['data'])
+        finally:
+            event_hub.unsubscribe(subscription)
+    
+    return app.response_class(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Disable proxy buffering (nginx)
+    })
 
 # ============================================================================
 # DEBUG ENDPOINTS (Remove in production)
@@ -1249,6 +2143,17 @@ def debug_booking_session():
         'session_keys': list(session.keys())
     }
 
+@app.route('/debug/fragment-cache')
+def debug_fragment_cache():
+    """
+    Debug endpoint to view rendered-fragment cache hit/miss counters.
+    Remove or secure this endpoint in production.
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    return fragment_cache.stats()
+
 @app.route('/debug/reset-booking', methods=['POST'])
 def debug_reset_booking():
     """
@@ -1271,6 +2176,15 @@ def not_found(error):
     """Handle 404 errors with custom template."""
     return render_template('404.html'), 404
 
+@app.errorhandler(413)
+def request_too_large(error):
+    """Handle bodies over MAX_CONTENT_LENGTH (oversized uploads)."""
+    if request.headers.get('HX-Request'):
+        # 200 so HTMX swaps the error fragment into the upload result area
+        return render_template('fragments/booking/upload-error.html',
+                             error="File is too large.")
+    return "Request too large", 413
+
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 errors with custom template."""
@@ -1285,6 +2199,7 @@ def internal_error(error):
 # ============================================================================
 
 @app.route('/htmx/patient/my-studies')
+@conditional_fragment(lambda user: fingerprint_patient_studies(user))
 def htmx_patient_my_studies():
     """
     HTMX endpoint to load patient's sleep studies in mobile-friendly card format.
@@ -1302,26 +2217,19 @@ def htmx_patient_my_studies():
     
     try:
         # Get patient's studies with related data
-        if 'access_token' in session:
-            auth_client = create_client(
-                supabase_url=os.getenv('SUPABASE_URL'),
-                supabase_key=os.getenv('SUPABASE_ANON_KEY')
-            )
-            auth_client.auth.set_session(session['access_token'], session['refresh_token'])
-        else:
-            auth_client = supabase
+        auth_client = get_authenticated_client()
         
         # Get studies with join data for patient cards
-        studies_result = auth_client.table('sleep_studies').select(
-            '*, devices(device_details), survey_responses(type, score, answers)'
-        ).eq('patient_id', user['id']).order('created_at', desc=True).execute()
+        studies_result = shaped_query(auth_client, 'patient_study_cards').eq(
+            'patient_id', user['id']
+        ).order('created_at', desc=True).execute()
         
         patient_studies = []
         for study in studies_result.data:
             # Get device name if assigned
             device_name = None
-            if study.get('devices') and study['devices'].get('device_details'):
-                device_name = study['devices']['device_details'].get('name', 'Device')
+            if study.get('devices'):
+                device_name = study['devices'].get('device_name') or 'Device'
             
             # Get assessment scores
             epworth_score = None
@@ -1369,18 +2277,11 @@ def htmx_patient_confirm_return(study_id):
     
     try:
         # Create authenticated client
-        if 'access_token' in session:
-            auth_client = create_client(
-                supabase_url=os.getenv('SUPABASE_URL'),
-                supabase_key=os.getenv('SUPABASE_ANON_KEY')
-            )
-            auth_client.auth.set_session(session['access_token'], session['refresh_token'])
-        else:
-            auth_client = supabase
+        auth_client = get_authenticated_client()
         
         # Update study state to 'review' and mark device as available
         # First get the study to check ownership and get device_id
-        study_result = auth_client.table('sleep_studies').select('*, devices(*)').eq('id', study_id).eq('patient_id', user['id']).single().execute()
+        study_result = shaped_query(auth_client, 'patient_confirm_return').eq('id', study_id).eq('patient_id', user['id']).single().execute()
         
         if not study_result.data:
             return "<div class='text-red-600 p-4'>Study not found or access denied</div>", 404
@@ -1400,12 +2301,14 @@ def htmx_patient_confirm_return(study_id):
                 'updated_at': datetime.utcnow().isoformat()
             }).eq('id', study['device_id']).execute()
         
+        notify_study_changed(study)
+        
         # Return updated study card
         updated_study = {
             'id': study['id'],
             'current_state': 'review',
             'start_date': study['start_date'],
-            'device_name': study.get('devices', {}).get('device_details', {}).get('name') if study.get('devices') else None
+            'device_name': study['devices'].get('device_name') if study.get('devices') else None
         }
         
         return render_template('fragments/patient/my-studies-cards.html', 
@@ -1432,19 +2335,14 @@ def htmx_staff_dashboard():
         return "Access denied", 403
     
     try:
-        # Get organization data for staff dashboard
-        # This would include pending actions, device status, etc.
+        # Device and capacity numbers come from the trigger-maintained summary
+        auth_client = get_authenticated_client()
+        summary = get_staff_organization_summary(user['id'], auth_client)
+        pending_actions, pending_count = get_staff_pending_actions(user['id'], auth_client)
         dashboard_data = {
-            'pending_actions': [],  # Implement based on business logic
-            'devices': {
-                'available': 5,  # Get from database
-                'assigned': 3,   # Get from database
-                'utilization_percent': 60
-            },
-            'pending_count': 0,
-            'week_bookings': 12,
-            'capacity_status': 'Normal',
-            'over_capacity': False
+            'pending_actions': pending_actions,
+            'pending_count': pending_count,
+            **summary
         }
         
         return render_template('fragments/staff/organization-dashboard.html', **dashboard_data)
@@ -1453,129 +2351,1226 @@ def htmx_staff_dashboard():
         print(f"Error loading staff dashboard: {e}")
         return f"<div class='text-center py-8 text-red-600'>Error loading dashboard: {str(e)}</div>", 500
 
-@app.route('/htmx/doctor/dashboard')
-def htmx_doctor_dashboard():
+@app.route('/htmx/staff/pending-actions')
+@conditional_fragment(lambda user: fingerprint_staff_pending_actions(user))
+def htmx_staff_pending_actions():
     """
-    HTMX endpoint to load doctor clinical dashboard.
+    HTMX endpoint polled by the staff dashboard's "Pending Actions" widget.
+    
+    Answered with 304 while the organizations' booked studies are unchanged.
     
     Returns:
-        str: Rendered doctor dashboard fragment
+        str: Rendered pending actions fragment
         tuple: (error_message, status_code) if unauthorized
     """
     if 'user' not in session:
         return "Unauthorized", 401
     
     user = session['user']
-    if user.get('role') != 'doctor':
+    if user.get('role') != 'staff':
         return "Access denied", 403
     
     try:
-        # Create authenticated client
-        if 'access_token' in session:
-            auth_client = create_client(
-                supabase_url=os.getenv('SUPABASE_URL'),
-                supabase_key=os.getenv('SUPABASE_ANON_KEY')
-            )
-            auth_client.auth.set_session(session['access_token'], session['refresh_token'])
-        else:
-            auth_client = supabase
-        
-        # Get assigned studies for review
-        studies_result = auth_client.table('sleep_studies').select(
-            '*, patient_profiles(*), survey_responses(type, score, answers), sleep_data_files(*), referrals(*)'
-        ).eq('doctor_id', user['id']).order('created_at', desc=True).execute()
-        
-        assigned_studies = []
-        pending_studies = []
-        recent_completed = []
-        
-        for study in studies_result.data:
-            # Get patient info
-            patient_name = "Patient"  # Default
-            if study.get('patient_profiles') and study['patient_profiles'].get('patient_details'):
-                patient_details = study['patient_profiles']['patient_details']
-                patient_name = patient_details.get('full_name', 'Patient')
-            
-            # Get assessment scores
-            epworth_score = None
-            osa50_score = None
-            for response in study.get('survey_responses', []):
-                if response['type'] == 'epworth':
-                    epworth_score = response['score']
-                elif response['type'] == 'osa50':
-                    osa50_score = response['score']
-            
-            study_data = {
-                'id': study['id'],
-                'patient_name': patient_name,
-                'current_state': study['current_state'],
-                'start_date': study['start_date'],
-                'epworth_score': epworth_score or 0,
-                'osa50_score': osa50_score or 0,
-                'has_referrals': bool(study.get('referrals')),
-                'has_sleep_data': bool(study.get('sleep_data_files')),
-                'priority': 'high' if (epworth_score or 0) > 15 or (osa50_score or 0) >= 3 else 'normal'
-            }
-            
-            assigned_studies.append(study_data)
-            
-            if study['current_state'] == 'review':
-                pending_studies.append(study_data)
-            elif study['current_state'] == 'completed':
-                recent_completed.append(study_data)
-        
-        dashboard_data = {
-            'assigned_studies': assigned_studies,
-            'pending_studies': pending_studies[:3],  # Show top 3
-            'recent_completed': recent_completed[:3],
-            'studies_count': {
-                'review': len(pending_studies),
-                'completed': len(recent_completed)
-            }
-        }
-        
-        return render_template('fragments/doctor/clinical-dashboard.html', **dashboard_data)
+        pending_actions, _ = get_staff_pending_actions(user['id'], get_authenticated_client())
+        return render_template('fragments/staff/pending-actions.html', pending_actions=pending_actions)
         
     except Exception as e:
-        print(f"Error loading doctor dashboard: {e}")
-        return f"<div class='text-center py-8 text-red-600'>Error loading dashboard: {str(e)}</div>", 500
+        print(f"Error loading pending actions: {e}")
+        return f"<div class='text-center py-4 text-red-600'>Error loading pending actions: {str(e)}</div>", 500
 
 # ============================================================================
-# DEVELOPMENT SERVER
+# SLEEP DATA INGESTION
 # ============================================================================
 
-if __name__ == '__main__':
-    port = int(os.getenv('PORT', 5000))
-    app.run(debug=True, port=port, host='127.0.0.1')
+# Local disk where recordings are staged chunk by chunk before ingestion
+SLEEP_DATA_STAGING_PATH = SLEEP_DATA_STAGING_DIR or os.path.join(app.instance_path, 'sleep-data-staging')
 
-# Database seeding CLI command
-@app.cli.command("seed-database")
-def seed_database_command():
-    """Create comprehensive test data for the sleep study app."""
-    print("🌱 Seeding database with test data...")
+# Local disk holding signal tile pyramids (one directory per sleep_data_files id)
+SIGNAL_TILES_PATH = SIGNAL_TILES_DIR or os.path.join(app.instance_path, 'signal-tiles')
+
+def get_tile_object_name(study_id, file_id, name):
+    """Storage path of a pyramid file, next to the raw recording."""
+    return f"{study_id}/{file_id}/tiles/{name}"
+
+def fetch_tile_file(file_id, name, destination):
+    """
+    Download a pyramid file this host has no local copy of.
     
-    try:
-        # Import and run the seeding script
-        import seed_database
-        seed_database.main()
-        print("✅ Database seeding completed successfully!")
-    except Exception as e:
-        print(f"❌ Database seeding failed: {e}")
-        return 1
+    Callers have already checked the user's access to the recording, so
+    the privileged client is used.
     
-    return 0
+    Raises:
+        FileNotFoundError: If the recording does not exist
+        UploadError: If Storage has no such file (e.g. ingested before tiles existed)
+    """
+    client = get_privileged_client()
+    result = shaped_query(client, 'recording_access').eq('id', file_id).limit(1).execute()
+    if not result.data:
+        raise FileNotFoundError(file_id)
+    
+    bucket_name = get_storage_bucket_names()['sleep_data']
+    download_object(client, bucket_name,
+                    get_tile_object_name(result.data[0]['sleep_study_id'], file_id, name), destination)
 
-@app.cli.command("clear-database")
-def clear_database_command():
-    """Clear all test data from the database."""
-    print("🧹 Clearing all test data...")
+# Memmapped tile pyramids, fetched from Storage on first use
+tile_store = TileStore(SIGNAL_TILES_PATH, fetch_tile_file)
+
+# Per-(doctor, recording) access checks for tile requests
+recording_access_cache = RecordingAccessCache()
+
+def get_sleep_data_study(study_id, client):
+    """
+    Get the study a recording is uploaded for (RLS limits staff to their organizations).
     
-    try:
-        import seed_database
-        seed_database.clear_existing_data()
-        print("✅ Database cleared successfully!")
-    except Exception as e:
-        print(f"❌ Database clearing failed: {e}")
+    Returns:
+        dict|None: Study row, or None if not found or not visible
+    """
+    result = shaped_query(client, 'sleep_data_upload_study').eq('id', study_id).limit(1).execute()
+    return result.data[0] if result.data else None
+
+def ingest_sleep_data(study, upload, staged_path, client):
+    """
+    Turn a fully staged EDF recording into stored raw and derived data.
+    
+    The recording is validated and summarized first (mmap + chunked NumPy
+    decode), so a corrupt file is rejected before anything is stored, and
+    respiratory/oximetry events are detected and the signal tile pyramid is
+    built in the analysis process pool while the file is still on local
+    disk. The raw file is then streamed to the sleep-data bucket, the
+    per-epoch summary array and tile files are stored next to it, and
+    sleep_data_files / sleep_data_summaries / sleep_study_analyses rows
+    link everything to the study.
+    
+    Args:
+        study (dict): Study row from get_sleep_data_study()
+        upload (dict): Upload state from the session (its id becomes the
+            sleep_data_files id, so a retried ingestion overwrites rather
+            than duplicates)
+        staged_path (str): Local staging file
+        client: Supabase client allowed to write the study's sleep data
+
+    Returns:
+        tuple: (sleep_data_summaries row, sleep_study_analyses row or None
+            if the recording has no SpO2 or airflow channel)
+        
+    Raises:
+        ValueError: If the file is not a readable EDF recording
+    """
+    header, summary = summarize_edf(staged_path)
+    analysis = analyze_recording(staged_path, header)
+    
+    file_id = upload['id']
+    tiles_path = tile_store.get_path(file_id)
+    pyramid = build_pyramid(staged_path, header, tiles_path,
+                            executor=get_analysis_pool(), timeout=ANALYSIS_TIMEOUT_SECONDS)
+    
+    bucket_name = get_storage_bucket_names()['sleep_data']
+    storage = client.storage.from_(bucket_name)
+    raw_path = f"{study['id']}/{file_id}/{upload['filename']}"
+    summary_path = f"{study['id']}/{file_id}/epochs.npy"
+    
+    try:
+        with open(staged_path, 'rb') as staged_file:
+            stream_upload(client, bucket_name, raw_path, staged_file, upload['size'],
+                          'application/octet-stream', upsert=True)
+        storage.upload(summary_path, encode_summary(summary),
+                       {'content-type': 'application/octet-stream', 'x-upsert': 'true'})
+
+        for name in list_pyramid_files(pyramid):
+            with open(os.path.join(tiles_path, name), 'rb') as tile_file:
+                stream_upload(client, bucket_name, get_tile_object_name(study['id'], file_id, name),
+                              tile_file, os.path.getsize(tile_file.name), 'application/octet-stream',
+                              upsert=True)
+    except Exception:
+        shutil.rmtree(tiles_path, ignore_errors=True)
+        raise
+    
+    client.table('sleep_data_files').upsert({
+        'id': file_id,
+        'sleep_study_id': study['id'],
+        'file_url': raw_path
+    }).execute()
+    
+    summary_row = {
+        'sleep_data_file_id': file_id,
+        'sleep_study_id': study['id'],
+        'summary_path': summary_path,
+        'epoch_seconds': EPOCH_SECONDS,
+        'epoch_count': int(summary.shape[1]),
+        'stats': list(SUMMARY_STATS),
+        'signals': describe_signals(header),
+        'recording_start': header['start'].isoformat() if header['start'] else None,
+        'duration_seconds': header['duration_seconds']
+    }
+    client.table('sleep_data_summaries').upsert(summary_row).execute()
+    
+    if analysis:
+        analysis = {'sleep_data_file_id': file_id, 'sleep_study_id': study['id'], **analysis}
+        client.table('sleep_study_analyses').upsert(analysis).execute()
+    
+    discard_staged(staged_path)
+    notify_study_changed(study)
+    return summary_row, analysis
+
+def discard_sleep_data_upload(error, study_id, upload):
+    """Drop the staged recording once its ingestion job has been given up."""
+    discard_staged(get_staging_path(SLEEP_DATA_STAGING_PATH, upload['id']))
+
+@job_queue.task('ingest_sleep_data', queue='ingest', max_attempts=3,
+                visibility_timeout=4 * ANALYSIS_TIMEOUT_SECONDS + 600,
+                on_failure=discard_sleep_data_upload)
+def run_sleep_data_ingestion(study_id, upload):
+    """
+    Background job: ingest a fully staged recording.
+    
+    The uploading staff member's access to the study was checked before
+    the job was queued, so the privileged client writes the results.
+    Storage and database errors are retried; an unreadable recording fails
+    the job permanently with the reason shown to the uploader.
+    
+    Args:
+        study_id (str): UUID of the study
+        upload (dict): Upload state (id, filename, size)
+    
+    Raises:
+        JobFailed: If the study is gone or the file is not a readable EDF recording
+    """
+    client = get_privileged_client()
+    study = get_sleep_data_study(study_id, client)
+    if not study:
+        raise JobFailed("Study not found")
+    
+    try:
+        ingest_sleep_data(study, upload, get_staging_path(SLEEP_DATA_STAGING_PATH, upload['id']), client)
+    except ValueError as e:
+        raise JobFailed(str(e))
+
+def render_sleep_data_ingest_status(study_id, upload):
+    """
+    Render the progress or result fragment of a recording's ingestion job.
+    
+    Args:
+        study_id (str): UUID of the study
+        upload (dict): Upload state (id, filename)
+    
+    Returns:
+        str: Processing fragment (polls again) or result fragment
+    """
+    job = job_queue.get(upload['id'])
+    if job and job['status'] != 'failed':
+        return render_template('fragments/staff/upload-data-processing.html',
+                             study_id=study_id, upload=upload, attempts=job['attempts'])
+    if job:
+        # JobFailed reasons (unreadable file, ...) are meant for the uploader;
+        # anything else only says that processing failed
+        error = job['last_error']
+        if not error or error == UNEXPECTED_JOB_ERROR:
+            error = "The recording could not be processed. Please try uploading it again."
+        return render_template('fragments/staff/upload-data-result.html',
+                             filename=upload['filename'], error=error)
+    
+    # Finished jobs are deleted: the stored rows are the result
+    result = shaped_query(get_authenticated_client(), 'sleep_data_ingest_result').eq(
+        'id', upload['id']
+    ).limit(1).execute()
+    recording = result.data[0] if result.data else None
+    summary = get_embedded_row(recording.get('sleep_data_summaries')) if recording else None
+    if not summary:
+        return render_template('fragments/staff/upload-data-result.html',
+                             filename=upload['filename'],
+                             error="The recording could not be stored. Please try again.")
+    
+    analysis = get_embedded_row(recording.get('sleep_study_analyses'))
+    return render_template('fragments/staff/upload-data-result.html',
+                         filename=upload['filename'], summary=summary, analysis=analysis,
+                         severity=get_ahi_severity(analysis['ahi']) if analysis else None)
+
+@app.route('/htmx/staff/upload-data/<study_id>', methods=['GET', 'POST'])
+def htmx_staff_upload_data(study_id):
+    """
+    Sleep-data upload modal (GET) and start/resume of a chunked upload (POST).
+    
+    POST form fields: filename, size. If the session already holds an
+    unfinished upload of the same file for this study, the client resumes
+    from the bytes already staged on disk.
+    
+    Returns:
+        str: Upload modal fragment (GET)
+        JSON: upload_id, offset and chunk_size (POST)
+        tuple: (error_message, status_code) if unauthorized or invalid
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    if session['user'].get('role') != 'staff':
+        return "Access denied", 403
+    
+    try:
+        study = get_sleep_data_study(study_id, get_authenticated_client())
+    except Exception as e:
+        print(f"Error loading study for sleep data upload: {e}")
+        return "<div class='text-red-600 p-4'>Error loading study</div>", 500
+    
+    if not study:
+        return "<div class='text-red-600 p-4'>Study not found or access denied</div>", 404
+    
+    if request.method == 'GET':
+        return render_template('fragments/staff/upload-data-modal.html', study=study,
+                             patient_name=get_patient_name(study),
+                             max_mb=SLEEP_DATA_MAX_BYTES // (1024 * 1024))
+    
+    filename = os.path.basename(request.form.get('filename', ''))
+    try:
+        size = int(request.form.get('size', ''))
+    except ValueError:
+        return {'error': "Invalid file size"}, 400
+    
+    if not any(filename.lower().endswith(ext) for ext in SLEEP_DATA_EXTENSIONS):
+        return {'error': "Invalid file type. Please upload an EDF recording."}, 400
+    if size <= 0:
+        return {'error': "The selected file is empty."}, 400
+    if size > SLEEP_DATA_MAX_BYTES:
+        return {'error': f"File is too large. The maximum size is {SLEEP_DATA_MAX_BYTES // (1024 * 1024)}MB."}, 413
+    
+    upload = session.get('sleep_data_upload')
+    if not (upload and upload['study_id'] == study_id
+            and upload['filename'] == filename and upload['size'] == size):
+        if upload:
+            discard_staged(get_staging_path(SLEEP_DATA_STAGING_PATH, upload['id']))
+        upload = {'id': str(uuid.uuid4()), 'study_id': study_id, 'filename': filename, 'size': size}
+        session['sleep_data_upload'] = upload
+        session.modified = True
+    
+    offset = get_staged_offset(get_staging_path(SLEEP_DATA_STAGING_PATH, upload['id']))
+    return {'upload_id': upload['id'], 'offset': offset, 'chunk_size': UPLOAD_CHUNK_SIZE}
+
+@app.route('/htmx/staff/upload-data/<study_id>/<upload_id>', methods=['HEAD', 'PATCH'])
+def htmx_staff_upload_data_chunk(study_id, upload_id):
+    """
+    Report the staged offset of (HEAD) or append one chunk to (PATCH) a recording.
+    
+    Same protocol as referral uploads: Upload-Offset and Upload-Checksum
+    headers, 204/409/460 while uploading. The last chunk queues the
+    ingestion job and returns a processing fragment that polls for the
+    result.
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    if session['user'].get('role') != 'staff':
+        return "Access denied", 403
+    
+    upload = session.get('sleep_data_upload')
+    if not upload or upload['id'] != upload_id or upload['study_id'] != study_id:
+        return "Upload not found", 404
+    
+    staged_path = get_staging_path(SLEEP_DATA_STAGING_PATH, upload_id)
+    staged = get_staged_offset(staged_path)
+    
+    if request.method == 'HEAD':
+        return '', 200, {'Upload-Offset': str(staged), 'Cache-Control': 'no-store'}
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return "Missing Upload-Offset header", 400
+    if offset != staged:
+        return "Offset mismatch", 409, {'Upload-Offset': str(staged)}
+    
+    expected = min(UPLOAD_CHUNK_SIZE, upload['size'] - offset)
+    data = read_chunk(request.stream, expected + 1)
+    if len(data) != expected:
+        return f"Chunk must be exactly {expected} bytes", 400
+    
+    try:
+        verify_chunk(data, request.headers.get('Upload-Checksum'))
+        offset = append_chunk(staged_path, offset, data)
+    except ChecksumMismatch as e:
+        return str(e), 460
+    except ValueError:
+        return "Offset mismatch", 409, {'Upload-Offset': str(get_staged_offset(staged_path))}
+    
+    if offset < upload['size']:
+        return '', 204, {'Upload-Offset': str(offset)}
+    
+    session.pop('sleep_data_upload', None)
+    session.modified = True
+    
+    try:
+        study = get_sleep_data_study(study_id, get_authenticated_client())
+        if not study:
+            discard_staged(staged_path)
+            return "<div class='text-red-600 p-4'>Study not found or access denied</div>", 404
+        
+        # The job id is the upload id, so a repeated last chunk cannot queue it twice
+        job_queue.enqueue('ingest_sleep_data', {'study_id': study_id, 'upload': upload}, job_id=upload_id)
+        return render_template('fragments/staff/upload-data-processing.html',
+                             study_id=study_id, upload=upload, attempts=0)
+    
+    except Exception as e:
+        print(f"Error queueing sleep data ingestion: {e}")
+        discard_staged(staged_path)
+        return render_template('fragments/staff/upload-data-result.html',
+                             filename=upload['filename'],
+                             error="The recording could not be stored. Please try again.")
+
+@app.route('/htmx/staff/upload-data/<study_id>/<upload_id>/status')
+def htmx_staff_upload_data_status(study_id, upload_id):
+    """
+    Poll a recording's ingestion: processing fragment until the job has
+    finished, then the result (or the reason it failed).
+    
+    Query Parameters:
+        filename (str): Uploaded file name, for display
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    if session['user'].get('role') != 'staff':
+        return "Access denied", 403
+    
+    upload = {'id': upload_id, 'filename': os.path.basename(request.args.get('filename', 'recording'))}
+    try:
+        return render_sleep_data_ingest_status(study_id, upload)
+    except Exception as e:
+        print(f"Error loading sleep data ingestion status: {e}")
+        return render_template('fragments/staff/upload-data-result.html',
+                             filename=upload['filename'],
+                             error="Could not check the recording's processing status.")
+
+@app.route('/htmx/staff/device-status')
+@conditional_fragment(lambda user: fingerprint_staff_device_status(user))
+def htmx_staff_device_status():
+    """
+    HTMX endpoint polled by the staff dashboard's device status widget.
+    
+    Reads the organization_summaries rows for the staff member's
+    organizations (primary-key lookups) - devices and studies are never
+    scanned on a poll.
+    
+    Returns:
+        str: Rendered device status fragment
+        tuple: (error_message, status_code) if unauthorized
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    user = session['user']
+    if user.get('role') != 'staff':
+        return "Access denied", 403
+    
+    try:
+        summary = get_staff_organization_summary(user['id'], get_authenticated_client())
+        return render_template('fragments/staff/device-status.html', devices=summary['devices'])
+        
+    except Exception as e:
+        print(f"Error loading device status: {e}")
+        return f"<div class='text-center py-4 text-red-600'>Error loading device status: {str(e)}</div>", 500
+
+# Rows per doctor dashboard bucket (limited in the doctor_dashboard() RPC)
+DOCTOR_DASHBOARD_LIMITS = {
+    'review': 3,
+    'completed': 3,
+    'assigned': int(os.getenv('DOCTOR_DASHBOARD_ASSIGNED_LIMIT', 20))
+}
+
+@app.route('/htmx/doctor/dashboard')
+def htmx_doctor_dashboard():
+    """
+    HTMX endpoint to load doctor clinical dashboard.
+    
+    Returns:
+        str: Rendered doctor dashboard fragment
+        tuple: (error_message, status_code) if unauthorized
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    user = session['user']
+    if user.get('role') != 'doctor':
+        return "Access denied", 403
+    
+    try:
+        # Create authenticated client
+        auth_client = get_authenticated_client()
+        
+        dashboard_data = get_doctor_dashboard_data(auth_client)
+        
+        return render_template('fragments/doctor/clinical-dashboard.html', **dashboard_data)
+        
+    except Exception as e:
+        print(f"Error loading doctor dashboard: {e}")
+        return f"<div class='text-center py-8 text-red-600'>Error loading dashboard: {str(e)}</div>", 500
+
+@app.route('/htmx/doctor/pending-reviews')
+@conditional_fragment(lambda user: fingerprint_doctor_reviews(user))
+def htmx_doctor_pending_reviews():
+    """
+    HTMX endpoint polled by the clinical dashboard's "Awaiting Review" widget.
+    
+    Answered with 304 while the doctor's review-state studies are unchanged.
+    
+    Returns:
+        str: Rendered pending reviews fragment
+        tuple: (error_message, status_code) if unauthorized
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    user = session['user']
+    if user.get('role') != 'doctor':
+        return "Access denied", 403
+    
+    try:
+        data = get_doctor_dashboard_data(get_authenticated_client(),
+                                         {'review': DOCTOR_DASHBOARD_LIMITS['review'], 'completed': 0, 'assigned': 0})
+        return render_template('fragments/doctor/pending-reviews.html', **data)
+        
+    except Exception as e:
+        print(f"Error loading pending reviews: {e}")
+        return f"<div class='text-center py-4 text-red-600'>Error loading pending reviews: {str(e)}</div>", 500
+
+# Recording indices (events per hour) that make a study high priority
+# (doctor_dashboard() orders the review bucket by the same rule)
+TRIAGE_AHI_THRESHOLD = 30
+TRIAGE_ODI_THRESHOLD = 30
+
+def get_triage_priority(epworth_score, osa50_score, ahi=None, odi=None):
+    """
+    Get a study's review priority.
+    
+    Once a recording has been analyzed its indices decide (severe AHI or
+    ODI); before that the questionnaire thresholds are used.
+    
+    Returns:
+        str: 'high' or 'normal'
+    """
+    if ahi is not None or odi is not None:
+        severe = ((ahi or 0) >= TRIAGE_AHI_THRESHOLD or (odi or 0) >= TRIAGE_ODI_THRESHOLD)
+        return 'high' if severe else 'normal'
+    return 'high' if epworth_score > 15 or osa50_score >= 3 else 'normal'
+
+def get_doctor_dashboard_data(client, limits=None):
+    """
+    Load the doctor dashboard buckets with one bounded RPC.
+    
+    Each bucket is limited server-side and carries pre-extracted scores and
+    attachment flags instead of child rows.
+    
+    Args:
+        client: Authenticated Supabase client of the doctor
+        limits (dict, optional): Rows per bucket (DOCTOR_DASHBOARD_LIMITS by default)
+        
+    Returns:
+        dict: assigned_studies, pending_studies, recent_completed, studies_count
+    """
+    limits = limits or DOCTOR_DASHBOARD_LIMITS
+    result = client.rpc('doctor_dashboard', {
+        'review_limit': limits['review'],
+        'completed_limit': limits['completed'],
+        'assigned_limit': limits['assigned']
+    }).execute()
+    
+    buckets = {'review': [], 'completed': [], 'assigned': []}
+    review_total = 0
+    
+    for row in result.data:
+        epworth_score = row.get('epworth_score') or 0
+        osa50_score = row.get('osa50_score') or 0
+        ahi = row.get('ahi')
+        odi = row.get('odi')
+        
+        buckets[row['bucket']].append({
+            'id': row['id'],
+            'patient_name': row.get('patient_name') or 'Patient',
+            'current_state': row['current_state'],
+            'start_date': row['start_date'],
+            'completed_date': (row.get('updated_at') or '')[:10],
+            'epworth_score': epworth_score,
+            'osa50_score': osa50_score,
+            'has_referrals': row['has_referrals'],
+            'has_sleep_data': row['has_sleep_data'],
+            'ahi': ahi,
+            'odi': odi,
+            'ahi_severity': get_ahi_severity(ahi),
+            'priority': get_triage_priority(epworth_score, osa50_score, ahi, odi)
+        })
+        
+        if row['bucket'] == 'review':
+            review_total = row.get('bucket_total') or 0
+    
+    return {
+        'assigned_studies': buckets['assigned'],
+        'pending_studies': buckets['review'],
+        'recent_completed': buckets['completed'],
+        'studies_count': {
+            'review': review_total,
+            'completed': len(buckets['completed'])
+        }
+    }
+
+# ============================================================================
+# STUDY REVIEW
+# ============================================================================
+
+def get_embedded_row(value):
+    """Get a one-to-one embed, which PostgREST may return as an object or a list."""
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+def check_recording_access(user_id, file_id):
+    """
+    Check (cached) that the user can read a recording.
+    
+    The check is an RLS-scoped select with the user's own client, so a
+    doctor only sees recordings of studies assigned to them.
+    """
+    def lookup(recording_id):
+        result = shaped_query(get_authenticated_client(), 'recording_access').eq(
+            'id', recording_id
+        ).limit(1).execute()
+        return bool(result.data)
+    
+    return recording_access_cache.check(user_id, file_id, lookup)
+
+@app.route('/htmx/doctor/study-review/<study_id>')
+def htmx_doctor_study_review(study_id):
+    """
+    Study review modal with the waveform viewer for the latest recording.
+    
+    The viewer loads the pyramid metadata and then only the tiles covering
+    the visible window at the current zoom (see htmx_doctor_recording_tile).
+    
+    Returns:
+        str: Rendered study review fragment
+        tuple: (error_message, status_code) if unauthorized or not found
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    if session['user'].get('role') != 'doctor':
+        return "Access denied", 403
+    
+    try:
+        result = shaped_query(get_authenticated_client(), 'doctor_study_review').eq(
+            'id', study_id
+        ).limit(1).execute()
+    except Exception as e:
+        print(f"Error loading study review: {e}")
+        return "<div class='text-red-600 p-4'>Error loading study</div>", 500
+    
+    if not result.data:
+        return "<div class='text-red-600 p-4'>Study not found or access denied</div>", 404
+    
+    study = result.data[0]
+    recordings = sorted(study.get('sleep_data_files') or [], key=lambda row: row['created_at'])
+    recording = recordings[-1] if recordings else None
+    summary = get_embedded_row(recording.get('sleep_data_summaries')) if recording else None
+    analysis = get_embedded_row(recording.get('sleep_study_analyses')) if recording else None
+    
+    return render_template('fragments/doctor/study-review.html',
+                         study=study, patient_name=get_patient_name(study),
+                         recording=recording, summary=summary, analysis=analysis,
+                         severity=get_ahi_severity(analysis['ahi']) if analysis else None)
+
+def tile_response(payload, etag):
+    """
+    JSON response for immutable tile data.
+    
+    Pyramids never change once built (a re-upload gets a new recording id),
+    so browsers may cache tiles for a year; revalidation by ETag still
+    answers 304 without reading the tile.
+    """
+    response = app.response_class(json.dumps(payload, separators=(',', ':')), mimetype='application/json')
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    response.set_etag(etag)
+    return response
+
+def get_tile_request_error(file_id):
+    """Shared auth/access check for tile endpoints (None if allowed)."""
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    if session['user'].get('role') != 'doctor':
+        return "Access denied", 403
+    
+    if not check_recording_access(session['user']['id'], file_id):
+        return "Recording not found", 404
+    
+    return None
+
+@app.route('/htmx/doctor/recordings/<file_id>/tiles')
+def htmx_doctor_recording_tiles(file_id):
+    """
+    Tile pyramid metadata of a recording (signals, levels, scaling).
+    
+    Returns:
+        JSON: pyramid.json contents
+        tuple: (error_message, status_code) if unauthorized or not available
+    """
+    error = get_tile_request_error(file_id)
+    if error:
+        return error
+    
+    etag = f"{file_id}-{PYRAMID_VERSION}"
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+    
+    try:
+        return tile_response(tile_store.metadata(file_id), etag)
+    except (FileNotFoundError, UploadError) as e:
+        print(f"Signal tiles unavailable for {file_id}: {e}")
+        return "No waveform available for this recording", 404
+
+@app.route('/htmx/doctor/recordings/<file_id>/tiles/<int:signal>/<int:level>/<int:tile>')
+def htmx_doctor_recording_tile(file_id, signal, level, tile):
+    """
+    One tile: TILE_BINS samples (level 0) or min/max bins of a signal.
+    
+    Reads only the requested slice of the memmapped pyramid, so the cost
+    does not depend on recording length.
+    
+    Returns:
+        JSON: start_seconds, bin_seconds and values or min/max
+        tuple: (error_message, status_code) if unauthorized or out of range
+    """
+    error = get_tile_request_error(file_id)
+    if error:
+        return error
+    
+    etag = f"{file_id}-{PYRAMID_VERSION}-{signal}-{level}-{tile}"
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+    
+    try:
+        return tile_response(tile_store.read_tile(file_id, signal, level, tile), etag)
+    except IndexError:
+        return "No such tile", 404
+    except (FileNotFoundError, UploadError) as e:
+        print(f"Signal tiles unavailable for {file_id}: {e}")
+        return "No waveform available for this recording", 404
+
+# ============================================================================
+# STUDY REPORTS
+# ============================================================================
+
+def load_report_inputs(study_id):
+    """
+    Load the values a study's report is rendered from.
+    
+    Always read with the privileged client: patients cannot read their
+    recordings under RLS, and the request and the worker must hash the
+    same inputs. Callers check access to the study first.
+    
+    Args:
+        study_id (str): UUID of the study
+    
+    Returns:
+        dict|None: Report inputs, or None if the study does not exist
+    """
+    result = shaped_query(get_privileged_client(), 'study_report_inputs').eq(
+        'id', study_id
+    ).limit(1).execute()
+    return collect_report_inputs(result.data[0]) if result.data else None
+
+def get_report_template_source():
+    """Source of the report template (part of the content hash)."""
+    return app.jinja_env.loader.get_source(app.jinja_env, REPORT_TEMPLATE)[0]
+
+def find_rendered_report(study_id, content_hash, client):
+    """
+    Get the doctor_reports row of an already rendered report.
+    
+    Returns:
+        dict|None: Report row, or None if this version was not rendered yet
+    """
+    result = shaped_query(client, 'study_report_file').eq(
+        'sleep_study_id', study_id
+    ).eq('content_hash', content_hash).limit(1).execute()
+    return result.data[0] if result.data else None
+
+def get_report_url(report):
+    """Signed link to a rendered report (None if it could not be signed)."""
+    path = report.get('report_path') or get_object_path(report['file_url'])
+    return sign_storage_urls([('reports', path)]).get(('reports', path))
+
+@job_queue.task('render_study_report', queue='reports')
+def render_study_report(study_id, content_hash):
+    """
+    Background job: render a study report and store it in the reports bucket.
+    
+    The report is stored under the hash it was requested for, which the
+    status poll looks up. A report that already exists for the hash is not
+    rendered again. The hash is recomputed from the current inputs: if the
+    study changed after the job was queued, the job fails instead of
+    storing newer data under the old hash (the next request queues a
+    report for the new hash).
+    
+    Args:
+        study_id (str): UUID of the study
+        content_hash (str): Hash the report was requested for
+    
+    Raises:
+        JobFailed: If the study no longer exists, its report version is no
+            longer current, or the format is unsupported
+    """
+    client = get_privileged_client()
+    if find_rendered_report(study_id, content_hash, client):
+        return
+    
+    inputs = load_report_inputs(study_id)
+    if inputs is None:
+        raise JobFailed("Study not found")
+    if get_report_hash(inputs, get_report_template_source()) != content_hash:
+        raise JobFailed("Report version is no longer current")
+    
+    analysis = inputs['analysis']
+    html = render_template(REPORT_TEMPLATE, **inputs,
+                           severity=get_ahi_severity(analysis['ahi']) if analysis else None,
+                           generated_at=datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC'))
+    try:
+        body, content_type = encode_report(html)
+    except ValueError as e:
+        raise JobFailed(str(e))
+    
+    bucket_name = get_storage_bucket_names()['reports']
+    storage = client.storage.from_(bucket_name)
+    report_path = get_report_path(study_id, content_hash)
+    storage.upload(report_path, body, {'content-type': content_type, 'x-upsert': 'true'})
+    
+    client.table('doctor_reports').upsert({
+        'sleep_study_id': study_id,
+        'content_hash': content_hash,
+        'report_path': report_path,
+        'file_url': report_path
+    }, on_conflict='sleep_study_id,content_hash').execute()
+
+def render_report_status(study_id, content_hash, client):
+    """
+    Render the report status fragment: ready, failed or still rendering.
+    
+    Only polls: jobs are queued by htmx_patient_study_report, which computes
+    the hash itself, so a hash that was never queued (or is no longer
+    current) does not create work.
+    """
+    report = find_rendered_report(study_id, content_hash, client)
+    if report:
+        return render_template('fragments/patient/report-status.html',
+                             report=report, report_url=get_report_url(report))
+    
+    job = job_queue.get(get_report_job_id(study_id, content_hash))
+    if job and job['status'] == 'failed':
+        return render_template('fragments/patient/report-status.html',
+                             error="Your report could not be prepared. Please try again later.")
+    if not job:
+        # Finished between the two lookups, or never queued for this hash
+        report = find_rendered_report(study_id, content_hash, client)
+        if report:
+            return render_template('fragments/patient/report-status.html',
+                                 report=report, report_url=get_report_url(report))
+        return render_template('fragments/patient/report-status.html',
+                             error="This report is no longer available. Please open the report again.")
+    
+    return render_template('fragments/patient/report-status.html',
+                         study_id=study_id, content_hash=content_hash)
+
+@app.route('/htmx/patient/studies/<study_id>/report')
+def htmx_patient_study_report(study_id):
+    """
+    Report modal for a completed study.
+    
+    Answers immediately: with the report link if the current version is
+    already rendered, otherwise with a progress fragment that polls
+    htmx_patient_study_report_status while the worker renders it.
+    
+    Returns:
+        str: Rendered report modal
+        tuple: (error_message, status_code) if unauthorized or not found
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    user = session['user']
+    if user.get('role') != 'patient':
+        return "Access denied", 403
+    
+    try:
+        client = get_authenticated_client()
+        study = shaped_query(client, 'study_list').eq('id', study_id).eq('patient_id', user['id']).limit(1).execute()
+        if not study.data:
+            return "<div class='text-red-600 p-4'>Study not found or access denied</div>", 404
+        
+        if study.data[0]['current_state'] != 'completed':
+            return render_template('fragments/patient/report-modal.html',
+                                 error="Your report will be available once your doctor has completed the review.")
+        
+        # Hashed from the same privileged load the worker renders from
+        inputs = load_report_inputs(study_id)
+        if inputs is None:
+            return "<div class='text-red-600 p-4'>Study not found or access denied</div>", 404
+        
+        content_hash = get_report_hash(inputs, get_report_template_source())
+        report = find_rendered_report(study_id, content_hash, client)
+        if not report:
+            # Idempotent: the job id is derived from the study and hash
+            job_queue.enqueue('render_study_report',
+                              {'study_id': study_id, 'content_hash': content_hash},
+                              job_id=get_report_job_id(study_id, content_hash))
+        
+        return render_template('fragments/patient/report-modal.html',
+                             study_id=study_id, content_hash=content_hash, report=report,
+                             report_url=get_report_url(report) if report else None)
+    
+    except Exception as e:
+        print(f"Error loading study report: {e}")
+        return f"<div class='text-red-600 p-4'>Error: {str(e)}</div>", 500
+
+@app.route('/htmx/patient/studies/<study_id>/report/<content_hash>')
+def htmx_patient_study_report_status(study_id, content_hash):
+    """
+    Poll the rendering of one report version.
+    
+    Returns:
+        str: Report status fragment (link, error, or progress that polls again)
+        tuple: (error_message, status_code) if unauthorized or not found
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    user = session['user']
+    if user.get('role') != 'patient':
+        return "Access denied", 403
+    
+    if not re.fullmatch(r'[0-9a-f]{64}', content_hash):
+        return "Invalid report version", 400
+    
+    try:
+        client = get_authenticated_client()
+        study = shaped_query(client, 'study_list').eq('id', study_id).eq('patient_id', user['id']).limit(1).execute()
+        if not study.data:
+            return "<div class='text-red-600 p-4'>Study not found or access denied</div>", 404
+        
+        return render_report_status(study_id, content_hash, client)
+    
+    except Exception as e:
+        print(f"Error checking study report: {e}")
+        return render_template('fragments/patient/report-status.html',
+                             error="Could not check your report. Please try again.")
+
+# ============================================================================
+# STUDY DETAILS
+# ============================================================================
+
+def get_study_details(study):
+    """
+    Flatten a study_details row for the study details modal.
+    
+    Every document link of the study is signed in one batch per bucket
+    (and reused from signed_url_cache when still valid), so opening the
+    modal costs at most one Storage round trip whatever the number of
+    attachments. Only the latest report is listed.
+    
+    Args:
+        study (dict): Row selected with the 'study_details' shape
+        
+    Returns:
+        dict: Study fields and document lists used by the template
+    """
+    scores = {}
+    for response in sorted(study.get('survey_responses') or [], key=lambda row: row['created_at']):
+        scores[response['type']] = response['score']
+    
+    referrals = [dict(row, path=get_object_path(row['file_url']))
+                 for row in sorted(study.get('referrals') or [], key=lambda row: row['created_at'])]
+    reports = [dict(row, path=row.get('report_path') or get_object_path(row['file_url']))
+               for row in sorted(study.get('doctor_reports') or [], key=lambda row: row['created_at'])[-1:]]
+    
+    urls = sign_storage_urls([('referrals', row['path']) for row in referrals] +
+                             [('reports', row['path']) for row in reports])
+    for row in referrals:
+        row['url'] = urls.get(('referrals', row['path']))
+    for row in reports:
+        row['url'] = urls.get(('reports', row['path']))
+    
+    return {
+        'id': study['id'],
+        'current_state': study['current_state'],
+        'start_date': study.get('start_date'),
+        'end_date': study.get('end_date'),
+        'device_name': (get_embedded_row(study.get('devices')) or {}).get('device_name'),
+        'patient_name': get_patient_name(study),
+        'epworth_score': scores.get('epworth'),
+        'osa50_score': scores.get('osa50'),
+        'referrals': referrals,
+        'sleep_data_files': study.get('sleep_data_files') or [],
+        'doctor_reports': reports
+    }
+
+@app.route('/htmx/study/<study_id>/details')
+def htmx_study_details(study_id):
+    """
+    Study details modal shared by all roles.
+    
+    The study is read with the user's own client, so RLS decides who may
+    open it; document links are only signed for rows that came back.
+    
+    Returns:
+        str: Rendered study details modal
+        tuple: (error_message, status_code) if unauthorized or not found
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    try:
+        result = shaped_query(get_authenticated_client(), 'study_details').eq(
+            'id', study_id
+        ).limit(1).execute()
+    except Exception as e:
+        print(f"Error loading study details: {e}")
+        return "<div class='text-red-600 p-4'>Error loading study</div>", 500
+    
+    if not result.data:
+        return "<div class='text-red-600 p-4'>Study not found or access denied</div>", 404
+    
+    return render_template('fragments/shared/study-details-modal.html',
+                         study=get_study_details(result.data[0]), user=session['user'])
+
+# ============================================================================
+# DOWNLOADS
+# ============================================================================
+
+DOWNLOAD_CACHE_PATH = DOWNLOAD_CACHE_DIR or os.path.join(app.instance_path, 'download-cache')
+
+# Recently downloaded recordings, shared by all workers on this host
+download_cache = DownloadCache(DOWNLOAD_CACHE_PATH)
+
+def stream_storage_download(bucket_name, object_path, filename, etag):
+    """
+    Proxy a Storage object that is not cached locally.
+    
+    A Range header is forwarded, so resumed and partial reads only fetch
+    the requested bytes. A complete download is written to download_cache
+    while it streams, so the next request for the object is a local hit.
+    
+    Args:
+        bucket_name (str): Storage bucket name
+        object_path (str): Object path in the bucket
+        filename (str): Download file name
+        etag (str): Strong ETag of the (immutable) object
+        
+    Returns:
+        Response: Streaming 200/206 response, or an error tuple
+    """
+    byte_range = request.headers.get('Range')
+    if byte_range and request.if_range.etag and request.if_range.etag != etag:
+        byte_range = None
+    
+    # Access was checked against the study with the user's own client
+    upstream = open_object(get_privileged_client(), bucket_name, object_path, byte_range)
+    if upstream.status_code == 416:
+        upstream.close()
+        return "Requested range not satisfiable", 416, {
+            'Content-Range': upstream.headers.get('Content-Range', '')
+        }
+    if upstream.status_code not in (200, 206):
+        upstream.close()
+        print(f"Error downloading {object_path}: Storage returned {upstream.status_code}")
+        return "File not available", 404 if upstream.status_code in (400, 404) else 502
+    
+    chunks = upstream.iter_bytes(DOWNLOAD_CHUNK_SIZE)
+    content_length = upstream.headers.get('Content-Length')
+    if upstream.status_code == 200 and content_length:
+        chunks = download_cache.stream_into(f"{bucket_name}/{object_path}", chunks, int(content_length))
+    
+    response = app.response_class(chunks, status=upstream.status_code,
+                                  mimetype='application/octet-stream', direct_passthrough=True)
+    for header in ('Content-Length', 'Content-Range'):
+        if header in upstream.headers:
+            response.headers[header] = upstream.headers[header]
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.set_etag(etag)
+    response.call_on_close(upstream.close)
+    return response
+
+@app.route('/htmx/download/<file_id>')
+def htmx_download_sleep_data(file_id):
+    """
+    Download a raw sleep recording.
+    
+    Access is checked with the user's own client, so RLS limits it to
+    recordings of studies the user may see. Hot recordings are served
+    from the local download cache with send_file() (Range requests and
+    wsgi.file_wrapper); misses are streamed from Storage in chunks.
+    
+    Returns:
+        Response: File download (200, 206 or 304)
+        tuple: (error_message, status_code) if unauthorized or not found
+    """
+    if 'user' not in session:
+        return "Unauthorized", 401
+    
+    if session['user'].get('role') not in ('staff', 'doctor', 'admin'):
+        return "Access denied", 403
+    
+    try:
+        result = shaped_query(get_authenticated_client(), 'recording_download').eq(
+            'id', file_id
+        ).limit(1).execute()
+    except Exception as e:
+        print(f"Error checking recording access: {e}")
+        return "Error checking access", 500
+    
+    if not result.data:
+        return "Recording not found or access denied", 404
+    
+    object_path = get_object_path(result.data[0]['file_url'])
+    if not object_path:
+        return "Recording not found or access denied", 404
+    
+    bucket_name = get_storage_bucket_names()['sleep_data']
+    filename = os.path.basename(object_path)
+    
+    # Recordings never change (a re-upload gets a new id)
+    if request.if_none_match.contains(file_id):
+        return '', 304, {'ETag': f'"{file_id}"'}
+    
+    cached_path = download_cache.lookup(f"{bucket_name}/{object_path}")
+    if cached_path:
+        response = send_file(cached_path, mimetype='application/octet-stream',
+                             as_attachment=True, download_name=filename,
+                             conditional=True, etag=file_id)
+        response.cache_control.private = True
+        return response
+    
+    try:
+        return stream_storage_download(bucket_name, object_path, filename, file_id)
+    except Exception as e:
+        print(f"Error downloading recording: {e}")
+        return "Download failed", 502
+
+# ============================================================================
+# DEVELOPMENT SERVER
+# ============================================================================
+
+if __name__ == '__main__':
+    port = int(os.getenv('PORT', 5000))
+    app.run(debug=True, port=port, host='127.0.0.1')
+
+# Database seeding CLI command
+@app.cli.command("seed-database")
+def seed_database_command():
+    """Create comprehensive test data for the sleep study app."""
+    print("🌱 Seeding database with test data...")
+    
+    try:
+        # Import and run the seeding script
+        import seed_database
+        seed_database.main()
+        print("✅ Database seeding completed successfully!")
+    except Exception as e:
+        print(f"❌ Database seeding failed: {e}")
+        return 1
+    
+    return 0
+
+@app.cli.command("clear-database")
+def clear_database_command():
+    """Clear all test data from the database."""
+    print("🧹 Clearing all test data...")
+    
+    try:
+        import seed_database
+        seed_database.clear_existing_data()
+        print("✅ Database cleared successfully!")
+    except Exception as e:
+        print(f"❌ Database clearing failed: {e}")
         return 1
     
-    return 0 
\ No newline at end of file
+    return 0 
+
+@app.cli.command("storage-init")
+def storage_init_command():
+    """Provision storage buckets and record them in the local marker."""
+    print("🗂️  Provisioning storage buckets...")
+    
+    try:
+        try:
+            client = get_service_client()
+        except ValueError:
+            print("⚠️  SUPABASE_SERVICE_ROLE_KEY not set - using anon client")
+            client = supabase
+        
+        results = initialize_storage_buckets(client)
+        write_storage_marker(results)
+        
+        if 'failed' in results.values():
+            print("⚠️  Some buckets could not be provisioned")
+            return 1
+        print(f"✅ Storage marker written to {STORAGE_MARKER_PATH}")
+    except Exception as e:
+        print(f"❌ Storage initialization failed: {e}")
+        return 1
+    
+    return 0
+
+@app.cli.command("auth-check")
+def auth_check_command():
+    """Check that access tokens can be verified locally (run before starting the app)."""
+    print("🔐 Checking token verification settings...")
+    
+    try:
+        checked = token_verifier.check_configuration()
+    except ValueError as e:
+        print(f"❌ {e}")
+        raise SystemExit(1)
+    
+    if not checked:
+        print("❌ Could not fetch the project's signing keys from Auth")
+        raise SystemExit(1)
+    print("✅ Token verification is configured")
+    return 0
+
+@app.cli.command("worker")
+@click.option('--queues', default='', help='Comma-separated queues to serve (default: all)')
+@click.option('--threads', default=JOB_WORKER_THREADS, type=int, help='Jobs run concurrently')
+@click.option('--burst', is_flag=True, help='Exit once no job is ready')
+def worker_command(queues, threads, burst):
+    """Process background jobs until stopped (SIGTERM/Ctrl-C finish running jobs first)."""
+    try:
+        job_queue.run_worker(
+            queues=[queue.strip() for queue in queues.split(',') if queue.strip()] or None,
+            threads=threads,
+            queue_limits=parse_queue_limits(os.getenv('JOB_QUEUE_CONCURRENCY', '')),
+            burst=burst
+        )
+    except Exception as e:
+        print(f"❌ Worker failed: {e}")
+        return 1
+    
+    return 0
+
+@app.cli.command("templates-compile")
+def templates_compile_command():
+    """Precompile all Jinja templates into the bytecode cache."""
+    print("🧩 Compiling templates...")
+    
+    try:
+        # Start from an empty cache so every template is compiled afresh
+        app.jinja_env.bytecode_cache.clear()
+        app.jinja_env.cache.clear()
+        results = preload_templates()
+        
+        for name, error in results['failed'].items():
+            print(f"❌ {name}: {error}")
+        if results['failed']:
+            return 1
+        print(f"✅ Compiled {len(results['loaded'])} templates into {TEMPLATE_BYTECODE_DIR}")
+    except Exception as e:
+        print(f"❌ Template compilation failed: {e}")
+        return 1
+    
+    return 0
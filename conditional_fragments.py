@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Conditional (ETag / 304) Responses for Polled HTMX Fragments
+
+The dashboards poll several fragments every 30-60 seconds (patient study
+cards, doctor pending reviews, staff pending actions and device status).
+Each poll used to run the fragment's full query and re-render its template
+even though the data almost never changes between polls.
+
+This module answers those polls conditionally:
+- Each fragment registers a cheap fingerprint function - typically
+  max(updated_at) plus a row count from one tiny query (fetch_fingerprint)
+- The fingerprint, user, path and template version are hashed into an ETag
+- If the request's If-None-Match matches, a bodyless 304 is returned before
+  the view's heavy query or template runs
+- Otherwise the view runs as before and its 200 response carries the ETag
+
+HTMX does not handle 304s on its own, so base.html echoes each element's
+last ETag in If-None-Match and skips the swap on a 304, keeping the
+existing DOM.
+"""
+
+import hashlib
+import json
+import os
+from functools import wraps
+
+from flask import current_app, request, session
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+def get_templates_version():
+    """
+    Get a version string that changes whenever a template file changes.
+
+    Mixed into every ETag so a deploy with new markup never serves a 304
+    for HTML rendered from the old templates. Identical across workers of
+    the same deployment.
+
+    Returns:
+        str: Latest template modification time
+    """
+    latest = 0
+    for root, _, files in os.walk(TEMPLATES_DIR):
+        for name in files:
+            latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+    return str(latest)
+
+TEMPLATES_VERSION = get_templates_version()
+
+def fetch_fingerprint(query, column='updated_at'):
+    """
+    Fingerprint the rows matched by a query in one round trip.
+
+    The query must select only the fingerprint column with count='exact';
+    it is ordered by that column and limited to one row, so PostgREST
+    returns the newest value plus the total count in the Content-Range header.
+
+    Args:
+        query: Select query builder (select(column, count='exact') + filters)
+        column (str): Timestamp column that changes on every write
+
+    Returns:
+        tuple: (row count, latest column value or None)
+    """
+    result = query.order(column, desc=True).limit(1).execute()
+    latest = result.data[0][column] if result.data else None
+    return result.count, latest
+
+def conditional_fragment(fingerprint):
+    """
+    Decorate an HTMX fragment route with ETag / 304 handling.
+
+    Args:
+        fingerprint (callable): fingerprint(user, *view_args) returning any
+            JSON-serializable version of the fragment's data, or None to
+            skip conditional handling (e.g. wrong role - the view then
+            returns its own error)
+
+    Returns:
+        callable: Decorator
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user = session.get('user')
+            if not user:
+                return view(*args, **kwargs)
+
+            try:
+                version = fingerprint(user, *args, **kwargs)
+            except Exception as e:
+                # Never fail a poll because the fingerprint query failed
+                print(f"Error computing fragment fingerprint: {e}")
+                version = None
+
+            if version is None:
+                return view(*args, **kwargs)
+
+            key = json.dumps([request.full_path, user.get('id'), version, TEMPLATES_VERSION],
+                             default=str, sort_keys=True)
+            etag = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            # Private per-user data; always revalidate before reuse
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Local Download Cache for the Sleep Study Management System
+
+Raw recordings are hundreds of megabytes. Serving one by redirecting to
+Storage (or by proxying it) downloads the whole object again every time a
+doctor opens it, although it never changes once ingested.
+
+This module keeps recently downloaded objects on local disk instead:
+- A download that misses the cache is streamed to the client in
+  DOWNLOAD_CHUNK_SIZE chunks and written to a partial file as it goes;
+  once every byte arrived the file is renamed into the cache, so the next
+  request is served from disk (and a dropped download caches nothing)
+- Only one request per object and process fills the cache; concurrent
+  misses just stream
+- The cache is bounded by bytes (DOWNLOAD_CACHE_BYTES): a hit touches the
+  file's mtime, and adding a file evicts the least recently used files
+  until the total fits. The directory is the only state, so all workers
+  on a host share one cache and one bound
+- Objects larger than a quarter of the cache are never cached, so one
+  huge file cannot flush everything else
+
+Cached files are plain files, so the app serves them with send_file()
+(Range requests, conditional requests and wsgi.file_wrapper / sendfile).
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+DOWNLOAD_CACHE_DIR = os.getenv('DOWNLOAD_CACHE_DIR')
+
+# Total size of cached objects per host
+DOWNLOAD_CACHE_BYTES = int(os.getenv('DOWNLOAD_CACHE_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Bytes read from Storage and written to the client at a time
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+PARTIAL_SUFFIX = '.part'
+
+# Partial files older than this are left over from a crashed worker
+STALE_PARTIAL_SECONDS = 24 * 3600
+
+class DownloadCache:
+    """
+    Byte-bounded LRU of downloaded objects in a local directory.
+
+    Args:
+        root (str): Cache directory (created if missing)
+        max_bytes (int): Total size of cached files before eviction
+    """
+
+    def __init__(self, root, max_bytes=DOWNLOAD_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_bytes // 4
+        self._filling = set()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def get_path(self, key):
+        """Local file of a cache key (e.g. '<bucket>/<object path>')."""
+        return os.path.join(self.root, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def lookup(self, key):
+        """
+        Get the cached file of a key and mark it recently used.
+
+        Returns:
+            str|None: Local file path, or None on a miss
+        """
+        path = self.get_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def stream_into(self, key, chunks, size):
+        """
+        Pass chunks through while writing them to the cache.
+
+        The file is added only if exactly `size` bytes arrived. If the
+        object is too large or another request is already filling the
+        key, chunks are passed through untouched.
+
+        Args:
+            key (str): Cache key
+            chunks (iterable): Object content, e.g. httpx iter_bytes()
+            size (int): Expected object size (Content-Length)
+
+        Yields:
+            bytes: The chunks, unchanged
+        """
+        with self._lock:
+            fill = size <= self.max_object_bytes and key not in self._filling
+            if fill:
+                self._filling.add(key)
+
+        if not fill:
+            yield from chunks
+            return
+
+        path = self.get_path(key)
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}{PARTIAL_SUFFIX}"
+        try:
+            written = 0
+            with open(partial, 'wb') as local_file:
+                for data in chunks:
+                    local_file.write(data)
+                    written += len(data)
+                    yield data
+            if written == size:
+                os.replace(partial, path)
+                self.evict()
+        finally:
+            with self._lock:
+                self._filling.discard(key)
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def evict(self):
+        """
+        Delete least recently used files until the cache fits max_bytes.
+
+        Files still being sent are unlinked but stay readable until closed.
+        """
+        now = time.time()
+        files = []
+        total = 0
+        for entry in os.scandir(self.root):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(PARTIAL_SUFFIX):
+                if now - stat.st_mtime > STALE_PARTIAL_SECONDS:
+                    self._remove(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        for _, file_size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= file_size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
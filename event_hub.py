@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Event Hub for Server-Sent Events in the Sleep Study Management System
+
+Dashboards used to poll their fragments on fixed timers, so database load
+grew with the number of open tabs rather than with the number of changes.
+
+This module pushes change notifications instead:
+- EventHub: in-process pub/sub; each SSE connection subscribes to its
+  topics (patient:<id>, doctor:<id>, org:<id>) and receives events on a
+  bounded queue
+- Brokers fan published events out to every gunicorn worker, so an SSE
+  connection on one worker sees changes made through another:
+  - SQLiteEventBroker: WAL-mode SQLite event log tailed by one listener
+    thread per worker (same host, no extra services)
+  - RedisEventBroker: Redis pub/sub (optional `redis` package, any host)
+  - no broker: events stay in the publishing process (single-process dev)
+
+Backends are selected with EVENT_BACKEND (memory | sqlite | redis). Events
+only say *what* changed; the browser then refetches the affected fragment
+(which the ETag layer answers cheaply if nothing it shows has changed).
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+EVENT_BACKEND = os.getenv('EVENT_BACKEND', 'sqlite')
+
+# Events buffered per connection before the oldest are dropped
+SUBSCRIPTION_QUEUE_SIZE = 100
+
+# SQLite broker: listener poll interval and event log retention
+SQLITE_POLL_INTERVAL = 0.25
+SQLITE_RETENTION_SECONDS = 300
+
+class Subscription:
+    """
+    One SSE connection's view of the hub.
+
+    Args:
+        topics (iterable): Topics the connection receives events for
+    """
+
+    def __init__(self, topics):
+        self.topics = frozenset(topics)
+        self._queue = queue.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+
+    def put(self, message):
+        """Queue an event, dropping the oldest if the client is not keeping up."""
+        while True:
+            try:
+                self._queue.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        Wait for the next event.
+
+        Args:
+            timeout (float, optional): Seconds to wait
+
+        Returns:
+            dict|None: Event message, or None on timeout
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class EventHub:
+    """
+    In-process publish/subscribe hub with optional cross-worker broker.
+
+    Args:
+        broker: SQLiteEventBroker, RedisEventBroker or None (process-local)
+    """
+
+    def __init__(self, broker=None):
+        self.broker = broker
+        self._subscribers = {}  # topic -> set of Subscription
+        self._lock = threading.Lock()
+
+    def publish(self, topic, event, data=None):
+        """
+        Publish an event to every subscriber of a topic, in all workers.
+
+        Publishing never raises: a failed broker write is logged and the
+        event is delivered locally only.
+
+        Args:
+            topic (str): e.g. 'patient:<uuid>' or 'org:<uuid>'
+            event (str): SSE event name, e.g. 'studies-changed'
+            data (dict, optional): JSON-serializable event payload
+        """
+        message = {'topic': topic, 'event': event, 'data': data or {}}
+        if self.broker is None:
+            self._deliver(message)
+            return
+        try:
+            self.broker.send(message)
+        except Exception as e:
+            print(f"Error publishing event: {e}")
+            self._deliver(message)
+
+    def subscribe(self, topics):
+        """
+        Subscribe to events for the given topics.
+
+        Args:
+            topics (iterable): Topics to receive
+
+        Returns:
+            Subscription: Call unsubscribe() with it when the connection ends
+        """
+        subscription = Subscription(topics)
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscribers.setdefault(topic, set()).add(subscription)
+        if self.broker is not None:
+            # Started lazily so each forked worker runs its own listener
+            self.broker.ensure_listening(self._deliver)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a subscription from all of its topics."""
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def _deliver(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(message['topic'], ()))
+        for subscription in subscribers:
+            subscription.put(message)
+
+# ============================================================================
+# CROSS-WORKER BROKERS
+# ============================================================================
+
+class SQLiteEventBroker:
+    """
+    Same-host event fan-out through a WAL-mode SQLite event log.
+
+    Publishing appends a row; one listener thread per worker tails the log
+    by rowid and hands new events to its hub. Old rows are purged after
+    SQLITE_RETENTION_SECONDS.
+
+    Args:
+        path (str): Database file path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        self._writes = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connect().execute(
+            'create table if not exists events ('
+            ' id integer primary key autoincrement,'
+            ' payload text not null,'
+            ' created_at real not null)'
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def send(self, message):
+        conn = self._connect()
+        conn.execute('insert into events (payload, created_at) values (?, ?)',
+                     (json.dumps(message), time.time()))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            conn.execute('delete from events where created_at < ?',
+                         (time.time() - SQLITE_RETENTION_SECONDS,))
+
+    def ensure_listening(self, deliver):
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            threading.Thread(target=self._listen, args=(deliver,),
+                             name='sqlite-event-listener', daemon=True).start()
+
+    def _listen(self, deliver):
+        conn = self._connect()
+        last_id = conn.execute('select coalesce(max(id), 0) from events').fetchone()[0]
+        while True:
+            try:
+                rows = conn.execute('select id, payload from events where id > ? order by id',
+                                    (last_id,)).fetchall()
+                for event_id, payload in rows:
+                    last_id = event_id
+                    deliver(json.loads(payload))
+            except Exception as e:
+                print(f"Error reading event log: {e}")
+            time.sleep(SQLITE_POLL_INTERVAL)
+
+class RedisEventBroker:
+    """
+    Event fan-out over Redis pub/sub (Redis, Valkey, KeyDB...).
+
+    Args:
+        url (str): Connection URL, e.g. redis://localhost:6379/0
+        channel (str): Pub/sub channel carrying all events
+    """
+
+    def __init__(self, url, channel='sleep-study:events'):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("EVENT_BACKEND=redis requires the 'redis' package")
+        self.url = url
+        self.channel = channel
+        self._redis = redis
+        self._client = redis.Redis.from_url(url)
+        self._client_pid = os.getpid()
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def send(self, message):
+        if self._client_pid != os.getpid():
+            self._client = self._redis.Redis.from_url(self.url)
+            self._client_pid = os.getpid()
+        self._client.publish(self.channel, json.dumps(message))
+
+    def ensure_listening(self, deliver):
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            threading.Thread(target=self._listen, args=(deliver,),
+                             name='redis-event-listener', daemon=True).start()
+
+    def _listen(self, deliver):
+        while True:
+            try:
+                pubsub = self._redis.Redis.from_url(self.url).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for item in pubsub.listen():
+                    deliver(json.loads(item['data']))
+            except Exception as e:
+                print(f"Error reading event channel: {e}")
+                time.sleep(1)
+
+def create_event_hub(app, backend=EVENT_BACKEND):
+    """
+    Create the event hub with the broker selected by EVENT_BACKEND.
+
+    Args:
+        app (Flask): Application (used for the instance folder path)
+        backend (str): 'memory', 'sqlite' or 'redis'
+
+    Returns:
+        EventHub: Hub instance
+
+    Raises:
+        ValueError: If the backend name is unknown or misconfigured
+    """
+    if backend == 'memory':
+        return EventHub()
+    if backend == 'sqlite':
+        path = os.getenv('EVENT_SQLITE_PATH',
+                         os.path.join(app.instance_path, 'events.sqlite3'))
+        return EventHub(SQLiteEventBroker(path))
+    if backend == 'redis':
+        return EventHub(RedisEventBroker(os.getenv('EVENT_REDIS_URL', 'redis://localhost:6379/0')))
+    raise ValueError(f"Unknown EVENT_BACKEND: {backend}")
+
+def format_sse(event, data=None):
+    """
+    Format one Server-Sent Events message.
+
+    Args:
+        event (str): Event name (HTMX listens with hx-trigger="sse:<event>")
+        data (dict, optional): JSON payload
+
+    Returns:
+        str: Wire-format SSE message
+    """
+    return f"event: {event}\ndata: {json.dumps(data or {})}\n\n"
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Rendered-Fragment Cache for the Sleep Study Management System
+
+Several booking wizard steps (intro, Epworth and OSA-50 questionnaires) do
+not depend on the user at all: their HTML is a pure function of the
+template and the static question lists. They were still rendered through
+Jinja on every wizard navigation.
+
+This module caches rendered HTML instead:
+- Keyed by template name plus the exact context values the template reads
+  (declared per template, so the key cannot silently miss an input)
+- Bounded LRU (FRAGMENT_CACHE_SIZE entries per worker)
+- In debug mode (or with TEMPLATES_AUTO_RELOAD) entries are invalidated when
+  the template file's mtime changes, so edits show up without a restart
+- Hit/miss counters for checking the cache is effective
+
+Only register templates that never read session, request or other
+per-user globals - those are not part of the cache key.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app, render_template
+
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', 256))
+
+class FragmentCache:
+    """
+    Bounded LRU cache of rendered, user-independent templates.
+
+    Args:
+        templates (dict): Template name -> tuple of context keys it reads
+        maxsize (int): Maximum number of rendered fragments held
+    """
+
+    def __init__(self, templates, maxsize=FRAGMENT_CACHE_SIZE):
+        self.templates = templates
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (template mtime, html)
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, template_name):
+        """Check whether a template is registered for caching."""
+        return template_name in self.templates
+
+    def render(self, template_name, **context):
+        """
+        Render a template, serving the HTML from cache when possible.
+
+        Templates that are not registered are rendered normally.
+
+        Args:
+            template_name (str): Template to render
+            **context: Template context (only the registered keys are used
+                for the cache key; other values are passed through)
+
+        Returns:
+            str: Rendered HTML
+        """
+        if template_name not in self.templates:
+            return render_template(template_name, **context)
+
+        inputs = {key: context.get(key) for key in self.templates[template_name]}
+        digest = hashlib.sha256(
+            json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+        key = (template_name, digest)
+        mtime = self._get_mtime(template_name)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        html = render_template(template_name, **context)
+
+        with self._lock:
+            self._entries[key] = (mtime, html)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return html
+
+    def clear(self):
+        """Drop all cached fragments."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Get cache counters.
+
+        Returns:
+            dict: hits, misses, hit_ratio, size and maxsize
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize
+            }
+
+    def _get_mtime(self, template_name):
+        """Template file mtime in debug/auto-reload mode, else None (never invalidated)."""
+        if not (current_app.debug or current_app.config.get('TEMPLATES_AUTO_RELOAD')):
+            return None
+        filename = current_app.jinja_env.get_template(template_name).filename
+        try:
+            return os.path.getmtime(filename)
+        except (OSError, TypeError):
+            return None
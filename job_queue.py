@@ -0,0 +1,564 @@
+#!/usr/bin/env python3
+"""
+Durable Background Jobs for the Sleep Study Management System
+
+Slow work ran on the request thread: recording ingestion (summaries,
+analysis, tile pyramids and several Storage uploads) kept the uploading
+browser waiting for its last chunk, and even the booking error report was
+a synchronous file write. There was also nowhere to run work that should
+not block a request at all.
+
+This module provides a small durable job queue instead:
+- Tasks are plain functions registered with @job_queue.task(); request
+  handlers call job_queue.enqueue(name, payload) and return immediately
+- Jobs are rows in a store that survives restarts:
+  - SQLiteJobStore: WAL-mode SQLite file (local development, single host)
+  - PostgresJobStore: public.jobs table through the service-role client,
+    claimed with `for update skip locked` (see the jobs migration)
+- `flask worker` runs a thread pool that claims jobs queue by queue
+- Claimed jobs are invisible to other workers for a visibility timeout;
+  a worker that dies mid-job leaves it to be claimed again afterwards.
+  Completing or failing a job only applies while it is still locked by the
+  worker that ran it, so a worker that overran its timeout cannot delete
+  or requeue a job another worker has since claimed
+- Failures are retried with exponential backoff (and jitter) up to the
+  task's max_attempts; JobFailed marks a failure as permanent
+- Per-queue concurrency limits (JOB_QUEUE_CONCURRENCY) are enforced at
+  claim time across all workers, e.g. ingest=1 so recordings are processed
+  one at a time per deployment
+
+Backends are selected with JOB_BACKEND (sqlite | postgres). Finished jobs
+are deleted; failed jobs are kept with their last error: the JobFailed
+message, or UNEXPECTED_JOB_ERROR for any other exception, whose traceback
+is only written to the worker log.
+"""
+
+import json
+import os
+import random
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_BACKEND = os.getenv('JOB_BACKEND', 'sqlite')
+
+# Seconds a claimed job stays invisible to other workers
+JOB_VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', 300))
+
+# Attempts before a job is marked failed
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+
+# Retry backoff: base * 2^(attempt - 1), capped
+JOB_RETRY_BASE_SECONDS = 5
+JOB_RETRY_MAX_SECONDS = 3600
+
+# Worker threads per `flask worker` process and idle poll interval
+JOB_WORKER_THREADS = int(os.getenv('JOB_WORKER_THREADS', 4))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1.0))
+
+# Per-queue concurrency limits across all workers, e.g. "ingest=1,reports=2"
+JOB_QUEUE_CONCURRENCY = os.getenv('JOB_QUEUE_CONCURRENCY', '')
+
+# last_error of a job that raised anything but JobFailed (details are logged)
+UNEXPECTED_JOB_ERROR = 'Unexpected error'
+
+class JobFailed(Exception):
+    """Raised by a task for a failure that retrying cannot fix (message may be shown to users)."""
+
+def parse_queue_limits(value):
+    """
+    Parse a JOB_QUEUE_CONCURRENCY value.
+
+    Args:
+        value (str): Comma-separated queue=limit pairs
+
+    Returns:
+        dict: Queue name -> maximum running jobs
+
+    Raises:
+        ValueError: If an entry is malformed
+    """
+    limits = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        name, _, limit = entry.partition('=')
+        if not name or not limit.strip().isdigit():
+            raise ValueError(f"Invalid JOB_QUEUE_CONCURRENCY entry: {entry}")
+        limits[name.strip()] = int(limit)
+    return limits
+
+def get_retry_delay(attempts):
+    """
+    Seconds to wait before retrying a job that failed its n-th attempt.
+
+    Jitter spreads out retries of jobs that failed together (e.g. during a
+    Storage outage).
+    """
+    delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+# ============================================================================
+# JOB STORES
+# ============================================================================
+
+class SQLiteJobStore:
+    """
+    Job store in a WAL-mode SQLite file, shared by all processes on a host.
+
+    Claims run in `begin immediate` transactions, so two workers never
+    claim the same job. Connections are opened per thread and per process.
+
+    Args:
+        path (str): Database file path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            'create table if not exists jobs ('
+            ' id text primary key,'
+            ' queue text not null,'
+            ' task text not null,'
+            ' payload text not null,'
+            " status text not null default 'queued',"
+            ' attempts integer not null default 0,'
+            ' max_attempts integer not null,'
+            ' run_at real not null,'
+            ' locked_until real,'
+            ' locked_by text,'
+            ' last_error text,'
+            ' created_at real not null)'
+        )
+        conn.execute('create index if not exists jobs_queue_run_at_idx'
+                     ' on jobs(queue, status, run_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, job):
+        now = time.time()
+        self._connect().execute(
+            'insert into jobs (id, queue, task, payload, max_attempts, run_at, created_at)'
+            ' values (?, ?, ?, ?, ?, ?, ?) on conflict(id) do nothing',
+            (job['id'], job['queue'], job['task'], json.dumps(job['payload']),
+             job['max_attempts'], now + job['delay'], now)
+        )
+
+    def claim(self, queue, worker_id, limit, queue_limit, visibility):
+        conn = self._connect()
+        now = time.time()
+        conn.execute('begin immediate')
+        try:
+            if queue_limit is not None:
+                running = conn.execute(
+                    "select count(*) from jobs where queue = ? and status = 'running'"
+                    ' and locked_until > ?', (queue, now)
+                ).fetchone()[0]
+                limit = min(limit, queue_limit - running)
+            rows = []
+            if limit > 0:
+                rows = conn.execute(
+                    'select id, task, payload, attempts, max_attempts from jobs'
+                    " where queue = ? and ((status = 'queued' and run_at <= ?)"
+                    "  or (status = 'running' and locked_until <= ?))"
+                    ' order by run_at limit ?', (queue, now, now, limit)
+                ).fetchall()
+                conn.executemany(
+                    "update jobs set status = 'running', attempts = attempts + 1,"
+                    ' locked_until = ?, locked_by = ? where id = ?',
+                    [(now + visibility, worker_id, row['id']) for row in rows]
+                )
+            conn.execute('commit')
+        except Exception:
+            conn.execute('rollback')
+            raise
+        return [{
+            'id': row['id'],
+            'queue': queue,
+            'task': row['task'],
+            'payload': json.loads(row['payload']),
+            'attempts': row['attempts'] + 1,
+            'max_attempts': row['max_attempts']
+        } for row in rows]
+
+    def complete(self, job_id, worker_id):
+        cursor = self._connect().execute(
+            'delete from jobs where id = ? and locked_by = ?', (job_id, worker_id)
+        )
+        return cursor.rowcount > 0
+
+    def fail(self, job_id, worker_id, error, retry_delay=None):
+        if retry_delay is None:
+            cursor = self._connect().execute(
+                "update jobs set status = 'failed', locked_until = null, locked_by = null,"
+                ' last_error = ? where id = ? and locked_by = ?', (error, job_id, worker_id)
+            )
+        else:
+            cursor = self._connect().execute(
+                "update jobs set status = 'queued', run_at = ?, locked_until = null,"
+                ' locked_by = null, last_error = ? where id = ? and locked_by = ?',
+                (time.time() + retry_delay, error, job_id, worker_id)
+            )
+        return cursor.rowcount > 0
+
+    def get(self, job_id):
+        row = self._connect().execute(
+            'select id, queue, task, status, attempts, last_error from jobs where id = ?',
+            (job_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+class PostgresJobStore:
+    """
+    Job store on the public.jobs table, through the service-role client.
+
+    Claiming, completing and failing go through the claim_jobs(),
+    complete_job() and fail_job() functions so each is one round trip and
+    one transaction.
+
+    Args:
+        get_client (callable): Returns the service-role Supabase client
+    """
+
+    def __init__(self, get_client):
+        self.get_client = get_client
+
+    def enqueue(self, job):
+        self.get_client().table('jobs').upsert({
+            'id': job['id'],
+            'queue': job['queue'],
+            'task': job['task'],
+            'payload': job['payload'],
+            'max_attempts': job['max_attempts'],
+            'run_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + job['delay']))
+        }, ignore_duplicates=True).execute()
+
+    def claim(self, queue, worker_id, limit, queue_limit, visibility):
+        result = self.get_client().rpc('claim_jobs', {
+            'queue_name': queue,
+            'worker_id': worker_id,
+            'max_jobs': limit,
+            'visibility_seconds': visibility,
+            'queue_limit': queue_limit
+        }).execute()
+        return [{
+            'id': row['id'],
+            'queue': row['queue'],
+            'task': row['task'],
+            'payload': row['payload'],
+            'attempts': row['attempts'],
+            'max_attempts': row['max_attempts']
+        } for row in result.data or []]
+
+    def complete(self, job_id, worker_id):
+        result = self.get_client().rpc('complete_job', {
+            'job_id': job_id,
+            'worker_id': worker_id
+        }).execute()
+        return bool(result.data)
+
+    def fail(self, job_id, worker_id, error, retry_delay=None):
+        result = self.get_client().rpc('fail_job', {
+            'job_id': job_id,
+            'worker_id': worker_id,
+            'error': error,
+            'retry_delay_seconds': int(retry_delay) if retry_delay is not None else None
+        }).execute()
+        return bool(result.data)
+
+    def get(self, job_id):
+        result = self.get_client().table('jobs').select(
+            'id, queue, task, status, attempts, last_error'
+        ).eq('id', job_id).limit(1).execute()
+        return result.data[0] if result.data else None
+
+def create_job_store(app, backend=JOB_BACKEND, get_client=None):
+    """
+    Create the job store selected by JOB_BACKEND.
+
+    Args:
+        app (Flask): Application (used for the instance folder path)
+        backend (str): 'sqlite' or 'postgres'
+        get_client (callable, optional): Service-role client getter
+            (required for postgres)
+
+    Returns:
+        Job store instance
+
+    Raises:
+        ValueError: If the backend name is unknown or misconfigured
+    """
+    if backend == 'sqlite':
+        path = os.getenv('JOB_SQLITE_PATH', os.path.join(app.instance_path, 'jobs.sqlite3'))
+        return SQLiteJobStore(path)
+    if backend == 'postgres':
+        if get_client is None:
+            raise ValueError("JOB_BACKEND=postgres requires a service-role client")
+        return PostgresJobStore(get_client)
+    raise ValueError(f"Unknown JOB_BACKEND: {backend}")
+
+# ============================================================================
+# QUEUE AND WORKER
+# ============================================================================
+
+class Task:
+    """
+    A registered job function and its retry settings.
+
+    Args:
+        name (str): Name jobs refer to
+        func (callable): Called with the job payload as keyword arguments
+        queue (str): Queue the jobs are placed on
+        max_attempts (int): Attempts before the job is marked failed
+        visibility_timeout (int): Seconds a claimed job is hidden from other workers
+        on_failure (callable, optional): on_failure(error, **payload) once
+            the job is given up (cleanup of staged files etc.)
+    """
+
+    def __init__(self, name, func, queue, max_attempts, visibility_timeout, on_failure=None):
+        self.name = name
+        self.func = func
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+        self.on_failure = on_failure
+
+class JobQueue:
+    """
+    Task registry, enqueue API and worker loop.
+
+    Args:
+        store: SQLiteJobStore or PostgresJobStore
+        app (Flask, optional): Application whose context wraps each job
+    """
+
+    def __init__(self, store, app=None):
+        self.store = store
+        self.app = app
+        self.tasks = {}
+
+    def task(self, name, queue='default', max_attempts=JOB_MAX_ATTEMPTS,
+             visibility_timeout=JOB_VISIBILITY_TIMEOUT, on_failure=None):
+        """
+        Register a function as a task (decorator).
+
+        Args:
+            name (str): Name used by enqueue()
+            queue (str): Queue for the task's jobs
+            max_attempts (int): Attempts before giving up
+            visibility_timeout (int): Seconds one attempt may run before
+                another worker may claim the job again
+            on_failure (callable, optional): Called when the job is given up
+        """
+        def register(func):
+            self.tasks[name] = Task(name, func, queue, max_attempts, visibility_timeout, on_failure)
+            return func
+        return register
+
+    def enqueue(self, name, payload=None, delay=0, job_id=None):
+        """
+        Add a job.
+
+        Args:
+            name (str): Registered task name
+            payload (dict, optional): JSON-serializable keyword arguments
+            delay (float): Seconds before the job may run
+            job_id (str, optional): Id for idempotent enqueues; a job with
+                this id that already exists is left unchanged
+
+        Returns:
+            str: Job id
+
+        Raises:
+            ValueError: If the task is not registered
+        """
+        task = self.tasks.get(name)
+        if task is None:
+            raise ValueError(f"Unknown task: {name}")
+
+        job_id = job_id or str(uuid.uuid4())
+        self.store.enqueue({
+            'id': job_id,
+            'queue': task.queue,
+            'task': name,
+            'payload': payload or {},
+            'max_attempts': task.max_attempts,
+            'delay': delay
+        })
+        return job_id
+
+    def get(self, job_id):
+        """
+        Get a pending, running or failed job.
+
+        Returns:
+            dict|None: id, queue, task, status, attempts, last_error; None
+                once the job has completed
+        """
+        return self.store.get(job_id)
+
+    def run_worker(self, queues=None, threads=JOB_WORKER_THREADS, queue_limits=None,
+                   stop_event=None, burst=False):
+        """
+        Claim and run jobs until stopped.
+
+        Args:
+            queues (list, optional): Queues to serve (default: every queue
+                with a registered task)
+            threads (int): Jobs run concurrently by this worker
+            queue_limits (dict, optional): Queue -> maximum running jobs
+                across all workers (default: JOB_QUEUE_CONCURRENCY)
+            stop_event (threading.Event, optional): Set to stop after the
+                running jobs finish (SIGTERM/SIGINT also stop the worker)
+            burst (bool): Return once no job is ready and none is running
+
+        Returns:
+            int: Jobs processed
+        """
+        queues = queues or sorted({task.queue for task in self.tasks.values()})
+        if queue_limits is None:
+            queue_limits = parse_queue_limits(JOB_QUEUE_CONCURRENCY)
+        stop_event = stop_event or threading.Event()
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        visibility = {
+            queue: max([task.visibility_timeout for task in self.tasks.values() if task.queue == queue]
+                       or [JOB_VISIBILITY_TIMEOUT])
+            for queue in queues
+        }
+
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *args: stop_event.set())
+
+        running = {queue: 0 for queue in queues}
+        running_lock = threading.Lock()
+        processed = 0
+
+        def finished(queue):
+            with running_lock:
+                running[queue] -= 1
+
+        print(f"👷 Worker {worker_id} serving {', '.join(queues)} with {threads} threads")
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='job') as executor:
+            while not stop_event.is_set():
+                claimed = 0
+                for queue in queues:
+                    with running_lock:
+                        free = threads - sum(running.values())
+                        room = free if queue not in queue_limits else min(free, queue_limits[queue] - running[queue])
+                    if room <= 0:
+                        continue
+
+                    try:
+                        jobs = self.store.claim(queue, worker_id, room, queue_limits.get(queue), visibility[queue])
+                    except Exception as e:
+                        print(f"Error claiming jobs from {queue}: {e}")
+                        jobs = []
+
+                    for job in jobs:
+                        with running_lock:
+                            running[queue] += 1
+                        future = executor.submit(self.run_job, job, worker_id)
+                        future.add_done_callback(lambda future, queue=queue: finished(queue))
+                    claimed += len(jobs)
+                processed += claimed
+
+                if not claimed:
+                    with running_lock:
+                        idle = not any(running.values())
+                    if burst and idle:
+                        break
+                    stop_event.wait(JOB_POLL_INTERVAL)
+
+        print(f"👷 Worker {worker_id} stopped after {processed} jobs")
+        return processed
+
+    def run_job(self, job, worker_id):
+        """
+        Run one claimed job and record its outcome.
+
+        The outcome is dropped if the job is no longer locked by this worker
+        (its visibility timeout expired and another worker claimed it).
+
+        Args:
+            job (dict): Claimed job (id, task, payload, attempts, max_attempts)
+            worker_id (str): Worker that claimed the job (claim()'s worker_id)
+        """
+        task = self.tasks.get(job['task'])
+        started = time.time()
+        try:
+            if task is None:
+                raise JobFailed(f"Unknown task: {job['task']}")
+            if job['attempts'] > job['max_attempts']:
+                # Earlier attempts exceeded the visibility timeout (e.g. the worker died)
+                raise JobFailed(f"Gave up after {job['max_attempts']} attempts timed out")
+            self._call(task.func, **job['payload'])
+        except Exception as e:
+            permanent = isinstance(e, JobFailed) or job['attempts'] >= job['max_attempts']
+            if isinstance(e, JobFailed):
+                error = str(e)
+            else:
+                error = UNEXPECTED_JOB_ERROR
+                print(f"Job {job['task']} {job['id']} raised:\n{traceback.format_exc()}")
+            try:
+                owned = self.store.fail(job['id'], worker_id, error,
+                                        None if permanent else get_retry_delay(job['attempts']))
+            except Exception as store_error:
+                print(f"Error recording failure of job {job['id']}: {store_error}")
+                owned = True
+
+            if not owned:
+                print(f"⚠️ Job {job['task']} {job['id']} was claimed by another worker; failure not recorded: {e}")
+                return
+            if not permanent:
+                print(f"🔁 Job {job['task']} {job['id']} failed (attempt {job['attempts']}), retrying: {e}")
+                return
+            print(f"❌ Job {job['task']} {job['id']} failed after {job['attempts']} attempts: {e}")
+            if task is not None and task.on_failure is not None:
+                try:
+                    self._call(task.on_failure, str(e), **job['payload'])
+                except Exception as cleanup_error:
+                    print(f"Error in failure handler of job {job['id']}: {cleanup_error}")
+            return
+
+        try:
+            if not self.store.complete(job['id'], worker_id):
+                print(f"⚠️ Job {job['task']} {job['id']} was claimed by another worker; completion not recorded")
+        except Exception as e:
+            print(f"Error completing job {job['id']}: {e}")
+        print(f"✅ Job {job['task']} {job['id']} done in {time.time() - started:.1f}s")
+
+    def _call(self, func, *args, **kwargs):
+        if self.app is None:
+            return func(*args, **kwargs)
+        with self.app.app_context():
+            return func(*args, **kwargs)
+
+def create_job_queue(app, backend=JOB_BACKEND, get_client=None):
+    """
+    Create the application's job queue.
+
+    Args:
+        app (Flask): Application
+        backend (str): 'sqlite' or 'postgres'
+        get_client (callable, optional): Service-role client getter
+
+    Returns:
+        JobQueue: Queue with no tasks registered yet
+    """
+    return JobQueue(create_job_store(app, backend, get_client), app)
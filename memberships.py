@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Organization Membership Cache for the Sleep Study Management System
+
+Staff study lists are scoped to the organizations a staff member belongs
+to. Memberships change rarely (sign-up, admin edits) but are needed on
+every dashboard render and every infinite-scroll page, so each request used
+to start with an organization_memberships round trip.
+
+This module keeps each user's organization ids in memory instead:
+- Keyed by user id, bounded LRU (MEMBERSHIP_CACHE_SIZE entries)
+- Entries expire after MEMBERSHIP_TTL_SECONDS, so membership changes made
+  elsewhere are picked up without a restart
+- Users with no memberships are cached too (as an empty tuple)
+- Failed lookups are not cached
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from query_shapes import shaped_query
+
+MEMBERSHIP_TTL_SECONDS = int(os.getenv('MEMBERSHIP_CACHE_TTL', 300))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 4096))
+
+class MembershipCache:
+    """
+    Per-user TTL/LRU cache of organization memberships.
+
+    Args:
+        get_client (callable): Returns the Supabase client used to read
+            organization_memberships
+        ttl (int): Seconds a user's memberships are served from memory
+        maxsize (int): Maximum number of users held before LRU eviction
+    """
+
+    def __init__(self, get_client, ttl=MEMBERSHIP_TTL_SECONDS, maxsize=MEMBERSHIP_CACHE_SIZE):
+        self.get_client = get_client
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # user_id -> (expires_at, organization_ids)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Get the organizations a user belongs to.
+
+        Args:
+            user_id (str): UUID of the user
+
+        Returns:
+            tuple: organization_id values (empty if none or the lookup failed)
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        try:
+            result = shaped_query(self.get_client(), 'user_memberships').eq(
+                'user_id', user_id
+            ).execute()
+        except Exception as e:
+            print(f"Error fetching organization memberships: {e}")
+            return ()
+
+        organization_ids = tuple(sorted({row['organization_id'] for row in result.data}))
+
+        with self._lock:
+            self._entries[user_id] = (time.time() + self.ttl, organization_ids)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return organization_ids
+
+    def invalidate(self, user_id=None):
+        """
+        Drop cached memberships for one user, or for everyone.
+
+        Args:
+            user_id (str, optional): UUID of the user whose memberships changed
+        """
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Query Shape Registry for the Sleep Study Management System
+
+Most reads used to request `select('*')` (and `devices(*)`,
+`patient_profiles(*)` embeds), returning jsonb blobs such as
+patient_details and device_details that the views never display. Every
+extra column is serialized by PostgREST, sent over the wire, decoded into
+Python dicts and held in worker memory for the length of the request.
+
+This module defines, in one place, the exact columns and embeds each view
+reads. Call sites build their query with shaped_query(client, view) and
+then add filters, ordering and limits as before. When a template starts
+showing a new field, add it to the view's shape here.
+
+Values needed from jsonb blobs are extracted server-side with PostgREST
+JSON paths (e.g. `device_name:device_details->>name`) so the rest of the
+blob never leaves the database.
+"""
+
+# View name -> (table, select expression)
+QUERY_SHAPES = {
+    # Authentication: only the role is stored in the session
+    'user_profile': ('app_users', 'id, role'),
+
+    # Booking step 3: pre-fill personal details
+    'patient_profile': ('patient_profiles', 'user_id, patient_details'),
+
+    # Studies list (fragments/studies_rows.html) and role dashboards;
+    # created_at and id are also the keyset pagination cursor
+    'study_list': ('sleep_studies', 'id, patient_id, current_state, start_date, created_at'),
+
+    # Patient study cards (fragments/patient/my-studies-cards.html)
+    'patient_study_cards': (
+        'sleep_studies',
+        'id, current_state, start_date, '
+        'devices(device_name:device_details->>name), '
+        'survey_responses(type, score)'
+    ),
+
+    # Patient device-return confirmation (ownership check + updated card)
+    'patient_confirm_return': (
+        'sleep_studies',
+        'id, patient_id, doctor_id, organization_id, start_date, device_id, '
+        'devices(device_name:device_details->>name)'
+    ),
+
+    # Staff/doctor assignment roster (staff_assignment.py)
+    'assignment_memberships': ('organization_memberships', 'user_id, organization_id, app_users(role)'),
+
+    # Per-user membership cache (memberships.py)
+    'user_memberships': ('organization_memberships', 'organization_id'),
+
+    # Staff dashboard pending actions (patient name via app_users -> patient_profiles)
+    'staff_pending_actions': (
+        'sleep_studies',
+        'id, start_date, '
+        'patient:app_users!sleep_studies_patient_id_fkey(patient_profiles(full_name:patient_details->>full_name))'
+    ),
+
+    # Staff sleep-data upload modal and ingestion (event topics + patient name)
+    'sleep_data_upload_study': (
+        'sleep_studies',
+        'id, patient_id, doctor_id, organization_id, current_state, start_date, '
+        'patient:app_users!sleep_studies_patient_id_fkey(patient_profiles(full_name:patient_details->>full_name))'
+    ),
+
+    # Background ingestion result, polled by the uploading staff member
+    'sleep_data_ingest_result': (
+        'sleep_data_files',
+        'id, sleep_data_summaries(epoch_seconds, epoch_count, signals, duration_seconds), '
+        'sleep_study_analyses(ahi, odi, apnea_count, hypopnea_count, min_spo2)'
+    ),
+
+    # Doctor study review: recordings with their summary and latest analysis
+    'doctor_study_review': (
+        'sleep_studies',
+        'id, doctor_id, current_state, start_date, '
+        'patient:app_users!sleep_studies_patient_id_fkey(patient_profiles(full_name:patient_details->>full_name)), '
+        'sleep_data_files(id, created_at, '
+        'sleep_data_summaries(duration_seconds, recording_start, signals), '
+        'sleep_study_analyses(ahi, odi, apnea_count, hypopnea_count, desaturation_count, min_spo2, events))'
+    ),
+
+    # Study report inputs (study_reports.collect_report_inputs) and rendered reports
+    'study_report_inputs': (
+        'sleep_studies',
+        'id, patient_id, current_state, start_date, '
+        'patient:app_users!sleep_studies_patient_id_fkey(patient_profiles('
+        'full_name:patient_details->>full_name, date_of_birth:patient_details->>date_of_birth)), '
+        'survey_responses(type, score, created_at), '
+        'sleep_data_files(id, created_at, '
+        'sleep_data_summaries(duration_seconds, recording_start, signals), '
+        'sleep_study_analyses(ahi, odi, apnea_count, hypopnea_count, desaturation_count, '
+        'min_spo2, mean_spo2, t90_minutes, analyzed_hours, algorithm_version))'
+    ),
+    'study_report_file': ('doctor_reports', 'id, file_url, report_path, content_hash, created_at'),
+
+    # Shared study details modal (fragments/shared/study-details-modal.html);
+    # document links are signed at render time (signed_urls.py)
+    'study_details': (
+        'sleep_studies',
+        'id, current_state, start_date, end_date, '
+        'devices(device_name:device_details->>name), '
+        'patient:app_users!sleep_studies_patient_id_fkey(patient_profiles(full_name:patient_details->>full_name)), '
+        'survey_responses(type, score, created_at), '
+        'referrals(id, file_url, created_at), '
+        'sleep_data_files(id, created_at), '
+        'doctor_reports(id, file_url, report_path, created_at)'
+    ),
+
+    # Signal tile access checks and Storage paths (signal_tiles.py)
+    'recording_access': ('sleep_data_files', 'id, sleep_study_id'),
+
+    # Recording downloads (download_cache.py): access check + object path
+    'recording_download': ('sleep_data_files', 'id, file_url'),
+
+    # Polled fragment fingerprints (conditional_fragments.py): newest timestamp + count
+    'study_fingerprint': ('sleep_studies', 'updated_at'),
+    'organization_summary_fingerprint': ('organization_summaries', 'refreshed_at'),
+
+    # Staff dashboard summary (maintained by triggers, see organization_summaries)
+    'organization_summary': (
+        'organization_summaries',
+        'organization_id, devices_available, devices_assigned, active_studies, '
+        'week_bookings, max_concurrent_studies, week_start'
+    ),
+
+    # Appointment slot engine (slot_engine.py)
+    'slot_organizations': ('organizations', 'id, opening_hours, max_concurrent_studies'),
+}
+
+def shaped_query(client, view, count=None):
+    """
+    Start a select query with the registered shape for a view.
+
+    Args:
+        client: Supabase client
+        view (str): Key of QUERY_SHAPES
+        count (str, optional): PostgREST count method ('exact', 'planned', 'estimated')
+
+    Returns:
+        Select query builder to which filters, ordering and limits can be added
+
+    Raises:
+        KeyError: If the view has no registered shape
+    """
+    table, columns = QUERY_SHAPES[view]
+    # Shapes are written with spaces for readability; send them compact
+    return client.table(table).select(''.join(columns.split()), count=count)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Request Authentication for the Sleep Study Management System
+
+Routes decided authorization with a plain `'user' in session` check: the
+access token in the session was never validated, an expired token was only
+noticed when PostgREST rejected a query, and refreshing it was left to
+whichever request happened to build a client first - several concurrent
+HTMX polls of one tab could all refresh at once, each spending the same
+single-use refresh token.
+
+This module is the request-auth layer instead:
+- Access tokens are verified locally with PyJWT: signature, `exp` and the
+  `authenticated` audience. HS256 tokens are checked against
+  SUPABASE_JWT_SECRET, asymmetric ones (RS256/ES256 signing keys) against
+  the project's JWKS, fetched once and cached for AUTH_JWKS_TTL seconds
+- Without SUPABASE_JWT_SECRET, HS256 tokens are checked remotely with GET
+  /auth/v1/user (what supabase-py's get_user() calls) instead of being
+  rejected, so legacy tokens of a project moving to signing keys keep
+  working. `flask auth-check` fails if the secret is missing and the
+  project publishes no signing keys (it signs every token with HS256);
+  the first such token in a worker logs the same error
+- Decoded claims are memoized per token (keyed by its SHA-256, never the
+  raw token) until the token expires, so a steady-state request costs one
+  dict lookup and no auth round trip
+- Tokens are refreshed proactively once they are within
+  AUTH_REFRESH_MARGIN seconds of expiry, single-flight per refresh token:
+  concurrent requests of one session wait for the first refresh and then
+  adopt its result instead of refreshing again
+- A token that fails verification (forged, expired and not refreshable,
+  or issued to another user) ends the session's sign-in; an Auth outage
+  during a remote check does not
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+
+from supabase_clients import get_shared_transport, hash_token
+
+# Legacy (HS256) JWT secret of the project; without it only JWKS keys verify
+SUPABASE_JWT_SECRET = os.getenv('SUPABASE_JWT_SECRET')
+
+# Refresh access tokens this long before they expire
+AUTH_REFRESH_MARGIN = int(os.getenv('AUTH_REFRESH_MARGIN', 120))
+
+# Seconds the project's signing keys are cached
+AUTH_JWKS_TTL = int(os.getenv('AUTH_JWKS_TTL', 3600))
+
+# Decoded tokens memoized per worker
+AUTH_CLAIMS_CACHE_SIZE = int(os.getenv('AUTH_CLAIMS_CACHE_SIZE', 4096))
+
+# Supabase issues user tokens for this audience
+AUTH_AUDIENCE = 'authenticated'
+
+# Asymmetric algorithms of Supabase signing keys
+JWKS_ALGORITHMS = ['RS256', 'ES256']
+
+# Minimum seconds between JWKS fetches for an unknown key id
+JWKS_MIN_REFRESH_INTERVAL = 60
+
+# Refreshed tokens kept for late requests that still carry the old ones
+REFRESH_RESULT_TTL = 60
+
+_http = httpx.Client(transport=get_shared_transport(), timeout=httpx.Timeout(10.0))
+
+class InvalidToken(Exception):
+    """Raised when an access token cannot be verified."""
+
+class AuthUnavailable(Exception):
+    """Raised when a token needs a remote check and Auth cannot be reached."""
+
+def _get_jwt():
+    try:
+        import jwt
+    except ImportError:
+        raise ValueError("Local token verification requires the 'PyJWT' package")
+    return jwt
+
+class TokenVerifier:
+    """
+    Verifies access tokens locally and memoizes their claims.
+
+    Args:
+        supabase_url (str): Supabase project URL (for the JWKS endpoint)
+        anon_key (str): Anon key sent with the JWKS request
+        jwt_secret (str, optional): Legacy HS256 secret
+        maxsize (int): Maximum number of memoized tokens
+        jwks_ttl (int): Seconds the signing keys are cached
+    """
+
+    def __init__(self, supabase_url, anon_key, jwt_secret=SUPABASE_JWT_SECRET,
+                 maxsize=AUTH_CLAIMS_CACHE_SIZE, jwks_ttl=AUTH_JWKS_TTL):
+        self.jwks_url = f"{supabase_url}/auth/v1/.well-known/jwks.json"
+        self.user_url = f"{supabase_url}/auth/v1/user"
+        self.anon_key = anon_key
+        self.jwt_secret = jwt_secret
+        self.maxsize = maxsize
+        self.jwks_ttl = jwks_ttl
+        self._claims = OrderedDict()  # token hash -> (exp, claims)
+        self._keys = {}  # kid -> PyJWK
+        self._keys_fetched_at = 0
+        self._configuration_checked = False
+        self._lock = threading.Lock()
+        self._keys_lock = threading.Lock()
+
+    def check_configuration(self):
+        """
+        Fail fast if the project signs tokens with HS256 but no secret is set.
+
+        Projects on the legacy JWT secret publish an empty JWKS; without
+        SUPABASE_JWT_SECRET every session would need a remote check. If the
+        keys cannot be fetched (Auth unreachable), the check is skipped and
+        HS256 tokens are checked remotely. Run by `flask auth-check`, and
+        once per worker on the first HS256 token, which only logs the error.
+
+        Returns:
+            bool: False if the check was skipped because the keys could not be fetched
+
+        Raises:
+            ValueError: If SUPABASE_JWT_SECRET is missing and the JWKS has no keys
+        """
+        if self.jwt_secret:
+            return True
+        keys = self._fetch_keys()
+        if keys is None:
+            return False
+        with self._keys_lock:
+            self._keys = keys
+            self._keys_fetched_at = time.time()
+        if not keys:
+            raise ValueError("Missing SUPABASE_JWT_SECRET: the project signs access tokens with HS256")
+        return True
+
+    def verify(self, access_token):
+        """
+        Get the verified claims of an access token.
+
+        Args:
+            access_token (str): User JWT
+
+        Returns:
+            dict: Token claims (sub, exp, role, ...)
+
+        Raises:
+            InvalidToken: If the signature, expiry or audience is invalid
+            AuthUnavailable: If a remote check was needed and failed
+        """
+        key = hash_token(access_token)
+        now = time.time()
+        with self._lock:
+            entry = self._claims.get(key)
+            if entry and entry[0] > now:
+                self._claims.move_to_end(key)
+                return entry[1]
+
+        claims = self._decode(access_token)
+
+        with self._lock:
+            self._claims[key] = (claims['exp'], claims)
+            self._claims.move_to_end(key)
+            while len(self._claims) > self.maxsize:
+                self._claims.popitem(last=False)
+        return claims
+
+    def _decode(self, access_token):
+        jwt = _get_jwt()
+        try:
+            header = jwt.get_unverified_header(access_token)
+            if header.get('alg') == 'HS256':
+                if not self.jwt_secret:
+                    return self._verify_remotely(access_token)
+                key, algorithms = self.jwt_secret, ['HS256']
+            else:
+                key, algorithms = self._get_signing_key(header.get('kid')), JWKS_ALGORITHMS
+            return jwt.decode(access_token, key, algorithms=algorithms, audience=AUTH_AUDIENCE,
+                              options={'require': ['exp', 'sub']})
+        except jwt.PyJWTError as e:
+            raise InvalidToken(str(e))
+
+    def _verify_remotely(self, access_token):
+        """Claims of an HS256 token that Auth accepts (no local secret)."""
+        if not self._configuration_checked:
+            self._configuration_checked = True
+            try:
+                self.check_configuration()
+            except ValueError as e:
+                print(f"❌ {e}; verifying every token remotely")
+        jwt = _get_jwt()
+        claims = jwt.decode(access_token, options={'verify_signature': False, 'require': ['exp', 'sub']})
+        try:
+            response = _http.get(self.user_url, headers={
+                'apikey': self.anon_key,
+                'Authorization': f"Bearer {access_token}"
+            })
+        except httpx.HTTPError as e:
+            raise AuthUnavailable(f"Error checking token with Auth: {e}")
+        if response.status_code in (401, 403):
+            raise InvalidToken("Token rejected by Auth")
+        if response.status_code != 200:
+            raise AuthUnavailable(f"Auth answered {response.status_code} to a token check")
+        try:
+            user = response.json()
+        except ValueError:
+            user = None
+        if not isinstance(user, dict):
+            raise AuthUnavailable("Auth answered a token check without a user object")
+        if user.get('id') != claims['sub']:
+            raise InvalidToken("Token subject does not match its Auth user")
+        return claims
+
+    def _get_signing_key(self, kid):
+        """Public key for a key id, fetching the JWKS when stale or unknown."""
+        now = time.time()
+        with self._keys_lock:
+            stale = now - self._keys_fetched_at > self.jwks_ttl
+            unknown = kid not in self._keys and now - self._keys_fetched_at > JWKS_MIN_REFRESH_INTERVAL
+            if stale or unknown:
+                keys = self._fetch_keys()
+                if keys is not None:
+                    self._keys = keys
+                self._keys_fetched_at = now
+            signing_key = self._keys.get(kid)
+        if signing_key is None:
+            raise InvalidToken(f"Unknown signing key: {kid}")
+        return signing_key.key
+
+    def _fetch_keys(self):
+        """Signing keys by key id, or None if the JWKS could not be fetched."""
+        jwt = _get_jwt()
+        try:
+            response = _http.get(self.jwks_url, headers={'apikey': self.anon_key})
+            response.raise_for_status()
+            key_set = response.json().get('keys') or []
+            if not key_set:
+                return {}
+            keys = jwt.PyJWKSet(key_set).keys
+        except (httpx.HTTPError, ValueError, jwt.PyJWTError) as e:
+            print(f"Error fetching signing keys: {e}")
+            return None
+        return {signing_key.key_id: signing_key for signing_key in keys}
+
+class TokenRefresher:
+    """
+    Single-flight refresh of session tokens.
+
+    The first request that needs a refresh performs it; concurrent requests
+    with the same refresh token wait for it, and requests arriving within
+    REFRESH_RESULT_TTL seconds (still holding the old tokens) reuse its
+    result instead of spending the refresh token again.
+
+    Args:
+        refresh (callable): refresh(refresh_token) -> (access_token, refresh_token) or None
+        timeout (float): Seconds a waiting request waits for the refresh
+    """
+
+    def __init__(self, refresh, timeout=10.0):
+        self._refresh = refresh
+        self.timeout = timeout
+        self._in_flight = {}  # refresh token hash -> threading.Event
+        self._results = {}  # refresh token hash -> (stored_at, tokens)
+        self._lock = threading.Lock()
+
+    def refresh(self, refresh_token):
+        """
+        Exchange a refresh token, or join the refresh already running for it.
+
+        Args:
+            refresh_token (str): Session refresh token
+
+        Returns:
+            tuple|None: (access_token, refresh_token), or None if it failed
+        """
+        key = hash_token(refresh_token)
+        with self._lock:
+            result = self._get_result(key)
+            if result:
+                return result
+            event = self._in_flight.get(key)
+            leader = event is None
+            if leader:
+                event = self._in_flight[key] = threading.Event()
+
+        if not leader:
+            event.wait(self.timeout)
+            with self._lock:
+                return self._get_result(key)
+
+        tokens = None
+        try:
+            tokens = self._refresh(refresh_token)
+        finally:
+            with self._lock:
+                if tokens:
+                    self._results[key] = (time.time(), tokens)
+                self._in_flight.pop(key, None)
+            event.set()
+        return tokens
+
+    def _get_result(self, key):
+        now = time.time()
+        for stale in [k for k, (stored_at, _) in self._results.items() if now - stored_at > REFRESH_RESULT_TTL]:
+            del self._results[stale]
+        entry = self._results.get(key)
+        return entry[1] if entry else None
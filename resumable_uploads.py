@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Streaming, Resumable Uploads to Supabase Storage
+
+Referral uploads used to call file.read() and hand the whole document to
+storage.upload(), so every in-flight upload held the complete file in
+worker memory and a dropped connection meant starting over.
+
+This module streams uploads through Storage's resumable upload endpoint
+(the TUS protocol, backed by Storage's multipart uploads -
+storage.s3_multipart_uploads / s3_multipart_uploads_parts):
+- Uploads are created with their final length, then sent in fixed
+  UPLOAD_CHUNK_SIZE parts, so memory per upload is one chunk regardless
+  of file size
+- Every chunk carries a SHA-256 checksum that is verified before the chunk
+  is forwarded to Storage
+- The server-side offset is authoritative: after a dropped connection the
+  client asks for the offset and continues from there
+- Uploads larger than the per-bucket cap are rejected before any bytes
+  are sent
+
+Objects can also be downloaded straight to a file (download_object) or
+streamed, optionally as a byte range (open_object), so large files are
+never buffered whole either.
+
+Requests run over the shared, fork-safe HTTP transport from
+supabase_clients, with the caller's bearer token so Storage RLS policies
+still apply.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+
+import httpx
+
+from supabase_clients import get_shared_transport
+
+# Storage requires every part except the last to be exactly 6 MiB
+UPLOAD_CHUNK_SIZE = 6 * 1024 * 1024
+
+# Hard cap for a single referral document
+REFERRAL_MAX_BYTES = int(os.getenv('REFERRAL_MAX_BYTES', 10 * 1024 * 1024))
+
+UPLOAD_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+TUS_VERSION = '1.0.0'
+
+_http = httpx.Client(transport=get_shared_transport(), timeout=UPLOAD_TIMEOUT)
+
+class UploadError(Exception):
+    """Storage rejected an upload request."""
+
+class OffsetMismatch(UploadError):
+    """
+    A chunk was sent for the wrong offset (e.g. a retried chunk that had
+    already been stored). The client should resume from `offset`.
+    """
+
+    def __init__(self, offset):
+        super().__init__(f"Upload offset mismatch, resume from byte {offset}")
+        self.offset = offset
+
+class ChecksumMismatch(UploadError):
+    """A chunk's bytes do not match the checksum the client sent."""
+
+def chunk_checksum(data):
+    """
+    Compute a chunk checksum in TUS Upload-Checksum format.
+
+    Args:
+        data (bytes): Chunk bytes
+
+    Returns:
+        str: 'sha256 <base64 digest>'
+    """
+    return 'sha256 ' + base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+def verify_chunk(data, checksum):
+    """
+    Check a chunk against the client's Upload-Checksum header.
+
+    Args:
+        data (bytes): Received chunk bytes
+        checksum (str): 'sha256 <base64 digest>'
+
+    Raises:
+        ChecksumMismatch: If the checksum is missing, malformed or wrong
+    """
+    if not checksum or not checksum.startswith('sha256 '):
+        raise ChecksumMismatch("Missing or unsupported chunk checksum")
+    if not hmac.compare_digest(chunk_checksum(data), checksum.strip()):
+        raise ChecksumMismatch("Chunk checksum mismatch")
+
+def _headers(client, extra=None):
+    headers = dict(client.headers)
+    headers['Tus-Resumable'] = TUS_VERSION
+    if extra:
+        headers.update(extra)
+    return headers
+
+def _metadata(values):
+    """Encode TUS Upload-Metadata (comma-separated 'key base64value')."""
+    return ','.join(
+        f"{key} {base64.b64encode(str(value).encode('utf-8')).decode('ascii')}"
+        for key, value in values.items()
+    )
+
+def _check_location(client, location):
+    # Upload URLs come from our own session state; never send a user's
+    # token anywhere but this project's Storage API
+    if not location.startswith(f"{client.storage_url}/upload/resumable/"):
+        raise UploadError("Invalid upload location")
+
+def create_upload(client, bucket, object_name, size, content_type, upsert=False):
+    """
+    Start a resumable upload of a known length.
+
+    Args:
+        client (AuthenticatedClient): Client whose token authorizes the upload
+        bucket (str): Storage bucket name
+        object_name (str): Destination path in the bucket
+        size (int): Total upload length in bytes
+        content_type (str): MIME type stored with the object
+        upsert (bool): Overwrite an existing object instead of failing
+
+    Returns:
+        str: Upload URL for subsequent offset and chunk requests
+
+    Raises:
+        UploadError: If Storage rejects the upload
+    """
+    response = _http.post(
+        f"{client.storage_url}/upload/resumable",
+        headers=_headers(client, {
+            'x-upsert': 'true' if upsert else 'false',
+            'Upload-Length': str(size),
+            'Upload-Metadata': _metadata({
+                'bucketName': bucket,
+                'objectName': object_name,
+                'contentType': content_type or 'application/octet-stream',
+                'cacheControl': '3600'
+            })
+        })
+    )
+    if response.status_code != 201 or 'location' not in response.headers:
+        raise UploadError(f"Could not start upload ({response.status_code}): {response.text}")
+
+    # Rebuild the URL from the upload ID: behind the API gateway Storage may
+    # answer with its internal host or scheme
+    upload_id = response.headers['location'].rstrip('/').rsplit('/', 1)[-1]
+    return f"{client.storage_url}/upload/resumable/{upload_id}"
+
+def get_upload_offset(client, location):
+    """
+    Get the number of bytes Storage has durably received for an upload.
+
+    Args:
+        client (AuthenticatedClient): Client that created the upload
+        location (str): Upload URL from create_upload()
+
+    Returns:
+        int: Current offset
+
+    Raises:
+        UploadError: If the upload no longer exists
+    """
+    _check_location(client, location)
+    response = _http.head(location, headers=_headers(client))
+    if response.status_code != 200 or 'upload-offset' not in response.headers:
+        raise UploadError(f"Upload not found ({response.status_code})")
+    return int(response.headers['upload-offset'])
+
+def upload_chunk(client, location, offset, data):
+    """
+    Append one chunk at the given offset.
+
+    Args:
+        client (AuthenticatedClient): Client that created the upload
+        location (str): Upload URL from create_upload()
+        offset (int): Byte offset the chunk starts at
+        data (bytes): Chunk bytes (UPLOAD_CHUNK_SIZE except for the last chunk)
+
+    Returns:
+        int: New offset after the chunk
+
+    Raises:
+        OffsetMismatch: If Storage is at a different offset
+        UploadError: If Storage rejects the chunk
+    """
+    _check_location(client, location)
+    response = _http.patch(
+        location,
+        content=data,
+        headers=_headers(client, {
+            'Upload-Offset': str(offset),
+            'Content-Type': 'application/offset+octet-stream'
+        })
+    )
+    if response.status_code == 409:
+        raise OffsetMismatch(get_upload_offset(client, location))
+    if response.status_code != 204:
+        raise UploadError(f"Chunk rejected ({response.status_code}): {response.text}")
+    return int(response.headers.get('upload-offset', offset + len(data)))
+
+def read_chunk(stream, size=UPLOAD_CHUNK_SIZE):
+    """
+    Read up to `size` bytes from a stream, looping over short reads.
+
+    Args:
+        stream: File-like object (request stream or spooled upload)
+        size (int): Maximum bytes to read
+
+    Returns:
+        bytes: Up to `size` bytes (empty at end of stream)
+    """
+    parts = []
+    remaining = size
+    while remaining > 0:
+        part = stream.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+def stream_upload(client, bucket, object_name, stream, size, content_type, upsert=False):
+    """
+    Upload a stream of known length in UPLOAD_CHUNK_SIZE chunks.
+
+    Holds at most one chunk in memory. Used for single-request uploads,
+    where werkzeug has already spooled the body to a temporary file.
+
+    Args:
+        client (AuthenticatedClient): Client whose token authorizes the upload
+        bucket (str): Storage bucket name
+        object_name (str): Destination path in the bucket
+        stream: Readable file-like object positioned at the start
+        size (int): Total length in bytes
+        content_type (str): MIME type stored with the object
+        upsert (bool): Overwrite an existing object (idempotent retries)
+
+    Returns:
+        int: Bytes uploaded
+
+    Raises:
+        UploadError: If Storage rejects the upload or the stream is short
+    """
+    location = create_upload(client, bucket, object_name, size, content_type, upsert)
+    offset = 0
+    while offset < size:
+        data = read_chunk(stream, min(UPLOAD_CHUNK_SIZE, size - offset))
+        if not data:
+            raise UploadError(f"Upload stream ended at byte {offset} of {size}")
+        offset = upload_chunk(client, location, offset, data)
+    return offset
+
+def download_object(client, bucket, object_name, destination):
+    """
+    Stream a Storage object to a local file.
+
+    Writes to a temporary file and renames it into place, so readers never
+    see a partial download.
+
+    Args:
+        client (AuthenticatedClient): Client whose token authorizes the read
+        bucket (str): Storage bucket name
+        object_name (str): Object path in the bucket
+        destination (str): Local file path
+
+    Raises:
+        UploadError: If Storage does not return the object
+    """
+    partial = f"{destination}.{os.getpid()}.download"
+    url = f"{client.storage_url}/object/{bucket}/{object_name}"
+    try:
+        with _http.stream('GET', url, headers=dict(client.headers)) as response:
+            if response.status_code != 200:
+                raise UploadError(f"Could not download {object_name} ({response.status_code})")
+            with open(partial, 'wb') as local_file:
+                for data in response.iter_bytes(UPLOAD_CHUNK_SIZE):
+                    local_file.write(data)
+        os.replace(partial, destination)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+def open_object(client, bucket, object_name, byte_range=None):
+    """
+    Open a streaming GET of a Storage object.
+
+    Args:
+        client (AuthenticatedClient): Client whose token authorizes the read
+        bucket (str): Storage bucket name
+        object_name (str): Object path in the bucket
+        byte_range (str, optional): HTTP Range header to forward (e.g. 'bytes=0-1023')
+
+    Returns:
+        httpx.Response: Unread response (200, 206, 416, ...); the caller
+            iterates it and must close() it
+    """
+    headers = dict(client.headers)
+    if byte_range:
+        headers['Range'] = byte_range
+    request = _http.build_request('GET', f"{client.storage_url}/object/{bucket}/{object_name}",
+                                  headers=headers)
+    return _http.send(request, stream=True)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Server-Side Session Store for the Sleep Study Management System
+
+Flask's default session keeps everything in a signed cookie. For this app
+that meant the access and refresh tokens, the user dict and the whole
+seven-step booking wizard state (appointment, personal details, referral
+metadata, Epworth/OSA-50 answers) were uploaded, verified and re-signed on
+every HTMX request - several KB per request, close to the ~4KB cookie limit.
+
+This module moves session data server-side behind a small opaque cookie:
+- ServerSideSessionInterface: Flask session interface storing only a random
+  session id in the cookie
+- MemorySessionStore: per-worker LRU (single-process development)
+- SQLiteSessionStore: WAL-mode SQLite file shared by all workers on a host
+- RedisSessionStore: any Redis-protocol server (optional `redis` package)
+
+Backends are selected with SESSION_BACKEND (memory | sqlite | redis) and all
+entries expire after SESSION_TTL_SECONDS. Unchanged sessions are not written
+back, so read-only polling requests cost one store read.
+"""
+
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', 12 * 3600))
+SESSION_MEMORY_MAXSIZE = int(os.getenv('SESSION_MEMORY_MAXSIZE', 10000))
+
+# Purge expired SQLite rows once every this many writes
+SQLITE_PURGE_INTERVAL = 500
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """
+    Session dict backed by a server-side store.
+
+    Args:
+        initial (dict, optional): Previously stored session data
+        sid (str): Opaque session id sent in the cookie
+        new (bool): True if no stored session was found for the request
+    """
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def rotate(self):
+        """
+        Issue a new session id, keeping the data.
+
+        Called on sign-in so a session id seen before authentication can
+        never be used afterwards (session fixation).
+        """
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = generate_session_id()
+        self.modified = True
+
+def generate_session_id():
+    """Generate an unguessable opaque session id."""
+    return secrets.token_urlsafe(32)
+
+# ============================================================================
+# STORE BACKENDS
+# ============================================================================
+
+class MemorySessionStore:
+    """
+    Per-worker LRU session store with TTL expiry.
+
+    Only suitable when a single process serves all requests (development
+    server, or one gunicorn worker with threads).
+
+    Args:
+        maxsize (int): Maximum number of sessions held before LRU eviction
+    """
+
+    def __init__(self, maxsize=SESSION_MEMORY_MAXSIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # sid -> (expires_at, payload)
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return payload
+
+    def set(self, sid, payload, ttl):
+        with self._lock:
+            self._entries[sid] = (time.time() + ttl, payload)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+class SQLiteSessionStore:
+    """
+    SQLite session store in WAL mode, shared by all workers on one host.
+
+    WAL lets readers proceed while a writer commits, so concurrent workers
+    do not serialize on session reads. Connections are opened per thread
+    and per process (sqlite3 connections must not cross a fork).
+
+    Args:
+        path (str): Database file path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                'create table if not exists sessions ('
+                ' sid text primary key,'
+                ' payload text not null,'
+                ' expires_at real not null)'
+            )
+            conn.execute('create index if not exists sessions_expires_at_idx'
+                         ' on sessions(expires_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, sid):
+        row = self._connect().execute(
+            'select payload from sessions where sid = ? and expires_at > ?',
+            (sid, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, sid, payload, ttl):
+        conn = self._connect()
+        conn.execute(
+            'insert into sessions (sid, payload, expires_at) values (?, ?, ?)'
+            ' on conflict(sid) do update set payload = excluded.payload,'
+            ' expires_at = excluded.expires_at',
+            (sid, payload, time.time() + ttl)
+        )
+        self._writes += 1
+        if self._writes % SQLITE_PURGE_INTERVAL == 0:
+            conn.execute('delete from sessions where expires_at <= ?', (time.time(),))
+
+    def delete(self, sid):
+        self._connect().execute('delete from sessions where sid = ?', (sid,))
+
+class RedisSessionStore:
+    """
+    Session store on any Redis-protocol server (Redis, Valkey, KeyDB...).
+
+    Expiry is delegated to the server with SETEX.
+
+    Args:
+        url (str): Connection URL, e.g. redis://localhost:6379/0
+        prefix (str): Key prefix for session entries
+    """
+
+    def __init__(self, url, prefix='sleep-study:session:'):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("SESSION_BACKEND=redis requires the 'redis' package")
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, sid):
+        payload = self._client.get(self.prefix + sid)
+        return payload.decode('utf-8') if payload is not None else None
+
+    def set(self, sid, payload, ttl):
+        self._client.setex(self.prefix + sid, int(ttl), payload)
+
+    def delete(self, sid):
+        self._client.delete(self.prefix + sid)
+
+def create_session_store(app, backend=SESSION_BACKEND):
+    """
+    Create the session store selected by SESSION_BACKEND.
+
+    Args:
+        app (Flask): Application (used for the instance folder path)
+        backend (str): 'memory', 'sqlite' or 'redis'
+
+    Returns:
+        Session store instance
+
+    Raises:
+        ValueError: If the backend name is unknown or misconfigured
+    """
+    if backend == 'memory':
+        return MemorySessionStore()
+    if backend == 'sqlite':
+        path = os.getenv('SESSION_SQLITE_PATH',
+                         os.path.join(app.instance_path, 'sessions.sqlite3'))
+        return SQLiteSessionStore(path)
+    if backend == 'redis':
+        return RedisSessionStore(os.getenv('SESSION_REDIS_URL', 'redis://localhost:6379/0'))
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+
+# ============================================================================
+# FLASK SESSION INTERFACE
+# ============================================================================
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Flask session interface that keeps session data in a server-side store.
+
+    The cookie carries only the opaque session id. Data is serialized with
+    Flask's tagged JSON serializer, so the same values the cookie session
+    supported (dicts, datetimes, UUIDs...) round-trip unchanged.
+
+    Args:
+        store: MemorySessionStore, SQLiteSessionStore or RedisSessionStore
+        ttl (int): Session lifetime in seconds (refreshed on every write)
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, ttl=SESSION_TTL_SECONDS):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            try:
+                payload = self.store.get(sid)
+            except Exception as e:
+                print(f"Error loading session: {e}")
+                payload = None
+            if payload is not None:
+                try:
+                    return ServerSideSession(self.serializer.loads(payload), sid=sid)
+                except ValueError:
+                    pass
+        return ServerSideSession(sid=generate_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+
+        # Emptied session (sign-out): drop server-side data and the cookie
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+
+        # Untouched sessions are not rewritten - polling stays read-only
+        if not session.modified:
+            return
+
+        self.store.set(session.sid, self.serializer.dumps(dict(session)), self.ttl)
+        response.set_cookie(
+            cookie_name,
+            session.sid,
+            max_age=self.ttl,
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=domain,
+            path=path
+        )
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Multi-Resolution Signal Tiles for the Sleep Study Management System
+
+Reviewing a study means scrolling 8+ hours of several channels. The raw
+samples (tens of millions per night) cannot be shipped to the browser, and
+decoding the recording per request would take seconds.
+
+This module builds a min/max decimation pyramid once, at ingestion:
+- Per signal, level 0 holds the raw int16 samples and every level above
+  holds (min, max) pairs over LEVEL_FACTOR times more samples than the one
+  below, until the whole recording fits in one tile
+- All levels of a signal are concatenated in one int16 file
+  (signal-<n>.i16) and read through np.memmap, so serving a tile touches
+  only the TILE_BINS rows it returns
+- pyramid.json describes the levels (offsets, bin counts, bin sizes) and
+  the scaling needed to turn digital values into physical units
+- Open recordings are cached as one LRU entry each (metadata plus the
+  signal memmaps opened so far), so a recording is evicted as a whole and
+  never left with its metadata cached but its signals closed
+- Storage keeps a copy of every file; a host that has no local copy
+  downloads it once on first use (TileStore fetch callback). Downloads are
+  single-flight per file, so opening one recording never waits for
+  another recording's download
+- Access checks are cached per (user, recording) for TILE_ACCESS_TTL
+  seconds, so a tile request is a memmap slice and no database round trip
+
+A tile is TILE_BINS bins of one level, so any time window at any zoom is a
+handful of fixed, immutable tiles that browsers can cache indefinitely.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from sleep_data import read_digital
+
+SIGNAL_TILES_DIR = os.getenv('SIGNAL_TILES_DIR')
+
+# Bins per tile (about one screen width)
+TILE_BINS = 1024
+
+# Samples per bin grow by this factor per level
+LEVEL_FACTOR = 4
+
+# Open recordings (metadata and signal memmaps) kept per worker
+TILE_STORE_SIZE = int(os.getenv('TILE_STORE_SIZE', 64))
+
+# Seconds a positive recording access check is reused
+TILE_ACCESS_TTL = int(os.getenv('TILE_ACCESS_TTL', 300))
+
+PYRAMID_VERSION = 'v1'
+
+PYRAMID_METADATA = 'pyramid.json'
+
+# ============================================================================
+# BUILDING
+# ============================================================================
+
+def get_signal_filename(index):
+    """File holding all pyramid levels of one signal."""
+    return f"signal-{index}.i16"
+
+def build_signal_pyramid(path, header, signal, output_dir):
+    """
+    Build and write all pyramid levels of one signal.
+
+    Runs in an analysis pool process: only this channel is decoded.
+
+    Args:
+        path (str): Staged EDF file
+        header (dict): Parsed header
+        signal (dict): Entry of header['signals']
+        output_dir (str): Directory receiving signal-<n>.i16
+
+    Returns:
+        dict: Signal metadata for pyramid.json
+    """
+    samples = read_digital(path, header, signal)
+    levels = [{'offset': 0, 'bins': len(samples), 'bin_samples': 1}]
+    offset = len(samples)
+
+    with open(os.path.join(output_dir, get_signal_filename(signal['index'])), 'wb') as output:
+        output.write(samples.astype('<i2').tobytes())
+
+        lows, highs = samples, samples
+        bin_samples = 1
+        while len(lows) > TILE_BINS:
+            starts = np.arange(0, len(lows), LEVEL_FACTOR)
+            lows = np.minimum.reduceat(lows, starts)
+            highs = np.maximum.reduceat(highs, starts)
+            bin_samples *= LEVEL_FACTOR
+
+            output.write(np.column_stack((lows, highs)).astype('<i2').tobytes())
+            levels.append({'offset': offset, 'bins': len(lows), 'bin_samples': bin_samples})
+            offset += 2 * len(lows)
+
+    return {
+        'index': signal['index'],
+        'label': signal['label'],
+        'unit': signal['unit'],
+        'sample_rate': signal['sample_rate'],
+        'gain': signal['gain'],
+        'digital_min': signal['digital_min'],
+        'physical_min': signal['physical_min'],
+        'samples': len(samples),
+        'levels': levels
+    }
+
+def build_pyramid(path, header, output_dir, executor=None, timeout=None):
+    """
+    Build the tile pyramid of every signal in a recording.
+
+    Files are written to a temporary directory that is renamed into place,
+    so readers never see a half-built pyramid.
+
+    Args:
+        path (str): Staged EDF file
+        header (dict): Header from sleep_data.summarize_edf()
+        output_dir (str): Final pyramid directory
+        executor (Executor, optional): Pool running one signal per task;
+            signals are built in-process when omitted
+        timeout (float, optional): Seconds to wait for each pool task
+
+    Returns:
+        dict: Pyramid metadata (also written as pyramid.json)
+    """
+    building = f"{output_dir}.building-{os.getpid()}"
+    os.makedirs(building, exist_ok=True)
+
+    try:
+        if executor is None:
+            signals = [build_signal_pyramid(path, header, signal, building) for signal in header['signals']]
+        else:
+            futures = [executor.submit(build_signal_pyramid, path, header, signal, building)
+                       for signal in header['signals']]
+            signals = [future.result(timeout=timeout) for future in futures]
+
+        metadata = {
+            'version': PYRAMID_VERSION,
+            'tile_bins': TILE_BINS,
+            'level_factor': LEVEL_FACTOR,
+            'duration_seconds': header['duration_seconds'],
+            'signals': signals
+        }
+        with open(os.path.join(building, PYRAMID_METADATA), 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.replace(building, output_dir)
+    finally:
+        shutil.rmtree(building, ignore_errors=True)
+
+    return metadata
+
+def list_pyramid_files(metadata):
+    """Names of all files making up a pyramid (metadata first)."""
+    return [PYRAMID_METADATA] + [get_signal_filename(signal['index']) for signal in metadata['signals']]
+
+# ============================================================================
+# SERVING
+# ============================================================================
+
+class TileStore:
+    """
+    Reads tiles from local pyramids through cached memmaps.
+
+    Args:
+        root (str): Directory holding one pyramid directory per recording
+        fetch (callable, optional): fetch(recording_id, name, destination)
+            downloads a missing pyramid file (e.g. from Storage)
+        maxsize (int): Open recordings kept (LRU)
+    """
+
+    def __init__(self, root, fetch=None, maxsize=TILE_STORE_SIZE):
+        self.root = root
+        self.fetch = fetch
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # recording_id -> {'metadata': dict, 'signals': {index: np.memmap}}
+        self._lock = threading.Lock()
+        self._fetch_locks = {}  # (recording_id, name) -> [lock, waiting threads]
+
+    def get_path(self, recording_id, name=None):
+        """Local path of a recording's pyramid directory or file."""
+        directory = os.path.join(self.root, recording_id)
+        return os.path.join(directory, name) if name else directory
+
+    def metadata(self, recording_id):
+        """
+        Get a recording's pyramid metadata.
+
+        Raises:
+            FileNotFoundError: If the pyramid is not available
+        """
+        return self._get(recording_id)['metadata']
+
+    def read_tile(self, recording_id, signal_index, level, tile):
+        """
+        Read one tile in physical units.
+
+        Args:
+            recording_id (str): sleep_data_files id
+            signal_index (int): Signal number (pyramid.json 'index')
+            level (int): Pyramid level (0 = raw samples)
+            tile (int): Tile number within the level
+
+        Returns:
+            dict: start_seconds, bin_seconds and either 'values' (level 0)
+                or 'min'/'max' lists
+
+        Raises:
+            FileNotFoundError: If the pyramid is not available
+            IndexError: If the signal, level or tile does not exist
+        """
+        entry = self._get(recording_id)
+        metadata = entry['metadata']
+        signal = next((s for s in metadata['signals'] if s['index'] == signal_index), None)
+        if signal is None or not 0 <= level < len(signal['levels']):
+            raise IndexError("No such signal or level")
+
+        bins = signal['levels'][level]
+        first = tile * TILE_BINS
+        last = min(first + TILE_BINS, bins['bins'])
+        if tile < 0 or first >= bins['bins']:
+            raise IndexError("No such tile")
+
+        data = entry['signals'].get(signal_index)
+        if data is None:
+            data = self._open_signal(self._ensure_local(recording_id, get_signal_filename(signal_index)))
+            with self._lock:
+                data = entry['signals'].setdefault(signal_index, data)
+        width = 1 if level == 0 else 2
+        digital = data[bins['offset'] + first * width:bins['offset'] + last * width]
+        physical = (digital.astype(np.float32) - signal['digital_min']) * signal['gain'] + signal['physical_min']
+        physical = np.round(physical, 3)
+
+        result = {
+            'signal': signal_index,
+            'level': level,
+            'tile': tile,
+            'start_seconds': first * bins['bin_samples'] / signal['sample_rate'],
+            'bin_seconds': bins['bin_samples'] / signal['sample_rate']
+        }
+        if level == 0:
+            result['values'] = physical.tolist()
+        else:
+            pairs = physical.reshape(-1, 2)
+            result['min'] = pairs[:, 0].tolist()
+            result['max'] = pairs[:, 1].tolist()
+        return result
+
+    def _get(self, recording_id):
+        with self._lock:
+            if recording_id in self._entries:
+                self._entries.move_to_end(recording_id)
+                return self._entries[recording_id]
+
+        metadata = self._load_metadata(self._ensure_local(recording_id, PYRAMID_METADATA))
+
+        with self._lock:
+            entry = self._entries.setdefault(recording_id, {'metadata': metadata, 'signals': {}})
+            self._entries.move_to_end(recording_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _ensure_local(self, recording_id, name):
+        path = self.get_path(recording_id, name)
+        if os.path.exists(path):
+            return path
+        if self.fetch is None:
+            raise FileNotFoundError(path)
+
+        # One download per file; other files (and recordings) fetch in parallel
+        key = (recording_id, name)
+        with self._lock:
+            entry = self._fetch_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if not os.path.exists(path):
+                    os.makedirs(self.get_path(recording_id), exist_ok=True)
+                    self.fetch(recording_id, name, path)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._fetch_locks[key]
+        return path
+
+    @staticmethod
+    def _load_metadata(path):
+        with open(path) as metadata_file:
+            return json.load(metadata_file)
+
+    @staticmethod
+    def _open_signal(path):
+        return np.memmap(path, dtype='<i2', mode='r')
+
+class RecordingAccessCache:
+    """
+    Per-(user, recording) TTL/LRU cache of successful access checks.
+
+    Only granted access is cached; a denied or failed check is repeated on
+    the next request.
+
+    Args:
+        ttl (int): Seconds a granted check is reused
+        maxsize (int): Maximum number of entries before LRU eviction
+    """
+
+    def __init__(self, ttl=TILE_ACCESS_TTL, maxsize=4096):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # (user_id, recording_id) -> expires_at
+        self._lock = threading.Lock()
+
+    def check(self, user_id, recording_id, lookup):
+        """
+        Check whether a user may read a recording.
+
+        Args:
+            user_id (str): UUID of the user
+            recording_id (str): sleep_data_files id
+            lookup (callable): lookup(recording_id) -> bool, run on a miss
+                (e.g. an RLS-scoped select with the user's client)
+
+        Returns:
+            bool: True if access is granted
+        """
+        key = (user_id, recording_id)
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is not None and expires_at > time.time():
+                self._entries.move_to_end(key)
+                return True
+
+        try:
+            granted = bool(lookup(recording_id))
+        except Exception as e:
+            print(f"Error checking recording access: {e}")
+            return False
+
+        if granted:
+            with self._lock:
+                self._entries[key] = time.time() + self.ttl
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return granted
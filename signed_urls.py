@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Signed Storage URLs for the Sleep Study Management System
+
+All buckets are private, yet referrals, recordings and reports were stored
+with get_public_url(), so every document link pointed at an endpoint that
+refuses to serve it. Signing each link instead costs a Storage request per
+file, and the study details modal shows a link for every referral, data
+file and report of the study, on every open.
+
+This module signs links in batches and reuses them while they are valid:
+- Rows store the object path in the bucket (file_url); links are signed
+  when a page is rendered, after the row was read with the user's own
+  (RLS-scoped) client
+- All paths a page needs are signed with one POST /object/sign/{bucket}
+  per bucket, and the buckets of a page are signed concurrently, so a modal
+  with any number of attachments costs at most one Storage round trip. The
+  endpoint is called directly: storage3's create_signed_urls() fails the
+  whole batch when one object is missing (Storage answers signedURL: null)
+- Signed URLs are kept in a bounded LRU per worker until
+  SIGNED_URL_MIN_REMAINING seconds before they expire, so a link handed
+  out is always valid for at least that long and repeated opens of the
+  same study cost no Storage request at all
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from supabase_clients import get_shared_transport
+
+# Lifetime of a signed URL
+SIGNED_URL_TTL = int(os.getenv('SIGNED_URL_TTL', 3600))
+
+# A cached URL is only handed out while at least this long remains
+SIGNED_URL_MIN_REMAINING = int(os.getenv('SIGNED_URL_MIN_REMAINING', 300))
+
+# Signed URLs kept per worker
+SIGNED_URL_CACHE_SIZE = int(os.getenv('SIGNED_URL_CACHE_SIZE', 4096))
+
+# Marker of object URLs stored before links were signed
+PUBLIC_URL_MARKER = '/storage/v1/object/public/'
+
+_http = httpx.Client(transport=get_shared_transport(), timeout=httpx.Timeout(10.0))
+
+def get_object_path(file_url):
+    """
+    Get the object path of a stored file reference.
+
+    Rows store the path in the bucket; rows written before links were
+    signed hold a full public URL, whose path is taken from the URL.
+
+    Args:
+        file_url (str): Stored file_url value
+
+    Returns:
+        str|None: Object path in its bucket, or None if empty
+    """
+    if not file_url:
+        return None
+    if PUBLIC_URL_MARKER in file_url:
+        # .../storage/v1/object/public/<bucket>/<path>
+        file_url = file_url.split(PUBLIC_URL_MARKER, 1)[1].split('?', 1)[0]
+        return file_url.split('/', 1)[1] if '/' in file_url else None
+    return file_url
+
+def sign_bucket(client, bucket, paths, expires_in):
+    """
+    Sign object paths of one bucket with a single Storage request.
+
+    Args:
+        client: AuthenticatedClient allowed to read the bucket
+        bucket (str): Bucket name
+        paths (list): Object paths
+        expires_in (int): URL lifetime in seconds
+
+    Returns:
+        dict: path -> signed URL (paths Storage could not sign, e.g.
+            missing objects, are left out)
+
+    Raises:
+        httpx.HTTPError: If the request itself fails
+    """
+    response = _http.post(f"{client.storage_url}/object/sign/{bucket}",
+                          headers=dict(client.headers),
+                          json={'paths': paths, 'expiresIn': expires_in})
+    response.raise_for_status()
+
+    urls = {}
+    for item in response.json():
+        # signedURL is relative to the Storage URL: /object/sign/<bucket>/<path>?token=...
+        if item.get('error') or not item.get('signedURL') or not item.get('path'):
+            continue
+        urls[item['path']] = f"{client.storage_url}/{item['signedURL'].lstrip('/')}"
+    return urls
+
+class SignedUrlCache:
+    """
+    Bounded LRU of signed URLs keyed by (bucket, path).
+
+    Entries are dropped min_remaining seconds before their URL expires.
+    Failed signing is not cached; the link is signed again next time.
+
+    Args:
+        ttl (int): Lifetime of newly signed URLs in seconds
+        min_remaining (int): Minimum validity left on a URL handed out
+        maxsize (int): Maximum number of entries before LRU eviction
+        sign (callable): sign(client, bucket, paths, expires_in) -> {path: url}
+    """
+
+    def __init__(self, ttl=SIGNED_URL_TTL, min_remaining=SIGNED_URL_MIN_REMAINING,
+                 maxsize=SIGNED_URL_CACHE_SIZE, sign=sign_bucket):
+        if min_remaining >= ttl:
+            raise ValueError("SIGNED_URL_MIN_REMAINING must be shorter than SIGNED_URL_TTL")
+        self.ttl = ttl
+        self.min_remaining = min_remaining
+        self.maxsize = maxsize
+        self.sign = sign
+        self._entries = OrderedDict()  # (bucket, path) -> (url, reuse_until)
+        self._lock = threading.Lock()
+
+    def get_many(self, client, objects):
+        """
+        Get signed URLs for many objects, signing only the missing ones.
+
+        Args:
+            client: Supabase client used to sign cache misses
+            objects (iterable): (bucket, path) pairs
+
+        Returns:
+            dict: (bucket, path) -> signed URL; objects that could not be
+                signed are missing
+        """
+        urls = {}
+        missing = {}
+        now = time.time()
+        with self._lock:
+            for key in objects:
+                if key in urls or not key[1]:
+                    continue
+                entry = self._entries.get(key)
+                if entry and entry[1] > now:
+                    self._entries.move_to_end(key)
+                    urls[key] = entry[0]
+                else:
+                    missing.setdefault(key[0], set()).add(key[1])
+
+        if not missing:
+            return urls
+
+        signed_at = time.time()
+
+        def sign(bucket):
+            try:
+                return bucket, self.sign(client, bucket, sorted(missing[bucket]), self.ttl)
+            except Exception as e:
+                print(f"Error signing URLs in bucket '{bucket}': {e}")
+                return bucket, {}
+
+        if len(missing) == 1:
+            results = [sign(next(iter(missing)))]
+        else:
+            with ThreadPoolExecutor(max_workers=len(missing)) as pool:
+                results = list(pool.map(sign, missing))
+
+        reuse_until = signed_at + self.ttl - self.min_remaining
+        with self._lock:
+            for bucket, signed in results:
+                for path, url in signed.items():
+                    key = (bucket, path)
+                    urls[key] = url
+                    self._entries[key] = (url, reuse_until)
+                    self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return urls
+
+    def get(self, client, bucket, path):
+        """Get one signed URL (None if it could not be signed)."""
+        return self.get_many(client, [(bucket, path)]).get((bucket, path))
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Respiratory and Oximetry Event Detection for the Sleep Study Management System
+
+Doctors triaged studies awaiting review by questionnaire thresholds alone
+(Epworth > 15, OSA-50 >= 3); nothing was computed from the recording itself.
+
+This module scores ingested recordings instead:
+- Oximetry: desaturations of at least DESATURATION_DROP % below the
+  preceding DESATURATION_BASELINE_SECONDS maximum, lasting at least
+  MIN_EVENT_SECONDS -> ODI (desaturations per hour)
+- Airflow: breath amplitude reductions of at least 30% (hypopnea) or 90%
+  (apnea) against the median amplitude of the preceding
+  AIRFLOW_BASELINE_SECONDS, lasting at least MIN_EVENT_SECONDS -> AHI-style
+  index (events per hour of recording; there is no sleep staging, so this
+  is a respiratory event index, not a polysomnography AHI)
+- Airflow signal loss (amplitude below AIRFLOW_LOSS_FRACTION of the
+  recording's median, e.g. a flatline from a dislodged cannula) is masked
+  before baselines are taken, is never scored as an event and does not
+  count as analyzed time
+- Signals are reduced to one-second values, then every step (baselines,
+  thresholds, event runs) is a NumPy sliding-window or array operation, so
+  a full night takes well under a second per channel
+- Each channel is analyzed in its own process of a shared spawn-based pool
+  (ANALYSIS_WORKERS per web worker), decoding only that channel from the
+  staged file
+
+Results are stored per recording in sleep_study_analyses and feed the
+doctor dashboard's triage priority.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from sleep_data import read_signal
+
+ANALYSIS_VERSION = 'v2'
+
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', min(4, os.cpu_count() or 1)))
+ANALYSIS_TIMEOUT_SECONDS = int(os.getenv('ANALYSIS_TIMEOUT_SECONDS', 120))
+
+# Channel labels (lowercase substrings) recognized per analysis
+SPO2_LABELS = ('spo2', 'sao2', 'sat', 'oxygen')
+AIRFLOW_LABELS = ('flow', 'nasal', 'cannula', 'therm')
+
+MIN_EVENT_SECONDS = 10
+
+# Oximetry
+DESATURATION_DROP = 3.0
+DESATURATION_BASELINE_SECONDS = 120
+SPO2_VALID_RANGE = (50.0, 100.0)
+
+# Airflow
+AIRFLOW_AMPLITUDE_SECONDS = 4
+AIRFLOW_BASELINE_SECONDS = 120
+HYPOPNEA_REDUCTION = 0.3
+APNEA_REDUCTION = 0.9
+# Amplitude below this fraction of the recording's median is signal loss
+# (a 90% apnea reduction still leaves well above it)
+AIRFLOW_LOSS_FRACTION = 0.02
+# Longer "events" are sensor loss (e.g. a dislodged cannula), not breathing
+MAX_AIRFLOW_EVENT_SECONDS = 120
+
+# AHI severity bands (events per hour)
+AHI_SEVERITY = ((30, 'severe'), (15, 'moderate'), (5, 'mild'), (0, 'normal'))
+
+# ============================================================================
+# SIGNAL HELPERS
+# ============================================================================
+
+def find_channel(signals, labels):
+    """
+    Find the first signal whose label contains one of the given substrings.
+
+    Args:
+        signals (list): Signal dicts from sleep_data.parse_edf_header()
+        labels (tuple): Lowercase label substrings
+
+    Returns:
+        dict|None: Matching signal
+    """
+    for signal in signals:
+        label = signal['label'].lower()
+        if any(part in label for part in labels):
+            return signal
+    return None
+
+def per_second(values, sample_rate, reducer):
+    """
+    Reduce a signal to one value per second.
+
+    Args:
+        values (np.ndarray): Samples
+        sample_rate (float): Samples per second
+        reducer: np.minimum, np.maximum or np.add (mean)
+
+    Returns:
+        np.ndarray: One value per whole second (float64)
+    """
+    seconds = int(len(values) / sample_rate)
+    if seconds == 0:
+        return np.empty(0)
+    if sample_rate < 1:
+        # Slower than 1 Hz (some oximeters): interpolate onto a 1 s grid
+        return np.interp(np.arange(seconds), np.arange(len(values)) / sample_rate, values)
+
+    starts = np.ceil(np.arange(seconds) * sample_rate).astype(np.int64)
+    ends = np.append(starts[1:], int(round(seconds * sample_rate)))
+    reduced = reducer.reduceat(values.astype(np.float64), starts)
+    if reducer is np.add:
+        reduced = reduced / np.maximum(ends - starts, 1)
+    # The last reduceat segment runs to the end of the array; trim partial seconds
+    return reduced[:seconds]
+
+def find_runs(mask, min_length, max_length=None):
+    """
+    Find runs of True values.
+
+    Args:
+        mask (np.ndarray): Boolean array
+        min_length (int): Shortest run kept
+        max_length (int, optional): Longest run kept
+
+    Returns:
+        tuple: (starts, ends) index arrays, ends exclusive
+    """
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    lengths = ends - starts
+    keep = lengths >= min_length
+    if max_length is not None:
+        keep &= lengths <= max_length
+    return starts[keep], ends[keep]
+
+def _events(kind, starts, ends, offset=0):
+    return [[int(start + offset), int(end - start), kind] for start, end in zip(starts, ends)]
+
+# ============================================================================
+# DETECTORS
+# ============================================================================
+
+def detect_desaturations(spo2, sample_rate):
+    """
+    Detect oxygen desaturation events.
+
+    Args:
+        spo2 (np.ndarray): SpO2 samples (%)
+        sample_rate (float): Samples per second
+
+    Returns:
+        dict: desaturation_count, odi, min_spo2, mean_spo2, t90_minutes,
+            oximetry_hours and events ([start_s, duration_s, 'desaturation'])
+    """
+    level = per_second(spo2, sample_rate, np.add)
+    level[(level < SPO2_VALID_RANGE[0]) | (level > SPO2_VALID_RANGE[1])] = np.nan
+
+    valid_seconds = int(np.count_nonzero(~np.isnan(level)))
+    result = {
+        'desaturation_count': 0, 'odi': None, 'min_spo2': None, 'mean_spo2': None,
+        't90_minutes': None, 'oximetry_hours': round(valid_seconds / 3600, 2), 'events': []
+    }
+    if valid_seconds == 0:
+        return result
+
+    result.update({
+        'min_spo2': round(float(np.nanmin(level)), 1),
+        'mean_spo2': round(float(np.nanmean(level)), 1),
+        't90_minutes': round(float(np.count_nonzero(level < 90)) / 60, 1)
+    })
+
+    window = DESATURATION_BASELINE_SECONDS
+    if len(level) <= window:
+        return result
+
+    # Baseline for second t is the highest level over [t - window, t);
+    # fmax ignores NaN (artifact) seconds unless the whole window is invalid
+    baseline = np.fmax.reduce(sliding_window_view(level[:-1], window), axis=1)
+    drop = baseline - level[window:]
+    with np.errstate(invalid='ignore'):
+        starts, ends = find_runs(drop >= DESATURATION_DROP, MIN_EVENT_SECONDS)
+
+    result['desaturation_count'] = len(starts)
+    result['odi'] = round(len(starts) / (valid_seconds / 3600), 1)
+    result['events'] = _events('desaturation', starts, ends, offset=window)
+    return result
+
+def detect_airflow_events(flow, sample_rate):
+    """
+    Detect apneas and hypopneas from breath amplitude reductions.
+
+    Args:
+        flow (np.ndarray): Airflow samples
+        sample_rate (float): Samples per second
+
+    Returns:
+        dict: apnea_count, hypopnea_count, ahi, airflow_hours and events
+            ([start_s, duration_s, 'apnea'|'hypopnea'])
+    """
+    result = {'apnea_count': 0, 'hypopnea_count': 0, 'ahi': None, 'airflow_hours': 0.0, 'events': []}
+    highs = per_second(flow, sample_rate, np.maximum)
+    lows = per_second(flow, sample_rate, np.minimum)
+
+    span = AIRFLOW_AMPLITUDE_SECONDS
+    window = AIRFLOW_BASELINE_SECONDS
+    if len(highs) < span + window + MIN_EVENT_SECONDS:
+        return result
+
+    # Peak-to-peak amplitude over a few breaths starting at each second
+    amplitude = (sliding_window_view(highs, span).max(axis=1)
+                 - sliding_window_view(lows, span).min(axis=1))
+    # Signal loss is judged against the whole recording, not the rolling
+    # baseline, which would itself sink to zero during a flatline
+    amplitude[amplitude <= AIRFLOW_LOSS_FRACTION * np.median(amplitude)] = np.nan
+
+    # Baseline for second t is the median amplitude over [t - window, t),
+    # ignoring lost seconds (NaN while the whole window is lost)
+    windows = sliding_window_view(amplitude[:-1], window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        baseline = np.full(len(windows), np.nan)
+        valid = ~np.isnan(windows).all(axis=1)
+        baseline[valid] = np.nanmedian(windows[valid], axis=1)
+        # Lost seconds have a NaN reduction, so no event runs through them
+        reduction = np.where(baseline > 0, 1 - amplitude[window:] / baseline, np.nan)
+        starts, ends = find_runs(reduction >= HYPOPNEA_REDUCTION, MIN_EVENT_SECONDS)
+        apnea_starts, _ = find_runs(reduction >= APNEA_REDUCTION, MIN_EVENT_SECONDS)
+
+    # Runs too long to be breathing events are loss the amplitude floor
+    # missed (e.g. a partly dislodged sensor): drop them and their time too
+    lost = (ends - starts) > MAX_AIRFLOW_EVENT_SECONDS
+    lost_seconds = int((ends[lost] - starts[lost]).sum())
+    starts, ends = starts[~lost], ends[~lost]
+
+    # An event is an apnea if a >= 90% reduction run starts inside it
+    containing = np.searchsorted(starts, apnea_starts, side='right') - 1
+    inside = (containing >= 0) & (apnea_starts < ends[np.maximum(containing, 0)]) if len(starts) else np.zeros(0, bool)
+    is_apnea = np.zeros(len(starts), dtype=bool)
+    is_apnea[containing[inside]] = True
+
+    analyzed_seconds = int(np.count_nonzero(~np.isnan(reduction))) - lost_seconds
+    if analyzed_seconds <= 0:
+        return result
+
+    events = (_events('apnea', starts[is_apnea], ends[is_apnea], offset=window)
+              + _events('hypopnea', starts[~is_apnea], ends[~is_apnea], offset=window))
+
+    result.update({
+        'apnea_count': int(is_apnea.sum()),
+        'hypopnea_count': int((~is_apnea).sum()),
+        'ahi': round(len(starts) / (analyzed_seconds / 3600), 1),
+        'airflow_hours': round(analyzed_seconds / 3600, 2),
+        'events': sorted(events)
+    })
+    return result
+
+def get_ahi_severity(ahi):
+    """
+    Get the severity band for an AHI value.
+
+    Returns:
+        str|None: 'normal', 'mild', 'moderate', 'severe' or None if unknown
+    """
+    if ahi is None:
+        return None
+    for threshold, severity in AHI_SEVERITY:
+        if ahi >= threshold:
+            return severity
+    return 'normal'
+
+# ============================================================================
+# PROCESS POOL
+# ============================================================================
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_analysis_pool():
+    """
+    Get this process's analysis pool, created on first use.
+
+    Uses the spawn start method: forking a threaded web worker could copy
+    held locks into the children. The pool is recreated after a fork, so
+    each gunicorn worker owns its own.
+
+    Returns:
+        ProcessPoolExecutor: Shared pool
+    """
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                max_workers=ANALYSIS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _pool_pid = os.getpid()
+    return _pool
+
+def _analyze_oximetry(path, header, signal):
+    return detect_desaturations(read_signal(path, header, signal), signal['sample_rate'])
+
+def _analyze_airflow(path, header, signal):
+    return detect_airflow_events(read_signal(path, header, signal), signal['sample_rate'])
+
+def analyze_recording(path, header):
+    """
+    Detect respiratory and oximetry events in a staged EDF recording.
+
+    The SpO2 and airflow channels are analyzed in parallel pool processes;
+    either may be missing, in which case its indices are None.
+
+    Args:
+        path (str): EDF file path
+        header (dict): Header from sleep_data.summarize_edf()
+
+    Returns:
+        dict|None: Indices, counts and sorted events, or None if the
+            recording has neither an SpO2 nor an airflow channel
+    """
+    spo2 = find_channel(header['signals'], SPO2_LABELS)
+    flow = find_channel(header['signals'], AIRFLOW_LABELS)
+    if spo2 is None and flow is None:
+        return None
+
+    pool = get_analysis_pool()
+    oximetry = pool.submit(_analyze_oximetry, path, header, spo2) if spo2 else None
+    airflow = pool.submit(_analyze_airflow, path, header, flow) if flow else None
+
+    oximetry = oximetry.result(timeout=ANALYSIS_TIMEOUT_SECONDS) if oximetry else detect_desaturations(np.empty(0), 1)
+    airflow = airflow.result(timeout=ANALYSIS_TIMEOUT_SECONDS) if airflow else detect_airflow_events(np.empty(0), 1)
+
+    return {
+        'ahi': airflow['ahi'],
+        'odi': oximetry['odi'],
+        'apnea_count': airflow['apnea_count'],
+        'hypopnea_count': airflow['hypopnea_count'],
+        'desaturation_count': oximetry['desaturation_count'],
+        'min_spo2': oximetry['min_spo2'],
+        'mean_spo2': oximetry['mean_spo2'],
+        't90_minutes': oximetry['t90_minutes'],
+        'analyzed_hours': max(airflow['airflow_hours'], oximetry['oximetry_hours']),
+        'events': sorted(airflow['events'] + oximetry['events']),
+        'spo2_channel': spo2['label'] if spo2 else None,
+        'airflow_channel': flow['label'] if flow else None,
+        'algorithm_version': ANALYSIS_VERSION
+    }
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Appointment Slot Engine for the Sleep Study Management System
+
+Step 2 of the booking wizard used to rebuild the same hard-coded weekday
+slots (09:00, 11:00, 14:00, 16:00) on every render, ignoring each
+organization's opening hours, its max_concurrent_studies capacity and the
+studies already booked.
+
+This module serves capacity-aware availability from memory instead:
+- Each organization's opening_hours JSON is compiled once into a weekly
+  schedule of appointment start hours
+- A per-organization, per-day occupancy index is loaded with one grouped
+  query (public.study_occupancy) over the booking window
+- Bookings update the index incrementally, and the index is reloaded from
+  the database once its TTL expires (picking up other workers' bookings)
+- The rendered slot list is cached until the index changes
+
+A study occupies its organization for the day it starts, so a day is full
+once its booked studies reach max_concurrent_studies.
+"""
+
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from query_shapes import shaped_query
+
+# Booking window: starts a week out and spans two weeks (matches prior behaviour)
+BOOKING_LEAD_DAYS = 7
+BOOKING_WINDOW_DAYS = 14
+
+# Spacing between appointment start times within opening hours
+APPOINTMENT_INTERVAL_HOURS = 2
+
+# Occupancy index lifetime before it is reloaded from the database
+OCCUPANCY_TTL_SECONDS = int(os.getenv('SLOT_OCCUPANCY_TTL', 60))
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Used for organizations without opening_hours configured
+DEFAULT_OPENING_HOURS = {
+    day: {'open': '09:00', 'close': '17:00'} for day in WEEKDAYS[:5]
+}
+
+DEFAULT_MAX_CONCURRENT_STUDIES = 10
+
+def compile_opening_hours(opening_hours):
+    """
+    Compile an organization's opening_hours JSON into appointment start hours.
+
+    Appointments start on the first full hour at or after opening and then
+    every APPOINTMENT_INTERVAL_HOURS, as long as the whole appointment fits
+    before closing. Days marked 'closed' (or missing) have no appointments.
+
+    Args:
+        opening_hours (dict|None): e.g. {'monday': {'open': '08:00', 'close': '18:00'},
+            'sunday': 'closed'}
+
+    Returns:
+        tuple: Seven tuples of start hours, indexed by weekday (Monday = 0)
+    """
+    opening_hours = opening_hours or DEFAULT_OPENING_HOURS
+    schedule = []
+
+    for day in WEEKDAYS:
+        hours = opening_hours.get(day)
+        if not isinstance(hours, dict):
+            schedule.append(())
+            continue
+        try:
+            open_hour, open_minute = (int(part) for part in hours['open'].split(':'))
+            close_hour, close_minute = (int(part) for part in hours['close'].split(':'))
+        except (KeyError, ValueError, AttributeError):
+            schedule.append(())
+            continue
+
+        first = open_hour + (1 if open_minute else 0)
+        last = close_hour - APPOINTMENT_INTERVAL_HOURS  # Latest start that still fits
+        schedule.append(tuple(range(first, last + 1, APPOINTMENT_INTERVAL_HOURS)))
+
+    return tuple(schedule)
+
+class SlotEngine:
+    """
+    Cached, capacity-aware appointment availability.
+
+    Args:
+        get_client (callable): Returns the Supabase client used to load
+            organizations and occupancy
+        ttl (int): Seconds before the occupancy index is reloaded
+    """
+
+    def __init__(self, get_client, ttl=OCCUPANCY_TTL_SECONDS):
+        self.get_client = get_client
+        self.ttl = ttl
+        self._schedules = {}    # organization_id -> compiled weekly schedule
+        self._capacity = {}     # organization_id -> max_concurrent_studies
+        self._occupancy = {}    # (organization_id, 'YYYY-MM-DD') -> booked count
+        self._window_start = None
+        self._loaded_at = 0
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def get_available_slots(self):
+        """
+        Get bookable appointment slots for the booking window.
+
+        Returns:
+            list: Slots with id ('YYYY-MM-DD-HH'), date, time and display fields
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if self._slots is None:
+                self._slots = self._build_slots()
+            return self._slots
+
+    def organizations_with_capacity(self, date_str, hour):
+        """
+        Get organizations that are open and under capacity for a slot.
+
+        Args:
+            date_str (str): Appointment date ('YYYY-MM-DD')
+            hour (int): Appointment start hour
+
+        Returns:
+            list: organization_id values able to take the booking (contains
+                None when no organizations are configured)
+        """
+        with self._lock:
+            self._ensure_loaded()
+            weekday = date.fromisoformat(date_str).weekday()
+            return [org_id for org_id, schedule in self._schedules.items()
+                    if hour in schedule[weekday] and self._has_capacity(org_id, date_str)]
+
+    def record_booking(self, organization_id, date_str):
+        """
+        Count a new booking in the occupancy index.
+
+        Args:
+            organization_id (str): Organization the study was booked with
+            date_str (str): Study start date ('YYYY-MM-DD')
+        """
+        with self._lock:
+            key = (organization_id, date_str)
+            self._occupancy[key] = self._occupancy.get(key, 0) + 1
+            self._slots = None
+
+    def invalidate(self):
+        """Force organizations and occupancy to be reloaded on next use."""
+        with self._lock:
+            self._loaded_at = 0
+
+    def _has_capacity(self, organization_id, date_str):
+        booked = self._occupancy.get((organization_id, date_str), 0)
+        return booked < self._capacity.get(organization_id, DEFAULT_MAX_CONCURRENT_STUDIES)
+
+    def _ensure_loaded(self):
+        window_start = (datetime.now() + timedelta(days=BOOKING_LEAD_DAYS)).date()
+        fresh = self._loaded_at and time.time() - self._loaded_at < self.ttl
+        if fresh and window_start == self._window_start:
+            return
+        try:
+            self._load(window_start)
+        except Exception as e:
+            # Keep serving the previous index if the reload fails
+            print(f"Error loading appointment occupancy: {e}")
+            if self._window_start is None:
+                # Nothing loaded yet: fall back to the default schedule
+                self._schedules = {None: compile_opening_hours(None)}
+                self._window_start = window_start
+
+    def _load(self, window_start):
+        """
+        Load organization schedules and the occupancy index for the window.
+
+        Two requests: organizations (opening hours and capacity) and one
+        grouped study_occupancy() call over the window's date range.
+        """
+        client = self.get_client()
+        window_end = window_start + timedelta(days=BOOKING_WINDOW_DAYS - 1)
+
+        organizations = shaped_query(client, 'slot_organizations').execute()
+
+        occupancy = client.rpc('study_occupancy', {
+            'from_date': window_start.isoformat(),
+            'to_date': window_end.isoformat()
+        }).execute()
+
+        self._schedules = {org['id']: compile_opening_hours(org.get('opening_hours'))
+                           for org in organizations.data}
+        if not self._schedules:
+            # No visible organizations: offer the default schedule unassigned
+            self._schedules = {None: compile_opening_hours(None)}
+        self._capacity = {org['id']: org.get('max_concurrent_studies') or DEFAULT_MAX_CONCURRENT_STUDIES
+                          for org in organizations.data}
+        self._occupancy = {(row['organization_id'], row['start_date']): row['study_count']
+                           for row in occupancy.data}
+        self._window_start = window_start
+        self._loaded_at = time.time()
+        self._slots = None
+
+    def _build_slots(self):
+        """Build the slot list from the compiled schedules and occupancy index."""
+        slots = []
+
+        for offset in range(BOOKING_WINDOW_DAYS):
+            day = self._window_start + timedelta(days=offset)
+            date_str = day.isoformat()
+            weekday = day.weekday()
+
+            hours = set()
+            for org_id, schedule in self._schedules.items():
+                if schedule[weekday] and self._has_capacity(org_id, date_str):
+                    hours.update(schedule[weekday])
+
+            for hour in sorted(hours):
+                slots.append({
+                    'id': f"{date_str}-{hour:02d}",
+                    'date': date_str,
+                    'time': f"{hour:02d}:00",
+                    'display_date': day.strftime('%A, %B %d'),
+                    'display_time': f"{hour:02d}:00"
+                })
+
+        return slots
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Staff & Doctor Assignment Engine for the Sleep Study Management System
+
+Every booking used to run `app_users.select('id').eq('role', role).limit(1)`
+twice - always returning the same staff member and doctor regardless of
+organization or workload.
+
+This module keeps an in-memory roster per organization instead:
+- Staff and doctors are loaded from organization_memberships with their
+  current open-study counts (booked, active and review states), counted
+  and grouped in the database by assignee_open_study_counts()
+- Each organization keeps one min-heap per role keyed by open-study count,
+  so the least-loaded eligible member is picked in O(log n)
+- Each organization also keeps its member count per role and its open
+  total per role, so choosing the least-loaded organization is O(orgs)
+  rather than a scan of every member under the lock
+- Counts are updated incrementally as studies are assigned or released,
+  and the whole roster is reloaded from the database once its TTL expires
+
+Heap entries are invalidated lazily: when a member's count changes a new
+entry is pushed and stale entries are skipped when they reach the top.
+"""
+
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from query_shapes import shaped_query
+
+# Roster lifetime before it is reloaded from the database
+ROSTER_TTL_SECONDS = int(os.getenv('ASSIGNMENT_ROSTER_TTL', 300))
+
+# Roles eligible for assignment, mapped to the sleep_studies column they fill
+ASSIGNABLE_ROLES = {
+    'staff': 'manager_id',
+    'doctor': 'doctor_id'
+}
+
+# Study states that count towards a member's open workload
+OPEN_STUDY_STATES = ['booked', 'active', 'review']
+
+class OrganizationRoster:
+    """
+    Workload-ordered roster of staff and doctors for one organization.
+
+    Args:
+        organization_id (str): UUID of the organization
+    """
+
+    def __init__(self, organization_id):
+        self.organization_id = organization_id
+        self._heaps = {role: [] for role in ASSIGNABLE_ROLES}
+        self._counts = {}  # user_id -> open study count
+        self._roles = {}   # user_id -> role
+        self._members = {role: 0 for role in ASSIGNABLE_ROLES}     # role -> member count
+        self._open_totals = {role: 0 for role in ASSIGNABLE_ROLES} # role -> open study count
+        self._sequence = itertools.count()
+
+    def add_member(self, user_id, role, open_count=0):
+        """
+        Add a staff member or doctor to the roster.
+
+        Args:
+            user_id (str): UUID of the member
+            role (str): 'staff' or 'doctor'
+            open_count (int): Number of open studies already assigned
+        """
+        if role not in self._heaps or user_id in self._roles:
+            return
+        self._roles[user_id] = role
+        self._members[role] += 1
+        self._set_count(user_id, open_count)
+
+    def has_member(self, user_id):
+        """Check whether a user is on the roster."""
+        return user_id in self._roles
+
+    def has_role(self, role):
+        """Check whether any member with the given role is on the roster."""
+        return self._members.get(role, 0) > 0
+
+    def total_open(self):
+        """Get the total open-study count across the roster's doctors."""
+        return self._open_totals['doctor']
+
+    def pick(self, role):
+        """
+        Pick the least-loaded member for a role and count the new study.
+
+        Args:
+            role (str): 'staff' or 'doctor'
+
+        Returns:
+            str|None: UUID of the chosen member, or None if none are eligible
+        """
+        heap = self._heaps.get(role)
+        while heap:
+            count, _, user_id = heap[0]
+            if self._counts.get(user_id) != count:
+                heapq.heappop(heap)  # Stale entry
+                continue
+            self._set_count(user_id, count + 1)
+            return user_id
+        return None
+
+    def release(self, user_id):
+        """
+        Decrement a member's open-study count (study closed or rolled back).
+
+        Args:
+            user_id (str): UUID of the member
+        """
+        count = self._counts.get(user_id)
+        if count:
+            self._set_count(user_id, count - 1)
+
+    def _set_count(self, user_id, count):
+        role = self._roles[user_id]
+        self._open_totals[role] += count - self._counts.get(user_id, 0)
+        self._counts[user_id] = count
+        heapq.heappush(self._heaps[role],
+                       (count, next(self._sequence), user_id))
+
+class AssignmentEngine:
+    """
+    TTL-cached, incrementally updated assignment of studies to staff and doctors.
+
+    Args:
+        get_client (callable): Returns the Supabase client used to load rosters
+            (service role preferred, since RLS hides other users' memberships)
+        ttl (int): Seconds before the rosters are reloaded from the database
+    """
+
+    def __init__(self, get_client, ttl=ROSTER_TTL_SECONDS):
+        self.get_client = get_client
+        self.ttl = ttl
+        self._rosters = {}
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def assign(self, organization_id=None, eligible=None):
+        """
+        Choose the manager, doctor and organization for a new study.
+
+        When no organization is given, the organization whose doctors carry
+        the lightest open workload (and that has both roles staffed) is used.
+
+        Args:
+            organization_id (str, optional): Organization the study belongs to
+            eligible (iterable, optional): Restrict the choice to these
+                organizations (e.g. those with capacity for the chosen slot)
+
+        Returns:
+            dict|None: {'organization_id', 'manager_id', 'doctor_id'}, or None
+                if no eligible organization/members are available
+        """
+        with self._lock:
+            self._ensure_loaded()
+
+            if organization_id:
+                roster = self._rosters.get(organization_id)
+            else:
+                candidates = [r for r in self._rosters.values()
+                              if r.has_role('staff') and r.has_role('doctor')
+                              and (eligible is None or r.organization_id in eligible)]
+                roster = min(candidates, key=lambda r: r.total_open(), default=None)
+
+            if roster is None:
+                return None
+
+            manager_id = roster.pick('staff')
+            doctor_id = roster.pick('doctor')
+            if not manager_id or not doctor_id:
+                if manager_id:
+                    roster.release(manager_id)
+                if doctor_id:
+                    roster.release(doctor_id)
+                return None
+
+            return {
+                'organization_id': roster.organization_id,
+                'manager_id': manager_id,
+                'doctor_id': doctor_id
+            }
+
+    def find_organization(self, user_id):
+        """
+        Find an organization the given staff member or doctor belongs to.
+
+        Args:
+            user_id (str): UUID of the member
+
+        Returns:
+            str|None: organization_id, or None if the user is on no roster
+        """
+        with self._lock:
+            self._ensure_loaded()
+            for organization_id, roster in self._rosters.items():
+                if roster.has_member(user_id):
+                    return organization_id
+        return None
+
+    def release(self, assignment):
+        """
+        Undo an assignment whose study was not created or has been closed.
+
+        Args:
+            assignment (dict): Value previously returned by assign()
+        """
+        with self._lock:
+            roster = self._rosters.get(assignment.get('organization_id'))
+            if roster is None:
+                return
+            roster.release(assignment.get('manager_id'))
+            roster.release(assignment.get('doctor_id'))
+
+    def invalidate(self):
+        """Force the rosters to be reloaded on the next assignment."""
+        with self._lock:
+            self._loaded_at = 0
+
+    def _ensure_loaded(self):
+        if self._loaded_at and time.time() - self._loaded_at < self.ttl:
+            return
+        try:
+            self._rosters = self._load_rosters()
+            self._loaded_at = time.time()
+        except Exception as e:
+            # Keep serving the previous roster if the reload fails
+            print(f"Error loading assignment roster: {e}")
+
+    def _load_rosters(self):
+        """
+        Load memberships and open-study counts for every organization.
+
+        Two queries in total, regardless of the number of organizations:
+        memberships with each member's role, and one open-study count per
+        assignee (grouped in the database, so the response does not grow
+        with the number of open studies).
+
+        Returns:
+            dict: OrganizationRoster keyed by organization_id
+        """
+        client = self.get_client()
+
+        memberships = shaped_query(client, 'assignment_memberships').execute()
+
+        counts = client.rpc('assignee_open_study_counts', {'states': OPEN_STUDY_STATES}).execute()
+        open_counts = {row['user_id']: row['open_count'] for row in counts.data or []}
+
+        rosters = {}
+        for membership in memberships.data:
+            role = (membership.get('app_users') or {}).get('role')
+            if role not in ASSIGNABLE_ROLES:
+                continue
+            organization_id = membership['organization_id']
+            roster = rosters.setdefault(organization_id, OrganizationRoster(organization_id))
+            roster.add_member(membership['user_id'], role,
+                              open_counts.get(membership['user_id'], 0))
+
+        return rosters
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Study Report Rendering for the Sleep Study Management System
+
+doctor_reports only held a file_url and nothing produced reports, so the
+patient's "Download Report" button had nothing to return. Rendering a
+report reads the study, both questionnaires and the derived recording
+metrics, renders a document and uploads it - far too slow for a request.
+
+This module keeps report generation off the request path and cacheable:
+- The report's inputs (study metadata, survey scores, recording summary
+  and analysis) are collected into one plain dict
+- The inputs, the report template source, REPORT_VERSION and the output
+  format are hashed into a content hash; a doctor_reports row with that
+  hash means the report is already rendered, so unchanged studies are
+  never rendered twice and any change (new analysis, edited template)
+  produces a new report
+- Rendering and the upload to the reports bucket run in the
+  `render_study_report` background job (job_queue.py), whose id is derived
+  from the study and hash, so repeated clicks queue one job
+- Reports are HTML documents with print styles; REPORT_FORMAT=pdf renders
+  them to PDF with the optional `weasyprint` package
+"""
+
+import hashlib
+import json
+import os
+import uuid
+
+REPORT_FORMAT = os.getenv('REPORT_FORMAT', 'html')
+
+# Bump when report content changes in ways the template source does not show
+REPORT_VERSION = 'v1'
+
+REPORT_TEMPLATE = 'reports/study-report.html'
+
+REPORT_CONTENT_TYPES = {
+    'html': 'text/html; charset=utf-8',
+    'pdf': 'application/pdf'
+}
+
+# Namespace for deterministic report job ids
+REPORT_JOB_NAMESPACE = uuid.UUID('6f1d2c8e-8a53-4a5c-9d4e-2f0b7f3c1a90')
+
+def _embedded(value):
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+def collect_report_inputs(study):
+    """
+    Reduce a study row to the values a report shows.
+
+    Only the latest response per questionnaire and the latest recording
+    are used, matching what the dashboards show.
+
+    Args:
+        study (dict): Row selected with the 'study_report_inputs' shape
+
+    Returns:
+        dict: JSON-serializable report inputs
+    """
+    profile = _embedded((study.get('patient') or {}).get('patient_profiles')) or {}
+
+    scores = {}
+    for response in sorted(study.get('survey_responses') or [], key=lambda row: row['created_at']):
+        scores[response['type']] = response['score']
+
+    recordings = sorted(study.get('sleep_data_files') or [], key=lambda row: row['created_at'])
+    recording = recordings[-1] if recordings else None
+    summary = _embedded(recording.get('sleep_data_summaries')) if recording else None
+    analysis = _embedded(recording.get('sleep_study_analyses')) if recording else None
+
+    return {
+        'study_id': study['id'],
+        'start_date': study.get('start_date'),
+        'current_state': study.get('current_state'),
+        'patient_name': profile.get('full_name') or 'Patient',
+        'date_of_birth': profile.get('date_of_birth'),
+        'epworth_score': scores.get('epworth'),
+        'osa50_score': scores.get('osa50'),
+        'recording': {
+            'id': recording['id'],
+            'recording_start': summary.get('recording_start'),
+            'duration_seconds': summary.get('duration_seconds'),
+            'channels': [signal['label'] for signal in summary.get('signals') or []]
+        } if recording and summary else None,
+        'analysis': {key: analysis.get(key) for key in (
+            'ahi', 'odi', 'apnea_count', 'hypopnea_count', 'desaturation_count',
+            'min_spo2', 'mean_spo2', 't90_minutes', 'analyzed_hours', 'algorithm_version'
+        )} if analysis else None
+    }
+
+def get_report_hash(inputs, template_source, report_format=REPORT_FORMAT):
+    """
+    Content hash identifying a rendered report.
+
+    Args:
+        inputs (dict): From collect_report_inputs()
+        template_source (str): Source of the report template
+        report_format (str): 'html' or 'pdf'
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{REPORT_VERSION}\0{report_format}\0".encode('utf-8'))
+    digest.update(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(template_source.encode('utf-8'))
+    return digest.hexdigest()
+
+def get_report_job_id(study_id, content_hash):
+    """Deterministic job id, so one report is queued once however often it is requested."""
+    return str(uuid.uuid5(REPORT_JOB_NAMESPACE, f"{study_id}:{content_hash}"))
+
+def get_report_path(study_id, content_hash, report_format=REPORT_FORMAT):
+    """Object path of a rendered report in the reports bucket."""
+    return f"{study_id}/report-{content_hash[:16]}.{report_format}"
+
+def encode_report(html, report_format=REPORT_FORMAT):
+    """
+    Turn rendered report HTML into the stored document.
+
+    Args:
+        html (str): Rendered report template
+        report_format (str): 'html' or 'pdf'
+
+    Returns:
+        tuple: (bytes, content_type)
+
+    Raises:
+        ValueError: If the format is unknown or PDF support is not installed
+    """
+    if report_format == 'html':
+        return html.encode('utf-8'), REPORT_CONTENT_TYPES['html']
+    if report_format == 'pdf':
+        try:
+            from weasyprint import HTML
+        except ImportError:
+            raise ValueError("REPORT_FORMAT=pdf requires the 'weasyprint' package")
+        return HTML(string=html).write_pdf(), REPORT_CONTENT_TYPES['pdf']
+    raise ValueError(f"Unknown REPORT_FORMAT: {report_format}")
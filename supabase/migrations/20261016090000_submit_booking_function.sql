@@ -0,0 +1,154 @@
+/*
+  Migration: Transactional booking submission function
+  Description: Adds public.submit_booking() so the booking wizard is persisted in one round trip
+  Author: Sleep Study App
+  Created: 2026-10-16 09:00:00 UTC
+
+  Changes:
+  - Add public.submit_booking(booking_data jsonb, ...) returning the new study id
+
+  Rationale:
+  htmx_submit_booking used to make up to eight sequential PostgREST calls (staff and
+  doctor lookups, sleep_studies insert, patient profile read + upsert, two survey
+  inserts and a referral insert) with no transaction around them. A failure part-way
+  left half-written bookings behind. The function performs every write inside the
+  single transaction PostgREST opens for an RPC call, so a booking is either stored
+  completely or not at all.
+
+  Security:
+  The function runs as security definer so it can resolve the assigned staff member,
+  doctor and organization (rows patients cannot read under RLS). It only ever writes
+  rows for auth.uid() and rejects anonymous callers.
+*/
+
+-- =============================================
+-- SUBMIT BOOKING FUNCTION
+-- =============================================
+
+create or replace function public.submit_booking(
+  booking_data jsonb,
+  manager_id uuid default null,
+  doctor_id uuid default null,
+  organization_id uuid default null
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = ''
+as $$
+declare
+  v_patient_id uuid := (select auth.uid());
+  v_manager_id uuid := manager_id;
+  v_doctor_id uuid := doctor_id;
+  v_organization_id uuid := organization_id;
+  v_study_id uuid := gen_random_uuid();
+  v_start_date date := (booking_data->'appointment'->>'date')::date;
+  v_epworth jsonb := booking_data->'epworth_responses';
+  v_osa50 jsonb := booking_data->'osa50_responses';
+  v_referral_url text := booking_data->'referral'->>'file_url';
+begin
+  if v_patient_id is null then
+    raise exception 'submit_booking requires an authenticated user'
+      using errcode = '42501';
+  end if;
+
+  if v_start_date is null then
+    raise exception 'Please complete the appointment time selection (Step 2) before submitting.'
+      using errcode = '22023';
+  end if;
+
+  -- Resolve assignments when the caller did not provide them
+  -- (falls back to the patient themselves, matching the previous test behaviour)
+  if v_manager_id is null then
+    select u.id into v_manager_id
+    from public.app_users u
+    where u.role = 'staff'
+    limit 1;
+  end if;
+
+  if v_doctor_id is null then
+    select u.id into v_doctor_id
+    from public.app_users u
+    where u.role = 'doctor'
+    limit 1;
+  end if;
+
+  v_manager_id := coalesce(v_manager_id, v_patient_id);
+  v_doctor_id := coalesce(v_doctor_id, v_patient_id);
+
+  if v_organization_id is null then
+    select m.organization_id into v_organization_id
+    from public.organization_memberships m
+    where m.user_id = v_manager_id
+    limit 1;
+  end if;
+
+  if v_organization_id is null then
+    select o.id into v_organization_id
+    from public.organizations o
+    order by o.created_at
+    limit 1;
+  end if;
+
+  -- Main sleep study record
+  insert into public.sleep_studies (
+    id, patient_id, manager_id, doctor_id, device_id,
+    current_state, start_date, end_date, organization_id
+  )
+  values (
+    v_study_id, v_patient_id, v_manager_id, v_doctor_id, null,
+    'booked', v_start_date, null, v_organization_id
+  );
+
+  -- Patient profile details
+  if jsonb_typeof(booking_data->'personal_details') = 'object' then
+    insert into public.patient_profiles (user_id, patient_details)
+    values (v_patient_id, booking_data->'personal_details')
+    on conflict (user_id) do update
+      set patient_details = excluded.patient_details;
+  end if;
+
+  -- Epworth survey response (score = sum of item scores, 0-24)
+  if jsonb_typeof(v_epworth) = 'object' and v_epworth <> '{}'::jsonb then
+    insert into public.survey_responses (sleep_study_id, type, answers, score)
+    values (
+      v_study_id,
+      'epworth',
+      v_epworth,
+      (select coalesce(sum(value::int), 0) from jsonb_each_text(v_epworth))
+    );
+  end if;
+
+  -- OSA-50 survey response (score = number of "yes" answers)
+  if jsonb_typeof(v_osa50) = 'object' and v_osa50 <> '{}'::jsonb then
+    insert into public.survey_responses (sleep_study_id, type, answers, score)
+    values (
+      v_study_id,
+      'osa50',
+      v_osa50,
+      (select count(*) from jsonb_each_text(v_osa50) where value = 'yes')
+    );
+  end if;
+
+  -- Referral document
+  if v_referral_url is not null then
+    insert into public.referrals (sleep_study_id, file_url)
+    values (v_study_id, v_referral_url);
+  end if;
+
+  return jsonb_build_object(
+    'study_id', v_study_id,
+    'appointment_date', v_start_date,
+    'manager_id', v_manager_id,
+    'doctor_id', v_doctor_id,
+    'organization_id', v_organization_id
+  );
+end;
+$$;
+
+comment on function public.submit_booking(jsonb, uuid, uuid, uuid) is
+  'Persists a complete booking wizard submission (study, profile, surveys, referral) in one transaction';
+
+-- Only signed-in users may submit bookings
+revoke execute on function public.submit_booking(jsonb, uuid, uuid, uuid) from public, anon;
+grant execute on function public.submit_booking(jsonb, uuid, uuid, uuid) to authenticated;
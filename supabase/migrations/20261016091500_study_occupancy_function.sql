@@ -0,0 +1,50 @@
+/*
+  Migration: Per-day study occupancy function
+  Description: Adds public.study_occupancy() for the appointment slot engine
+  Author: Sleep Study App
+  Created: 2026-10-16 09:15:00 UTC
+
+  Changes:
+  - Add public.study_occupancy(from_date date, to_date date)
+
+  Rationale:
+  Appointment availability must respect organizations.max_concurrent_studies, which
+  needs the number of studies already booked per organization and day. The function
+  returns those counts with one grouped query over the sleep_studies_start_date_idx
+  range instead of shipping every study row to the application.
+
+  Security:
+  Runs as security definer so patients (who cannot read other patients' studies under
+  RLS) still get correct availability. Only aggregate counts are returned.
+*/
+
+-- =============================================
+-- STUDY OCCUPANCY FUNCTION
+-- =============================================
+
+create or replace function public.study_occupancy(
+  from_date date,
+  to_date date
+)
+returns table (
+  organization_id uuid,
+  start_date date,
+  study_count bigint
+)
+language sql
+stable
+security definer
+set search_path = ''
+as $$
+  select s.organization_id, s.start_date, count(*) as study_count
+  from public.sleep_studies s
+  where s.start_date between from_date and to_date
+    and s.current_state <> 'cancelled'
+  group by s.organization_id, s.start_date;
+$$;
+
+comment on function public.study_occupancy(date, date) is
+  'Non-cancelled study counts per organization and start date within a date range';
+
+revoke execute on function public.study_occupancy(date, date) from public, anon;
+grant execute on function public.study_occupancy(date, date) to authenticated, service_role;
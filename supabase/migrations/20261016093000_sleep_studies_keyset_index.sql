@@ -0,0 +1,25 @@
+/*
+  Migration: Keyset pagination index for sleep_studies
+  Description: Replaces sleep_studies_created_at_idx with a (created_at, id) index
+  Author: Sleep Study App
+  Created: 2026-10-16 09:30:00 UTC
+
+  Changes:
+  - Add sleep_studies_created_at_id_idx on (created_at desc, id desc)
+  - Drop sleep_studies_created_at_idx (a prefix of the new index)
+
+  Rationale:
+  The staff and admin studies lists page newest-first with a (created_at, id) cursor.
+  An index matching that ordering lets each page be read as a short index range scan
+  starting at the cursor, so page cost no longer grows with the size of the table.
+  id breaks ties between studies created in the same instant.
+*/
+
+-- =============================================
+-- KEYSET PAGINATION INDEX
+-- =============================================
+
+create index if not exists sleep_studies_created_at_id_idx
+  on public.sleep_studies using btree (created_at desc, id desc);
+
+drop index if exists public.sleep_studies_created_at_idx;
@@ -0,0 +1,23 @@
+/*
+  Migration: Organization-scoped study index
+  Description: Adds a composite (organization_id, current_state, start_date) index on sleep_studies
+  Author: Sleep Study App
+  Created: 2026-10-16 09:45:00 UTC
+
+  Changes:
+  - Add sleep_studies_org_state_start_date_idx on (organization_id, current_state, start_date)
+
+  Rationale:
+  Staff study lists are now filtered with organization_id in (...) plus optional
+  current_state and start_date filters. With the organization as the leading column,
+  each staff request reads only its own tenant's rows as an index range scan, and the
+  state/date filters narrow that range further instead of being applied to every
+  study in the system. sleep_studies.organization_id had no index at all before.
+*/
+
+-- =============================================
+-- ORGANIZATION-SCOPED STUDY INDEX
+-- =============================================
+
+create index if not exists sleep_studies_org_state_start_date_idx
+  on public.sleep_studies using btree (organization_id, current_state, start_date);
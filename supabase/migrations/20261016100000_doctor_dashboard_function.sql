@@ -0,0 +1,133 @@
+/*
+  Migration: Doctor dashboard function
+  Description: Adds public.doctor_dashboard() returning bounded, pre-aggregated dashboard rows
+  Author: Sleep Study App
+  Created: 2026-10-16 10:00:00 UTC
+
+  Changes:
+  - Add public.doctor_dashboard(review_limit, completed_limit, assigned_limit)
+  - Add sleep_studies_doctor_state_updated_at_idx on (doctor_id, current_state, updated_at)
+  - Add sleep_studies_doctor_created_at_idx on (doctor_id, created_at desc)
+
+  Rationale:
+  The doctor dashboard embedded every child row (patient_profiles, survey_responses with
+  answers, sleep_data_files, referrals) for every study ever assigned to the doctor, only
+  to derive a patient name, two scores and two booleans, and then kept three studies per
+  list in Python. The function returns exactly those fields, computed with EXISTS and
+  scalar subqueries, and applies each bucket's LIMIT in the database. Each bucket is an
+  index range scan on the new (doctor_id, ...) indexes, so the cost no longer grows with
+  the doctor's study history.
+
+  Buckets:
+  - review:    studies awaiting review, longest waiting first (with the total review count)
+  - completed: most recently completed studies
+  - assigned:  most recently created studies of any state
+  Rows are ordered by bucket, then by the bucket's own order (an ordinal carried out of
+  each bucket, since union all and the joins do not preserve it).
+
+  Security:
+  Runs as security invoker, so the caller's RLS policies still apply, and only returns
+  studies assigned to auth.uid().
+*/
+
+-- =============================================
+-- INDEXES
+-- =============================================
+
+create index if not exists sleep_studies_doctor_state_updated_at_idx
+  on public.sleep_studies using btree (doctor_id, current_state, updated_at);
+
+create index if not exists sleep_studies_doctor_created_at_idx
+  on public.sleep_studies using btree (doctor_id, created_at desc);
+
+-- =============================================
+-- DOCTOR DASHBOARD FUNCTION
+-- =============================================
+
+create or replace function public.doctor_dashboard(
+  review_limit integer default 3,
+  completed_limit integer default 3,
+  assigned_limit integer default 20
+)
+returns table (
+  bucket text,
+  id uuid,
+  patient_name text,
+  current_state public.study_state,
+  start_date date,
+  updated_at timestamptz,
+  epworth_score integer,
+  osa50_score integer,
+  has_referrals boolean,
+  has_sleep_data boolean,
+  bucket_total bigint
+)
+language sql
+stable
+security invoker
+set search_path = ''
+as $$
+  with review as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by s.updated_at) as ordinal
+    from public.sleep_studies s
+    where s.doctor_id = (select auth.uid())
+      and s.current_state = 'review'
+    order by s.updated_at
+    limit review_limit
+  ),
+  completed as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by s.updated_at desc) as ordinal
+    from public.sleep_studies s
+    where s.doctor_id = (select auth.uid())
+      and s.current_state = 'completed'
+    order by s.updated_at desc
+    limit completed_limit
+  ),
+  assigned as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by s.created_at desc) as ordinal
+    from public.sleep_studies s
+    where s.doctor_id = (select auth.uid())
+    order by s.created_at desc
+    limit assigned_limit
+  ),
+  buckets as (
+    select 'review' as bucket, r.* from review r
+    union all
+    select 'completed' as bucket, c.* from completed c
+    union all
+    select 'assigned' as bucket, a.* from assigned a
+  )
+  select
+    b.bucket,
+    b.id,
+    p.patient_details->>'full_name' as patient_name,
+    b.current_state,
+    b.start_date,
+    b.updated_at,
+    (select sr.score from public.survey_responses sr
+      where sr.sleep_study_id = b.id and sr.type = 'epworth'
+      order by sr.created_at desc limit 1) as epworth_score,
+    (select sr.score from public.survey_responses sr
+      where sr.sleep_study_id = b.id and sr.type = 'osa50'
+      order by sr.created_at desc limit 1) as osa50_score,
+    exists (select 1 from public.referrals rf where rf.sleep_study_id = b.id) as has_referrals,
+    exists (select 1 from public.sleep_data_files df where df.sleep_study_id = b.id) as has_sleep_data,
+    case when b.bucket = 'review' then (
+      select count(*) from public.sleep_studies s
+      where s.doctor_id = (select auth.uid())
+        and s.current_state = 'review'
+    ) end as bucket_total
+  from buckets b
+  left join public.patient_profiles p on p.user_id = b.patient_id
+  -- union all and the joins do not keep the CTE order
+  order by b.bucket, b.ordinal;
+$$;
+
+comment on function public.doctor_dashboard(integer, integer, integer) is
+  'Bounded doctor dashboard buckets (review, completed, assigned) with scores and attachment flags';
+
+revoke execute on function public.doctor_dashboard(integer, integer, integer) from public, anon;
+grant execute on function public.doctor_dashboard(integer, integer, integer) to authenticated;
@@ -0,0 +1,184 @@
+/*
+  Migration: Organization summaries
+  Description: Adds a trigger-maintained per-organization summary for the staff dashboard
+  Author: Sleep Study App
+  Created: 2026-10-16 10:15:00 UTC
+
+  Changes:
+  - Add public.organization_summaries (one row per organization)
+  - Add public.refresh_organization_summaries(org_ids uuid[])
+  - Add refresh triggers on devices, sleep_studies and organizations
+  - Backfill summaries for existing organizations
+
+  Rationale:
+  The staff dashboard showed hard-coded device and capacity numbers, and its device
+  status widget polls every 30 seconds. Computing the numbers on each poll would scan
+  the organization's devices and studies every time. The summary row is recomputed
+  with one grouped aggregate only when a device, study or organization changes, and
+  every poll becomes a primary-key read.
+
+  Contents:
+  - devices_available / devices_assigned: device counts by device_status
+  - active_studies: studies in the 'active' state (compared to max_concurrent_studies)
+  - week_bookings: non-cancelled studies starting in the current week (Monday-Sunday)
+  - week_start: week that week_bookings refers to; readers refresh rows from a past week
+
+  Security:
+  Staff and doctors can read summaries of organizations they belong to. Only triggers
+  and the service role refresh summaries.
+*/
+
+-- =============================================
+-- ORGANIZATION SUMMARIES TABLE
+-- =============================================
+
+create table if not exists public.organization_summaries (
+  organization_id uuid primary key references public.organizations(id) on delete cascade,
+  devices_available integer not null default 0,
+  devices_assigned integer not null default 0,
+  active_studies integer not null default 0,
+  week_bookings integer not null default 0,
+  max_concurrent_studies integer not null default 10,
+  week_start date not null,
+  refreshed_at timestamptz not null default now()
+);
+
+comment on table public.organization_summaries is
+  'Per-organization device, booking and capacity counts maintained by triggers for the staff dashboard';
+
+alter table public.organization_summaries enable row level security;
+
+create policy "Members can view their organization summaries"
+  on public.organization_summaries
+  for select
+  to authenticated
+  using (
+    organization_id in (
+      select organization_id
+      from public.organization_memberships
+      where user_id = (select auth.uid())
+    )
+  );
+
+-- =============================================
+-- REFRESH FUNCTION
+-- =============================================
+
+-- Recompute summaries for the given organizations (all organizations when null)
+create or replace function public.refresh_organization_summaries(
+  org_ids uuid[] default null
+)
+returns void
+language sql
+security definer
+set search_path = ''
+as $$
+  with week as (
+    select date_trunc('week', current_date)::date as week_start
+  ),
+  device_counts as (
+    select d.organization_id,
+           count(*) filter (where d.status = 'available') as available,
+           count(*) filter (where d.status = 'assigned') as assigned
+    from public.devices d
+    where org_ids is null or d.organization_id = any(org_ids)
+    group by d.organization_id
+  ),
+  study_counts as (
+    select s.organization_id,
+           count(*) filter (where s.current_state = 'active') as active,
+           count(*) filter (where s.current_state <> 'cancelled'
+                              and s.start_date >= w.week_start
+                              and s.start_date < w.week_start + 7) as week_bookings
+    from public.sleep_studies s
+    cross join week w
+    where (org_ids is null or s.organization_id = any(org_ids))
+      and (s.current_state = 'active'
+           or (s.start_date >= w.week_start and s.start_date < w.week_start + 7))
+    group by s.organization_id
+  )
+  insert into public.organization_summaries as os (
+    organization_id, devices_available, devices_assigned, active_studies,
+    week_bookings, max_concurrent_studies, week_start, refreshed_at
+  )
+  select o.id,
+         coalesce(dc.available, 0),
+         coalesce(dc.assigned, 0),
+         coalesce(sc.active, 0),
+         coalesce(sc.week_bookings, 0),
+         coalesce(o.max_concurrent_studies, 10),
+         w.week_start,
+         now()
+  from public.organizations o
+  cross join week w
+  left join device_counts dc on dc.organization_id = o.id
+  left join study_counts sc on sc.organization_id = o.id
+  where org_ids is null or o.id = any(org_ids)
+  on conflict (organization_id) do update set
+    devices_available = excluded.devices_available,
+    devices_assigned = excluded.devices_assigned,
+    active_studies = excluded.active_studies,
+    week_bookings = excluded.week_bookings,
+    max_concurrent_studies = excluded.max_concurrent_studies,
+    week_start = excluded.week_start,
+    refreshed_at = excluded.refreshed_at;
+$$;
+
+comment on function public.refresh_organization_summaries(uuid[]) is
+  'Recomputes organization_summaries rows for the given organizations (all when null)';
+
+revoke execute on function public.refresh_organization_summaries(uuid[]) from public, anon, authenticated;
+grant execute on function public.refresh_organization_summaries(uuid[]) to service_role;
+
+-- =============================================
+-- REFRESH TRIGGERS
+-- =============================================
+
+-- Refresh the organization(s) touched by a changed device, study or organization row
+create or replace function public.refresh_organization_summary_trigger()
+returns trigger
+language plpgsql
+security definer
+set search_path = ''
+as $$
+declare
+  v_org_ids uuid[];
+begin
+  if tg_table_name = 'organizations' then
+    v_org_ids := array[new.id];
+  elsif tg_op = 'INSERT' then
+    v_org_ids := array[new.organization_id];
+  elsif tg_op = 'DELETE' then
+    v_org_ids := array[old.organization_id];
+  else
+    v_org_ids := array(select distinct unnest(array[old.organization_id, new.organization_id]));
+  end if;
+
+  perform public.refresh_organization_summaries(v_org_ids);
+  return null;
+end;
+$$;
+
+create trigger refresh_organization_summary_on_devices
+  after insert or delete or update of status, organization_id
+  on public.devices
+  for each row
+  execute function public.refresh_organization_summary_trigger();
+
+create trigger refresh_organization_summary_on_sleep_studies
+  after insert or delete or update of current_state, start_date, organization_id
+  on public.sleep_studies
+  for each row
+  execute function public.refresh_organization_summary_trigger();
+
+create trigger refresh_organization_summary_on_organizations
+  after insert or update of max_concurrent_studies
+  on public.organizations
+  for each row
+  execute function public.refresh_organization_summary_trigger();
+
+-- =============================================
+-- BACKFILL
+-- =============================================
+
+select public.refresh_organization_summaries();
@@ -0,0 +1,76 @@
+/*
+  Migration: Sleep data summaries
+  Description: Adds per-epoch summary metadata for ingested sleep recordings
+  Author: Sleep Study App
+  Created: 2026-10-16 10:30:00 UTC
+
+  Changes:
+  - Add public.sleep_data_summaries (one row per sleep_data_files row)
+  - Add sleep_data_summaries_sleep_study_id_idx
+
+  Rationale:
+  Overnight EDF recordings are hundreds of megabytes and were stored only as opaque file
+  URLs, so reviewing a study meant downloading the raw file. Ingestion now reduces each
+  signal to per-epoch statistics (min, max, mean, std) in one float32 array stored as an
+  .npy object next to the recording (summary_path, a few hundred KB at most). This table
+  describes that array: its shape (signals x epoch_count x stats), the signal labels,
+  units and sample rates, and the recording start and length.
+
+  Security:
+  Mirrors sleep_data_files: the study's manager and doctor can read summaries, and only
+  the study's manager can write them.
+*/
+
+-- =============================================
+-- SLEEP DATA SUMMARIES TABLE
+-- =============================================
+
+create table if not exists public.sleep_data_summaries (
+  sleep_data_file_id uuid primary key references public.sleep_data_files(id) on delete cascade,
+  sleep_study_id uuid not null references public.sleep_studies(id) on delete cascade,
+  summary_path text not null,
+  epoch_seconds integer not null,
+  epoch_count integer not null,
+  stats text[] not null,
+  signals jsonb not null,
+  recording_start timestamptz,
+  duration_seconds numeric not null,
+  created_at timestamptz default now() not null
+);
+
+comment on table public.sleep_data_summaries is
+  'Per-epoch signal summaries derived from ingested sleep recordings (array stored at summary_path)';
+comment on column public.sleep_data_summaries.signals is
+  'Signals in array order: [{label, unit, sample_rate}]';
+comment on column public.sleep_data_summaries.stats is
+  'Statistics along the last array axis, e.g. {min,max,mean,std}';
+
+create index if not exists sleep_data_summaries_sleep_study_id_idx
+  on public.sleep_data_summaries using btree (sleep_study_id);
+
+-- Enable RLS
+alter table public.sleep_data_summaries enable row level security;
+
+create policy "Staff and doctors can view summaries for their studies"
+  on public.sleep_data_summaries
+  for select
+  to authenticated
+  using (
+    sleep_study_id in (
+      select id
+      from public.sleep_studies
+      where manager_id = (select auth.uid()) or doctor_id = (select auth.uid())
+    )
+  );
+
+create policy "Staff can manage summaries for studies they manage"
+  on public.sleep_data_summaries
+  for all
+  to authenticated
+  using (
+    sleep_study_id in (
+      select id
+      from public.sleep_studies
+      where manager_id = (select auth.uid())
+    )
+  );
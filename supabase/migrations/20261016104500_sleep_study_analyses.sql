@@ -0,0 +1,219 @@
+/*
+  Migration: Sleep study analyses
+  Description: Stores respiratory/oximetry indices per recording and uses them for doctor triage
+  Author: Sleep Study App
+  Created: 2026-10-16 10:45:00 UTC
+
+  Changes:
+  - Add public.sleep_study_analyses (one row per analyzed sleep_data_files row)
+  - Add sleep_study_analyses_study_created_at_idx on (sleep_study_id, created_at desc)
+  - Add trigger touching sleep_studies.updated_at when an analysis is stored
+  - Replace public.doctor_dashboard() to return ahi/odi and rank severe studies first
+
+  Rationale:
+  Triage used questionnaire thresholds only. Ingestion now detects apneas, hypopneas and
+  desaturations in the recording (sleep_analysis.py) and stores AHI/ODI-style indices
+  with the detected events. The doctor dashboard returns the latest indices per study
+  and lists review studies with AHI >= 30 before the longest-waiting ones.
+
+  Touching sleep_studies.updated_at changes the doctor's pending-review fingerprint,
+  so polled fragments pick up new results instead of answering 304.
+
+  Indices:
+  - ahi: apneas + hypopneas per hour of usable airflow (no sleep staging, so a
+    respiratory event index rather than a polysomnography AHI)
+  - odi: >= 3% desaturations per hour of valid oximetry
+  - events: [[start_seconds, duration_seconds, 'apnea'|'hypopnea'|'desaturation'], ...]
+
+  Security:
+  Mirrors sleep_data_files: the study's manager and doctor can read analyses, and only
+  the study's manager can write them. doctor_dashboard() remains security invoker.
+*/
+
+-- =============================================
+-- SLEEP STUDY ANALYSES TABLE
+-- =============================================
+
+create table if not exists public.sleep_study_analyses (
+  sleep_data_file_id uuid primary key references public.sleep_data_files(id) on delete cascade,
+  sleep_study_id uuid not null references public.sleep_studies(id) on delete cascade,
+  ahi numeric,
+  odi numeric,
+  apnea_count integer not null default 0,
+  hypopnea_count integer not null default 0,
+  desaturation_count integer not null default 0,
+  min_spo2 numeric,
+  mean_spo2 numeric,
+  t90_minutes numeric,
+  analyzed_hours numeric not null,
+  events jsonb not null default '[]'::jsonb,
+  spo2_channel text,
+  airflow_channel text,
+  algorithm_version text not null,
+  created_at timestamptz default now() not null
+);
+
+comment on table public.sleep_study_analyses is
+  'Respiratory and oximetry indices (AHI/ODI-style) and events detected in ingested recordings';
+
+create index if not exists sleep_study_analyses_study_created_at_idx
+  on public.sleep_study_analyses using btree (sleep_study_id, created_at desc);
+
+-- Enable RLS
+alter table public.sleep_study_analyses enable row level security;
+
+create policy "Staff and doctors can view analyses for their studies"
+  on public.sleep_study_analyses
+  for select
+  to authenticated
+  using (
+    sleep_study_id in (
+      select id
+      from public.sleep_studies
+      where manager_id = (select auth.uid()) or doctor_id = (select auth.uid())
+    )
+  );
+
+create policy "Staff can manage analyses for studies they manage"
+  on public.sleep_study_analyses
+  for all
+  to authenticated
+  using (
+    sleep_study_id in (
+      select id
+      from public.sleep_studies
+      where manager_id = (select auth.uid())
+    )
+  );
+
+-- =============================================
+-- STUDY TOUCH TRIGGER
+-- =============================================
+
+create or replace function public.touch_sleep_study_on_analysis()
+returns trigger
+language plpgsql
+security definer
+set search_path = ''
+as $$
+begin
+  update public.sleep_studies
+  set updated_at = now()
+  where id = new.sleep_study_id;
+  return null;
+end;
+$$;
+
+create trigger touch_sleep_study_on_analysis
+  after insert on public.sleep_study_analyses
+  for each row
+  execute function public.touch_sleep_study_on_analysis();
+
+-- =============================================
+-- DOCTOR DASHBOARD FUNCTION
+-- =============================================
+
+-- The return type changes, so the function must be dropped first
+drop function if exists public.doctor_dashboard(integer, integer, integer);
+
+create or replace function public.doctor_dashboard(
+  review_limit integer default 3,
+  completed_limit integer default 3,
+  assigned_limit integer default 20
+)
+returns table (
+  bucket text,
+  id uuid,
+  patient_name text,
+  current_state public.study_state,
+  start_date date,
+  updated_at timestamptz,
+  epworth_score integer,
+  osa50_score integer,
+  has_referrals boolean,
+  has_sleep_data boolean,
+  ahi numeric,
+  odi numeric,
+  bucket_total bigint
+)
+language sql
+stable
+security invoker
+set search_path = ''
+as $$
+  with review as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by coalesce(latest.ahi >= 30, false) desc, s.updated_at) as ordinal
+    from public.sleep_studies s
+    left join lateral (
+      select sa.ahi from public.sleep_study_analyses sa
+      where sa.sleep_study_id = s.id
+      order by sa.created_at desc limit 1
+    ) latest on true
+    where s.doctor_id = (select auth.uid())
+      and s.current_state = 'review'
+    order by coalesce(latest.ahi >= 30, false) desc, s.updated_at
+    limit review_limit
+  ),
+  completed as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by s.updated_at desc) as ordinal
+    from public.sleep_studies s
+    where s.doctor_id = (select auth.uid())
+      and s.current_state = 'completed'
+    order by s.updated_at desc
+    limit completed_limit
+  ),
+  assigned as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by s.created_at desc) as ordinal
+    from public.sleep_studies s
+    where s.doctor_id = (select auth.uid())
+    order by s.created_at desc
+    limit assigned_limit
+  ),
+  buckets as (
+    select 'review' as bucket, r.* from review r
+    union all
+    select 'completed' as bucket, c.* from completed c
+    union all
+    select 'assigned' as bucket, a.* from assigned a
+  )
+  select
+    b.bucket,
+    b.id,
+    p.patient_details->>'full_name' as patient_name,
+    b.current_state,
+    b.start_date,
+    b.updated_at,
+    (select sr.score from public.survey_responses sr
+      where sr.sleep_study_id = b.id and sr.type = 'epworth'
+      order by sr.created_at desc limit 1) as epworth_score,
+    (select sr.score from public.survey_responses sr
+      where sr.sleep_study_id = b.id and sr.type = 'osa50'
+      order by sr.created_at desc limit 1) as osa50_score,
+    exists (select 1 from public.referrals rf where rf.sleep_study_id = b.id) as has_referrals,
+    exists (select 1 from public.sleep_data_files df where df.sleep_study_id = b.id) as has_sleep_data,
+    latest.ahi,
+    latest.odi,
+    case when b.bucket = 'review' then (
+      select count(*) from public.sleep_studies s
+      where s.doctor_id = (select auth.uid())
+        and s.current_state = 'review'
+    ) end as bucket_total
+  from buckets b
+  left join public.patient_profiles p on p.user_id = b.patient_id
+  left join lateral (
+    select sa.ahi, sa.odi from public.sleep_study_analyses sa
+    where sa.sleep_study_id = b.id
+    order by sa.created_at desc limit 1
+  ) latest on true
+  -- union all and the joins do not keep the CTE order
+  order by b.bucket, b.ordinal;
+$$;
+
+comment on function public.doctor_dashboard(integer, integer, integer) is
+  'Bounded doctor dashboard buckets (review, completed, assigned) with scores, attachment flags and latest AHI/ODI';
+
+revoke execute on function public.doctor_dashboard(integer, integer, integer) from public, anon;
+grant execute on function public.doctor_dashboard(integer, integer, integer) to authenticated;
@@ -0,0 +1,146 @@
+/*
+  Migration: Background jobs
+  Description: Durable job queue table and claim/complete/fail functions for `flask worker`
+  Author: Sleep Study App
+  Created: 2026-10-16 11:00:00 UTC
+
+  Changes:
+  - Add public.jobs
+  - Add jobs_queue_ready_idx on (queue, run_at) for unfinished jobs
+  - Add public.claim_jobs(), public.complete_job() and public.fail_job()
+
+  Rationale:
+  Recording ingestion and other slow work ran on the request thread. Request handlers now
+  enqueue a job (job_queue.py) and return; `flask worker` processes claim jobs with
+  claim_jobs(), which locks ready rows with `for update skip locked` so concurrent workers
+  never claim the same job and never wait on each other. A claimed job is hidden until
+  locked_until (the visibility timeout); if its worker dies it becomes claimable again.
+  Failed attempts are requeued with a backoff delay chosen by the worker, or marked failed
+  once retries are exhausted. Completed jobs are deleted.
+
+  When a per-queue limit is passed, claims for that queue are serialized with a
+  transaction-level advisory lock so the count of running jobs cannot be raced.
+
+  Security:
+  RLS is enabled with no policies and the functions are only executable by service_role:
+  jobs are created and processed server-side with the service-role key only.
+*/
+
+-- =============================================
+-- JOBS TABLE
+-- =============================================
+
+create table if not exists public.jobs (
+  id uuid primary key default gen_random_uuid(),
+  queue text not null default 'default',
+  task text not null,
+  payload jsonb not null default '{}'::jsonb,
+  status text not null default 'queued' check (status in ('queued', 'running', 'failed')),
+  attempts integer not null default 0,
+  max_attempts integer not null default 5,
+  run_at timestamptz not null default now(),
+  locked_until timestamptz,
+  locked_by text,
+  last_error text,
+  created_at timestamptz default now() not null
+);
+
+comment on table public.jobs is 'Durable background jobs processed by `flask worker`';
+
+create index if not exists jobs_queue_ready_idx
+  on public.jobs using btree (queue, run_at)
+  where status <> 'failed';
+
+-- Enable RLS (no policies: service role only)
+alter table public.jobs enable row level security;
+
+-- =============================================
+-- JOB FUNCTIONS
+-- =============================================
+
+create or replace function public.claim_jobs(
+  queue_name text,
+  worker_id text,
+  max_jobs integer,
+  visibility_seconds integer,
+  queue_limit integer default null
+)
+returns setof public.jobs
+language plpgsql
+security invoker
+set search_path = ''
+as $$
+declare
+  available integer := max_jobs;
+begin
+  if queue_limit is not null then
+    perform pg_advisory_xact_lock(hashtext('jobs:' || queue_name));
+    select least(max_jobs, queue_limit - count(*)) into available
+    from public.jobs j
+    where j.queue = queue_name
+      and j.status = 'running'
+      and j.locked_until > now();
+  end if;
+
+  if available <= 0 then
+    return;
+  end if;
+
+  return query
+  update public.jobs j
+  set status = 'running',
+      attempts = j.attempts + 1,
+      locked_until = now() + make_interval(secs => visibility_seconds),
+      locked_by = worker_id
+  where j.id in (
+    select r.id
+    from public.jobs r
+    where r.queue = queue_name
+      and ((r.status = 'queued' and r.run_at <= now())
+        or (r.status = 'running' and r.locked_until <= now()))
+    order by r.run_at
+    limit available
+    for update skip locked
+  )
+  returning j.*;
+end;
+$$;
+
+create or replace function public.complete_job(job_id uuid)
+returns void
+language sql
+security invoker
+set search_path = ''
+as $$
+  delete from public.jobs where id = job_id;
+$$;
+
+create or replace function public.fail_job(
+  job_id uuid,
+  error text,
+  retry_delay_seconds integer default null
+)
+returns void
+language sql
+security invoker
+set search_path = ''
+as $$
+  update public.jobs
+  set status = case when retry_delay_seconds is null then 'failed' else 'queued' end,
+      run_at = case when retry_delay_seconds is null then run_at
+                    else now() + make_interval(secs => retry_delay_seconds) end,
+      locked_until = null,
+      locked_by = null,
+      last_error = error
+  where id = job_id;
+$$;
+
+comment on function public.claim_jobs(text, text, integer, integer, integer) is
+  'Claim up to max_jobs ready jobs of a queue for visibility_seconds (skip locked, optional queue-wide limit)';
+
+revoke execute on function public.claim_jobs(text, text, integer, integer, integer) from public, anon, authenticated;
+revoke execute on function public.complete_job(uuid) from public, anon, authenticated;
+revoke execute on function public.fail_job(uuid, text, integer) from public, anon, authenticated;
+grant execute on function public.claim_jobs(text, text, integer, integer, integer) to service_role;
+grant execute on function public.complete_job(uuid) to service_role;
+grant execute on function public.fail_job(uuid, text, integer) to service_role;
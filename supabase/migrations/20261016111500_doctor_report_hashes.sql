@@ -0,0 +1,33 @@
+/*
+  Migration: Doctor report content hashes
+  Description: Keys rendered study reports by a content hash of their inputs
+  Author: Sleep Study App
+  Created: 2026-10-16 11:15:00 UTC
+
+  Changes:
+  - Add doctor_reports.content_hash and doctor_reports.report_path
+  - Add doctor_reports_study_content_hash_key unique index on (sleep_study_id, content_hash)
+
+  Rationale:
+  Reports are rendered by the `render_study_report` background job from the study,
+  survey scores and recording analysis (study_reports.py). The hash of those inputs and
+  the report template identifies a rendered report: a request first looks for a row with
+  the current hash and only queues rendering when none exists, so unchanged studies are
+  never rendered twice. report_path is the object path in the reports bucket.
+
+  Existing rows (no hash) are left as they are.
+
+  Security:
+  No policy changes. Reports are written by the worker with the service role; patients,
+  managers and doctors keep their existing read access.
+*/
+
+alter table public.doctor_reports
+  add column if not exists content_hash text,
+  add column if not exists report_path text;
+
+create unique index if not exists doctor_reports_study_content_hash_key
+  on public.doctor_reports using btree (sleep_study_id, content_hash);
+
+comment on column public.doctor_reports.content_hash is
+  'SHA-256 of the report inputs, template and format (study_reports.get_report_hash)';
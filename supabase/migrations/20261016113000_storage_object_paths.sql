@@ -0,0 +1,43 @@
+/*
+  Migration: Storage object paths
+  Description: Stores object paths instead of public URLs for private bucket files
+  Author: Sleep Study App
+  Created: 2026-10-16 11:30:00 UTC
+
+  Changes:
+  - Rewrite referrals.file_url, sleep_data_files.file_url and doctor_reports.file_url
+    values that hold a public Storage URL to the object path in the bucket
+  - Document the new meaning of the three file_url columns
+
+  Rationale:
+  All buckets are private, so the public URLs stored until now could not be opened.
+  The app now stores the path and signs links when it renders them, batching every
+  link of a page into one create_signed_urls() call per bucket and caching the signed
+  URLs until shortly before they expire (signed_urls.py). Signed URLs expire, so they
+  are never stored.
+
+  Security:
+  No policy changes. Links are only signed for rows the user could already read
+  through RLS, and each signed URL expires after SIGNED_URL_TTL seconds.
+*/
+
+update public.referrals
+  set file_url = regexp_replace(file_url, '^.*/storage/v1/object/public/[^/]+/([^?]*).*$', '\1')
+  where file_url like '%/storage/v1/object/public/%';
+
+update public.sleep_data_files
+  set file_url = regexp_replace(file_url, '^.*/storage/v1/object/public/[^/]+/([^?]*).*$', '\1')
+  where file_url like '%/storage/v1/object/public/%';
+
+update public.doctor_reports
+  set file_url = regexp_replace(file_url, '^.*/storage/v1/object/public/[^/]+/([^?]*).*$', '\1')
+  where file_url like '%/storage/v1/object/public/%';
+
+comment on column public.referrals.file_url is
+  'Object path in the referrals bucket (links are signed when shown)';
+
+comment on column public.sleep_data_files.file_url is
+  'Object path of the raw recording in the sleep-data bucket';
+
+comment on column public.doctor_reports.file_url is
+  'Object path in the reports bucket (links are signed when shown)';
@@ -0,0 +1,207 @@
+/*
+  Migration: Validate submit_booking assignments
+  Description: submit_booking() only accepts staff, doctor and organization ids that belong together
+  Author: Sleep Study App
+  Created: 2026-10-16 11:45:00 UTC
+
+  Changes:
+  - Replace public.submit_booking(booking_data jsonb, manager_id, doctor_id, organization_id)
+  - Passed ids are validated: manager_id must be a staff member and doctor_id a doctor,
+    both members of organization_id (organization_memberships)
+  - Missing ids are resolved server-side (least-loaded staff member / doctor of the
+    organization); the patient is never used as a fallback
+  - Bookings that cannot be assigned raise an error instead of being stored
+
+  Rationale:
+  The function runs as security definer and is executable by every signed-in user, so
+  its arguments are untrusted. The previous version stored whatever manager_id,
+  doctor_id and organization_id the caller sent and fell back to the patient's own uid.
+  A patient calling the RPC directly could make themselves the "manager" of their study
+  and pass the manager RLS policies on sleep_data_files, summaries and analyses.
+
+  Security:
+  The caller can still suggest an assignment (the app passes its least-loaded choice),
+  but only assignments that are valid for the organization are written. Errors use
+  errcode 42501 for rejected ids and P0001 when no assignment is possible.
+*/
+
+-- =============================================
+-- SUBMIT BOOKING FUNCTION
+-- =============================================
+
+create or replace function public.submit_booking(
+  booking_data jsonb,
+  manager_id uuid default null,
+  doctor_id uuid default null,
+  organization_id uuid default null
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = ''
+as $$
+declare
+  v_patient_id uuid := (select auth.uid());
+  v_manager_id uuid := manager_id;
+  v_doctor_id uuid := doctor_id;
+  v_organization_id uuid := organization_id;
+  v_study_id uuid := gen_random_uuid();
+  v_start_date date := (booking_data->'appointment'->>'date')::date;
+  v_epworth jsonb := booking_data->'epworth_responses';
+  v_osa50 jsonb := booking_data->'osa50_responses';
+  v_referral_url text := booking_data->'referral'->>'file_url';
+begin
+  if v_patient_id is null then
+    raise exception 'submit_booking requires an authenticated user'
+      using errcode = '42501';
+  end if;
+
+  if v_start_date is null then
+    raise exception 'Please complete the appointment time selection (Step 2) before submitting.'
+      using errcode = '22023';
+  end if;
+
+  -- Organization: the one shared by the suggested staff member and doctor,
+  -- else the first organization that has both a staff member and a doctor
+  if v_organization_id is null then
+    select o.id into v_organization_id
+    from public.organizations o
+    where exists (
+        select 1
+        from public.organization_memberships m
+        join public.app_users u on u.id = m.user_id
+        where m.organization_id = o.id
+          and u.role = 'staff'
+          and (v_manager_id is null or u.id = v_manager_id)
+      )
+      and exists (
+        select 1
+        from public.organization_memberships m
+        join public.app_users u on u.id = m.user_id
+        where m.organization_id = o.id
+          and u.role = 'doctor'
+          and (v_doctor_id is null or u.id = v_doctor_id)
+      )
+    order by o.created_at
+    limit 1;
+  end if;
+
+  if v_organization_id is null then
+    raise exception 'No organization is available to take this booking'
+      using errcode = 'P0001';
+  end if;
+
+  -- Resolve missing assignments to the least-loaded member of the organization
+  if v_manager_id is null then
+    select u.id into v_manager_id
+    from public.organization_memberships m
+    join public.app_users u on u.id = m.user_id
+    where m.organization_id = v_organization_id
+      and u.role = 'staff'
+    order by (
+      select count(*) from public.sleep_studies s
+      where s.manager_id = u.id and s.current_state <> 'completed'
+    ), u.id
+    limit 1;
+  end if;
+
+  if v_doctor_id is null then
+    select u.id into v_doctor_id
+    from public.organization_memberships m
+    join public.app_users u on u.id = m.user_id
+    where m.organization_id = v_organization_id
+      and u.role = 'doctor'
+    order by (
+      select count(*) from public.sleep_studies s
+      where s.doctor_id = u.id and s.current_state <> 'completed'
+    ), u.id
+    limit 1;
+  end if;
+
+  -- Never trust passed ids: both must hold the right role in the organization
+  if v_manager_id is null or not exists (
+    select 1
+    from public.organization_memberships m
+    join public.app_users u on u.id = m.user_id
+    where m.user_id = v_manager_id
+      and m.organization_id = v_organization_id
+      and u.role = 'staff'
+  ) then
+    raise exception 'Invalid staff assignment for this booking'
+      using errcode = '42501';
+  end if;
+
+  if v_doctor_id is null or not exists (
+    select 1
+    from public.organization_memberships m
+    join public.app_users u on u.id = m.user_id
+    where m.user_id = v_doctor_id
+      and m.organization_id = v_organization_id
+      and u.role = 'doctor'
+  ) then
+    raise exception 'Invalid doctor assignment for this booking'
+      using errcode = '42501';
+  end if;
+
+  -- Main sleep study record
+  insert into public.sleep_studies (
+    id, patient_id, manager_id, doctor_id, device_id,
+    current_state, start_date, end_date, organization_id
+  )
+  values (
+    v_study_id, v_patient_id, v_manager_id, v_doctor_id, null,
+    'booked', v_start_date, null, v_organization_id
+  );
+
+  -- Patient profile details
+  if jsonb_typeof(booking_data->'personal_details') = 'object' then
+    insert into public.patient_profiles (user_id, patient_details)
+    values (v_patient_id, booking_data->'personal_details')
+    on conflict (user_id) do update
+      set patient_details = excluded.patient_details;
+  end if;
+
+  -- Epworth survey response (score = sum of item scores, 0-24)
+  if jsonb_typeof(v_epworth) = 'object' and v_epworth <> '{}'::jsonb then
+    insert into public.survey_responses (sleep_study_id, type, answers, score)
+    values (
+      v_study_id,
+      'epworth',
+      v_epworth,
+      (select coalesce(sum(value::int), 0) from jsonb_each_text(v_epworth))
+    );
+  end if;
+
+  -- OSA-50 survey response (score = number of "yes" answers)
+  if jsonb_typeof(v_osa50) = 'object' and v_osa50 <> '{}'::jsonb then
+    insert into public.survey_responses (sleep_study_id, type, answers, score)
+    values (
+      v_study_id,
+      'osa50',
+      v_osa50,
+      (select count(*) from jsonb_each_text(v_osa50) where value = 'yes')
+    );
+  end if;
+
+  -- Referral document
+  if v_referral_url is not null then
+    insert into public.referrals (sleep_study_id, file_url)
+    values (v_study_id, v_referral_url);
+  end if;
+
+  return jsonb_build_object(
+    'study_id', v_study_id,
+    'appointment_date', v_start_date,
+    'manager_id', v_manager_id,
+    'doctor_id', v_doctor_id,
+    'organization_id', v_organization_id
+  );
+end;
+$$;
+
+comment on function public.submit_booking(jsonb, uuid, uuid, uuid) is
+  'Persists a complete booking wizard submission (study, profile, surveys, referral) in one transaction; assignments are validated against organization_memberships';
+
+-- Only signed-in users may submit bookings
+revoke execute on function public.submit_booking(jsonb, uuid, uuid, uuid) from public, anon;
+grant execute on function public.submit_booking(jsonb, uuid, uuid, uuid) to authenticated;
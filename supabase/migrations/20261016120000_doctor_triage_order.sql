@@ -0,0 +1,145 @@
+/*
+  Migration: Doctor triage order
+  Description: Lists review studies in doctor_dashboard() by the same priority rule the dashboard shows
+  Author: Sleep Study App
+  Created: 2026-10-16 12:00:00 UTC
+
+  Changes:
+  - Replace public.doctor_dashboard() (same signature and columns): the review bucket
+    is ordered high priority first, where high priority is AHI >= 30 or ODI >= 30 for
+    analyzed studies and Epworth > 15 or OSA-50 >= 3 before analysis
+  - Each bucket carries a row_number() ordinal and the result is ordered by bucket and
+    ordinal: union all and the joins do not preserve the buckets' own order
+
+  Rationale:
+  The review bucket sorted by AHI >= 30 alone, while get_triage_priority() in app.py
+  marks a study high priority on AHI or ODI (or, before analysis, on questionnaire
+  scores). With a review_limit smaller than the bucket, a study flagged high priority
+  by its ODI could be cut from the dashboard behind normal-priority ones. Both places
+  now use one rule; the thresholds match TRIAGE_AHI_THRESHOLD / TRIAGE_ODI_THRESHOLD.
+
+  Security:
+  No change: doctor_dashboard() remains security invoker and executable by
+  authenticated users only.
+*/
+
+-- =============================================
+-- DOCTOR DASHBOARD FUNCTION
+-- =============================================
+
+create or replace function public.doctor_dashboard(
+  review_limit integer default 3,
+  completed_limit integer default 3,
+  assigned_limit integer default 20
+)
+returns table (
+  bucket text,
+  id uuid,
+  patient_name text,
+  current_state public.study_state,
+  start_date date,
+  updated_at timestamptz,
+  epworth_score integer,
+  osa50_score integer,
+  has_referrals boolean,
+  has_sleep_data boolean,
+  ahi numeric,
+  odi numeric,
+  bucket_total bigint
+)
+language sql
+stable
+security invoker
+set search_path = ''
+as $$
+  with review as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by priority.high desc, s.updated_at) as ordinal
+    from public.sleep_studies s
+    left join lateral (
+      select sa.ahi, sa.odi from public.sleep_study_analyses sa
+      where sa.sleep_study_id = s.id
+      order by sa.created_at desc limit 1
+    ) latest on true
+    -- Same rule as get_triage_priority() in app.py: severe AHI or ODI once
+    -- analyzed, questionnaire thresholds before that
+    cross join lateral (
+      select case
+        when latest.ahi is not null or latest.odi is not null then
+          coalesce(latest.ahi, 0) >= 30 or coalesce(latest.odi, 0) >= 30
+        else
+          coalesce((select sr.score from public.survey_responses sr
+                    where sr.sleep_study_id = s.id and sr.type = 'epworth'
+                    order by sr.created_at desc limit 1), 0) > 15
+          or coalesce((select sr.score from public.survey_responses sr
+                       where sr.sleep_study_id = s.id and sr.type = 'osa50'
+                       order by sr.created_at desc limit 1), 0) >= 3
+      end as high
+    ) priority
+    where s.doctor_id = (select auth.uid())
+      and s.current_state = 'review'
+    order by ordinal
+    limit review_limit
+  ),
+  completed as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by s.updated_at desc) as ordinal
+    from public.sleep_studies s
+    where s.doctor_id = (select auth.uid())
+      and s.current_state = 'completed'
+    order by s.updated_at desc
+    limit completed_limit
+  ),
+  assigned as (
+    select s.id, s.patient_id, s.current_state, s.start_date, s.updated_at,
+      row_number() over (order by s.created_at desc) as ordinal
+    from public.sleep_studies s
+    where s.doctor_id = (select auth.uid())
+    order by s.created_at desc
+    limit assigned_limit
+  ),
+  buckets as (
+    select 'review' as bucket, r.* from review r
+    union all
+    select 'completed' as bucket, c.* from completed c
+    union all
+    select 'assigned' as bucket, a.* from assigned a
+  )
+  select
+    b.bucket,
+    b.id,
+    p.patient_details->>'full_name' as patient_name,
+    b.current_state,
+    b.start_date,
+    b.updated_at,
+    (select sr.score from public.survey_responses sr
+      where sr.sleep_study_id = b.id and sr.type = 'epworth'
+      order by sr.created_at desc limit 1) as epworth_score,
+    (select sr.score from public.survey_responses sr
+      where sr.sleep_study_id = b.id and sr.type = 'osa50'
+      order by sr.created_at desc limit 1) as osa50_score,
+    exists (select 1 from public.referrals rf where rf.sleep_study_id = b.id) as has_referrals,
+    exists (select 1 from public.sleep_data_files df where df.sleep_study_id = b.id) as has_sleep_data,
+    latest.ahi,
+    latest.odi,
+    case when b.bucket = 'review' then (
+      select count(*) from public.sleep_studies s
+      where s.doctor_id = (select auth.uid())
+        and s.current_state = 'review'
+    ) end as bucket_total
+  from buckets b
+  left join public.patient_profiles p on p.user_id = b.patient_id
+  left join lateral (
+    select sa.ahi, sa.odi from public.sleep_study_analyses sa
+    where sa.sleep_study_id = b.id
+    order by sa.created_at desc limit 1
+  ) latest on true
+  -- union all and the joins do not keep the CTE order
+  order by b.bucket, b.ordinal;
+$$;
+
+comment on function public.doctor_dashboard(integer, integer, integer) is
+  'Bounded doctor dashboard buckets (review, completed, assigned) with scores, attachment flags and latest AHI/ODI';
+
+revoke execute on function public.doctor_dashboard(integer, integer, integer) from public, anon;
+grant execute on function public.doctor_dashboard(integer, integer, integer) to authenticated;
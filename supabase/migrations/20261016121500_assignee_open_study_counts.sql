@@ -0,0 +1,60 @@
+/*
+  Migration: Assignee open-study counts
+  Description: Counts open studies per staff member and doctor in the database for the assignment roster
+  Author: Sleep Study App
+  Created: 2026-10-16 12:15:00 UTC
+
+  Changes:
+  - Add public.assignee_open_study_counts(states): one row per assigned manager or doctor
+    with the number of their studies in the given states (grouped by manager_id and by
+    doctor_id)
+
+  Rationale:
+  The assignment engine (staff_assignment.py) reloaded its roster by selecting the
+  manager_id and doctor_id of every open study and counting them in Python, so each
+  reload transferred one row per open study. The grouped count returns one row per
+  assignee, however many studies are open.
+
+  Security:
+  security invoker: the counts only include studies the caller can read through RLS,
+  exactly like the select it replaces. The app calls it with the service-role client.
+*/
+
+-- =============================================
+-- ASSIGNEE OPEN STUDY COUNTS FUNCTION
+-- =============================================
+
+create or replace function public.assignee_open_study_counts(
+  states public.study_state[] default array['booked', 'active', 'review']::public.study_state[]
+)
+returns table (
+  user_id uuid,
+  open_count bigint
+)
+language sql
+stable
+security invoker
+set search_path = ''
+as $$
+  select assignee.assignee_id, sum(assignee.study_count)::bigint
+  from (
+    select s.manager_id as assignee_id, count(*) as study_count
+    from public.sleep_studies s
+    where s.current_state = any(states)
+      and s.manager_id is not null
+    group by s.manager_id
+    union all
+    select s.doctor_id as assignee_id, count(*) as study_count
+    from public.sleep_studies s
+    where s.current_state = any(states)
+      and s.doctor_id is not null
+    group by s.doctor_id
+  ) assignee
+  group by assignee.assignee_id;
+$$;
+
+comment on function public.assignee_open_study_counts(public.study_state[]) is
+  'Open-study count per assigned manager/doctor (grouped in the database for the assignment roster)';
+
+revoke execute on function public.assignee_open_study_counts(public.study_state[]) from public, anon;
+grant execute on function public.assignee_open_study_counts(public.study_state[]) to authenticated, service_role;
@@ -0,0 +1,26 @@
+/*
+  Migration: Organization-scoped keyset pagination index
+  Description: Adds a (organization_id, created_at desc, id desc) index on sleep_studies
+  Author: Sleep Study App
+  Created: 2026-10-17 09:00:00 UTC
+
+  Changes:
+  - Add sleep_studies_org_created_at_id_idx on (organization_id, created_at desc, id desc)
+
+  Rationale:
+  The staff studies list filters on organization_id in (...) and pages by
+  (created_at desc, id desc) with a cursor. sleep_studies_org_state_start_date_idx
+  narrows the rows to the tenant but not in page order, so every page sorted all of
+  the organization's matching studies; sleep_studies_created_at_id_idx has the order
+  but walks every tenant's studies. With this index a single-organization staff member
+  (the common case) reads each page as a short ordered range scan from the cursor, and
+  a member of several organizations gets one ordered range per organization to merge.
+  The (organization_id, current_state, start_date) index stays for filtered lists.
+*/
+
+-- =============================================
+-- ORGANIZATION-SCOPED KEYSET PAGINATION INDEX
+-- =============================================
+
+create index if not exists sleep_studies_org_created_at_id_idx
+  on public.sleep_studies using btree (organization_id, created_at desc, id desc);
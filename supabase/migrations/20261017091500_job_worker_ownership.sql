@@ -0,0 +1,76 @@
+/*
+  Migration: Worker-owned job completion
+  Description: complete_job() and fail_job() only apply to jobs still locked by the calling worker
+  Author: Sleep Study App
+  Created: 2026-10-17 09:15:00 UTC
+
+  Changes:
+  - Replace public.complete_job(job_id) with public.complete_job(job_id, worker_id)
+  - Replace public.fail_job(job_id, error, retry_delay_seconds) with
+    public.fail_job(job_id, worker_id, error, retry_delay_seconds)
+  - Both now return whether the job was still locked by worker_id (and was updated)
+
+  Rationale:
+  Both functions matched on id only. A worker that overran a job's visibility timeout
+  could finish after another worker had re-claimed the job, and then delete it (or
+  requeue/fail it) while the second attempt was still running. Matching on locked_by as
+  well leaves a re-claimed job to the worker that holds it now; the late worker sees
+  false and only logs it. A job whose lock expired but was not re-claimed still has the
+  same locked_by, so it is completed normally.
+
+  Security:
+  Unchanged: security invoker and executable by service_role only.
+*/
+
+-- =============================================
+-- WORKER-OWNED JOB FUNCTIONS
+-- =============================================
+
+drop function if exists public.complete_job(uuid);
+drop function if exists public.fail_job(uuid, text, integer);
+
+create or replace function public.complete_job(job_id uuid, worker_id text)
+returns boolean
+language sql
+security invoker
+set search_path = ''
+as $$
+  with deleted as (
+    delete from public.jobs
+    where id = job_id
+      and locked_by = worker_id
+    returning 1
+  )
+  select exists (select 1 from deleted);
+$$;
+
+create or replace function public.fail_job(
+  job_id uuid,
+  worker_id text,
+  error text,
+  retry_delay_seconds integer default null
+)
+returns boolean
+language sql
+security invoker
+set search_path = ''
+as $$
+  with updated as (
+    update public.jobs
+    set status = case when retry_delay_seconds is null then 'failed' else 'queued' end,
+        run_at = case when retry_delay_seconds is null then run_at
+                      else now() + make_interval(secs => retry_delay_seconds) end,
+        locked_until = null,
+        locked_by = null,
+        last_error = error
+    where id = job_id
+      and locked_by = worker_id
+    returning 1
+  )
+  select exists (select 1 from updated);
+$$;
+
+revoke execute on function public.complete_job(uuid, text) from public, anon, authenticated;
+revoke execute on function public.fail_job(uuid, text, text, integer) from public, anon, authenticated;
+grant execute on function public.complete_job(uuid, text) to service_role;
+grant execute on function public.fail_job(uuid, text, text, integer) to service_role;
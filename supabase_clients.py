@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Supabase Connection Management for the Sleep Study Management System
+
+Authenticated database and storage access used to build a brand-new Supabase
+client (GoTrue, PostgREST and Storage sub-clients, each with its own HTTP
+connection pool) and call auth.set_session() on every request. Dashboards
+that poll every 30 seconds multiplied that cost per open tab, and the single
+module-level client had its auth state mutated by sign-in/sign-out calls from
+every gunicorn thread.
+
+This module is the connection-management layer instead:
+- One bounded keep-alive HTTP connection pool per worker process (HTTP/2
+  where the `h2` package is installed), rebuilt automatically after fork
+- Thread-safe anon and service-role singletons for PostgREST and Storage
+- A process-wide pool of per-user clients, keyed by a SHA-256 hash of the
+  access token (raw tokens are never used as cache keys or logged), living
+  until shortly before the JWT `exp` claim and evicted least-recently-used
+- Short-lived GoTrue clients for sign-in/sign-up/sign-out, so no shared
+  client ever holds a user's auth state
+"""
+
+import base64
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+from gotrue import SyncGoTrueClient
+from gotrue.http_clients import SyncClient as GoTrueSession
+from postgrest import SyncPostgrestClient
+from postgrest.constants import (
+    DEFAULT_POSTGREST_CLIENT_HEADERS,
+    DEFAULT_POSTGREST_CLIENT_TIMEOUT,
+)
+from postgrest.utils import SyncClient as PostgrestSession
+from storage3 import SyncStorageClient
+from storage3.constants import DEFAULT_TIMEOUT as DEFAULT_STORAGE_TIMEOUT
+from storage3.utils import SyncClient as StorageSession
+
+# Pool sizing (override via environment for larger deployments)
+CLIENT_POOL_SIZE = int(os.getenv('SUPABASE_CLIENT_POOL_SIZE', 256))
+CLIENT_POOL_DEFAULT_TTL = int(os.getenv('SUPABASE_CLIENT_POOL_DEFAULT_TTL', 3600))
+
+# HTTP connection limits per worker process
+HTTP_MAX_CONNECTIONS = int(os.getenv('SUPABASE_HTTP_MAX_CONNECTIONS', 20))
+HTTP_MAX_KEEPALIVE = int(os.getenv('SUPABASE_HTTP_MAX_KEEPALIVE', 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('SUPABASE_HTTP_KEEPALIVE_EXPIRY', 30))
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Retire clients slightly before their token expires so a request never
+# starts with a token that PostgREST will reject mid-flight
+TOKEN_EXPIRY_SKEW_SECONDS = 30
+
+_config = {}
+_transport = None
+_transport_pid = None
+_anon_client = None
+_service_client = None
+_lock = threading.Lock()
+
+def init_clients(supabase_url, anon_key, service_role_key=None):
+    """
+    Configure the connection layer with the project URL and API keys.
+    
+    Must be called once at import time of the Flask app, before any
+    client accessor is used.
+    
+    Args:
+        supabase_url (str): Supabase project URL
+        anon_key (str): Public anon key
+        service_role_key (str, optional): Service role key (bypasses RLS)
+    """
+    global _anon_client, _service_client
+
+    with _lock:
+        _config.update({
+            'url': supabase_url,
+            'anon_key': anon_key,
+            'service_role_key': service_role_key
+        })
+        _anon_client = None
+        _service_client = None
+
+# ============================================================================
+# SHARED HTTP TRANSPORT
+# ============================================================================
+
+def get_process_transport():
+    """
+    Get this worker process's bounded keep-alive HTTP transport.
+    
+    httpx connection pools live on the transport, so routing every session
+    through one transport means connections to Supabase are opened once and
+    reused across users and requests. The transport is rebuilt when the PID
+    changes, so a forked gunicorn worker never shares sockets with its parent.
+    
+    Returns:
+        httpx.HTTPTransport: Transport owned by the current process
+    """
+    global _transport, _transport_pid
+
+    pid = os.getpid()
+    if _transport is None or _transport_pid != pid:
+        with _lock:
+            if _transport is None or _transport_pid != pid:
+                _transport = httpx.HTTPTransport(
+                    http2=HTTP2_AVAILABLE,
+                    limits=httpx.Limits(
+                        max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                    )
+                )
+                _transport_pid = pid
+    return _transport
+
+class SharedTransport(httpx.BaseTransport):
+    """
+    Transport proxy that forwards to the current process's transport.
+    
+    Sessions hold this proxy rather than a concrete transport, so clients
+    created before a fork (e.g. with gunicorn --preload) transparently use
+    the child's own connection pool. Closing a session never closes the
+    shared pool.
+    """
+
+    def handle_request(self, request):
+        return get_process_transport().handle_request(request)
+
+    def close(self):
+        pass
+
+_shared_transport = SharedTransport()
+
+def get_shared_transport():
+    """
+    Get the fork-safe transport proxy used by all sessions.
+    
+    Returns:
+        SharedTransport: Process-wide transport proxy
+    """
+    return _shared_transport
+
+def _reset_after_fork():
+    """Drop inherited connections and locks in a freshly forked child."""
+    global _transport, _transport_pid, _lock
+
+    _lock = threading.Lock()
+    _transport = None
+    _transport_pid = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+class PooledPostgrestClient(SyncPostgrestClient):
+    """PostgREST client whose session runs over the shared transport."""
+
+    def create_session(self, base_url, headers, timeout):
+        return PostgrestSession(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            transport=get_shared_transport()
+        )
+
+class PooledStorageClient(SyncStorageClient):
+    """Storage client whose session runs over the shared transport."""
+
+    def _create_session(self, base_url, headers, timeout, verify=True):
+        return StorageSession(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            follow_redirects=True,
+            transport=get_shared_transport()
+        )
+
+# ============================================================================
+# AUTHENTICATED CLIENTS
+# ============================================================================
+
+class AuthenticatedClient:
+    """
+    Lightweight Supabase client for PostgREST and Storage access.
+
+    Mirrors the subset of the supabase-py Client interface used by app.py
+    (table, from_, rpc, postgrest, storage). The bearer token is sent as the
+    Authorization header directly, so no GoTrue session is created and no
+    auth.set_session() round trip is made. Instances never change identity,
+    which makes them safe to share between threads.
+
+    Args:
+        supabase_url (str): Supabase project URL
+        supabase_key (str): API key sent as the apiKey header
+        access_token (str): Bearer token - a user JWT for RLS-authenticated
+            requests, or the API key itself for anon/service-role access
+    """
+
+    def __init__(self, supabase_url, supabase_key, access_token):
+        self.rest_url = f"{supabase_url}/rest/v1"
+        self.storage_url = f"{supabase_url}/storage/v1"
+        self.headers = {
+            'apiKey': supabase_key,
+            'Authorization': f"Bearer {access_token}"
+        }
+        self._postgrest = None
+        self._storage = None
+        self._lock = threading.Lock()
+
+    @property
+    def postgrest(self):
+        if self._postgrest is None:
+            with self._lock:
+                if self._postgrest is None:
+                    self._postgrest = PooledPostgrestClient(
+                        self.rest_url,
+                        headers={**DEFAULT_POSTGREST_CLIENT_HEADERS, **self.headers},
+                        timeout=DEFAULT_POSTGREST_CLIENT_TIMEOUT
+                    )
+        return self._postgrest
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            with self._lock:
+                if self._storage is None:
+                    self._storage = PooledStorageClient(
+                        self.storage_url,
+                        dict(self.headers),
+                        DEFAULT_STORAGE_TIMEOUT
+                    )
+        return self._storage
+
+    def table(self, table_name):
+        """Perform a table operation (alias of from_)."""
+        return self.from_(table_name)
+
+    def from_(self, table_name):
+        """Perform a table operation."""
+        return self.postgrest.from_(table_name)
+
+    def rpc(self, fn, params):
+        """Call a Postgres function through PostgREST."""
+        return self.postgrest.rpc(fn, params)
+
+def get_anon_client():
+    """
+    Get the shared anon-key client for this worker.
+    
+    Returns:
+        AuthenticatedClient: Thread-safe anon singleton
+    """
+    global _anon_client
+
+    if _anon_client is None:
+        with _lock:
+            if _anon_client is None:
+                _anon_client = AuthenticatedClient(
+                    _config['url'], _config['anon_key'], _config['anon_key']
+                )
+    return _anon_client
+
+def get_service_client():
+    """
+    Get the shared service-role client for this worker.
+    
+    Used for server-side writes that must bypass RLS, such as creating the
+    app_users record during email verification.
+    
+    Returns:
+        AuthenticatedClient: Thread-safe service-role singleton
+        
+    Raises:
+        ValueError: If SUPABASE_SERVICE_ROLE_KEY is not configured
+    """
+    global _service_client
+
+    if _service_client is None:
+        service_role_key = _config.get('service_role_key')
+        if not service_role_key:
+            raise ValueError("Missing SUPABASE_SERVICE_ROLE_KEY in environment variables")
+        with _lock:
+            if _service_client is None:
+                _service_client = AuthenticatedClient(
+                    _config['url'], service_role_key, service_role_key
+                )
+    return _service_client
+
+def create_auth_client():
+    """
+    Create a short-lived GoTrue client for a single auth operation.
+    
+    Sign-in, sign-up, code exchange and token refresh store session state on
+    the GoTrue client that performs them. Giving each operation its own
+    client (over the shared transport) keeps that state out of the shared
+    singletons. Auto-refresh is disabled so no background timer is started.
+    
+    Returns:
+        SyncGoTrueClient: Fresh auth client
+    """
+    anon_key = _config['anon_key']
+    return SyncGoTrueClient(
+        url=f"{_config['url']}/auth/v1",
+        headers={'apiKey': anon_key, 'Authorization': f"Bearer {anon_key}"},
+        auto_refresh_token=False,
+        persist_session=False,
+        http_client=GoTrueSession(
+            follow_redirects=True,
+            transport=get_shared_transport()
+        )
+    )
+
+def hash_token(access_token):
+    """
+    Hash an access token for use as a cache key.
+
+    Args:
+        access_token (str): User JWT
+
+    Returns:
+        str: Hex SHA-256 digest of the token
+    """
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+def get_token_expiry(access_token):
+    """
+    Read the `exp` claim from a JWT without verifying its signature.
+
+    Only used for cache lifetimes - the token itself is still validated by
+    PostgREST and Storage on every request.
+
+    Args:
+        access_token (str): User JWT
+
+    Returns:
+        int|None: Expiry as a Unix timestamp, or None if not present/decodable
+    """
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        exp = claims.get('exp')
+        return int(exp) if exp is not None else None
+    except (IndexError, ValueError, TypeError):
+        return None
+
+def is_token_expired(access_token, skew=TOKEN_EXPIRY_SKEW_SECONDS):
+    """
+    Check whether a JWT has expired (or is about to).
+
+    Args:
+        access_token (str): User JWT
+        skew (int): Seconds before `exp` at which the token counts as expired
+
+    Returns:
+        bool: True if the token is expired or expires within `skew` seconds
+    """
+    exp = get_token_expiry(access_token)
+    if exp is None:
+        return False
+    return exp - skew <= time.time()
+
+class AuthenticatedClientPool:
+    """
+    Thread-safe LRU + TTL pool of AuthenticatedClient instances.
+
+    Args:
+        supabase_url (str): Supabase project URL
+        supabase_key (str): Anon key for the apiKey header
+        maxsize (int): Maximum number of cached clients
+        default_ttl (int): Lifetime in seconds for tokens without an `exp` claim
+    """
+
+    def __init__(self, supabase_url, supabase_key, maxsize=CLIENT_POOL_SIZE,
+                 default_ttl=CLIENT_POOL_DEFAULT_TTL):
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # token hash -> (expires_at, client)
+        self._lock = threading.Lock()
+
+    def get(self, access_token):
+        """
+        Get (or build) the authenticated client for an access token.
+
+        Args:
+            access_token (str): User JWT from the Flask session
+
+        Returns:
+            AuthenticatedClient: Warm client for this token
+        """
+        key = hash_token(access_token)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, client = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return client
+                del self._entries[key]
+
+        client = AuthenticatedClient(self.supabase_url, self.supabase_key, access_token)
+        exp = get_token_expiry(access_token)
+        expires_at = (exp - TOKEN_EXPIRY_SKEW_SECONDS) if exp else now + self.default_ttl
+
+        with self._lock:
+            # Another thread may have built one meanwhile - keep the first
+            existing = self._entries.get(key)
+            if existing is not None and existing[0] > now:
+                self._entries.move_to_end(key)
+                return existing[1]
+
+            self._entries[key] = (expires_at, client)
+            self._entries.move_to_end(key)
+            self._evict(now)
+
+        return client
+
+    def discard(self, access_token):
+        """
+        Remove the client for a token (e.g. on sign-out).
+
+        Args:
+            access_token (str): User JWT
+        """
+        with self._lock:
+            self._entries.pop(hash_token(access_token), None)
+
+    def _evict(self, now):
+        """Drop expired entries, then least-recently-used ones over maxsize."""
+        expired = [key for key, (expires_at, _) in self._entries.items()
+                   if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
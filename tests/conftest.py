@@ -0,0 +1,112 @@
+"""
+Test fixtures: the Flask app wired to an in-process fake Supabase.
+
+Every HTTP request the app makes (PostgREST, Storage, GoTrue) goes through
+the shared transport, which is replaced by an httpx.MockTransport routed to
+FakeSupabase handlers, so tests run without a Supabase project.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCRATCH_DIR = tempfile.mkdtemp(prefix='sleep-study-tests-')
+
+JWT_SECRET = 'test-jwt-secret'
+SERVICE_ROLE_KEY = 'service.role.key'
+
+os.environ.update({
+    'SUPABASE_URL': 'http://supabase.test',
+    'SUPABASE_ANON_KEY': 'anon.key.test',
+    'SUPABASE_SERVICE_ROLE_KEY': SERVICE_ROLE_KEY,
+    'SUPABASE_JWT_SECRET': JWT_SECRET,
+    'SESSION_BACKEND': 'memory',
+    'EVENT_BACKEND': 'memory',
+    'JOB_BACKEND': 'sqlite',
+    'JOB_SQLITE_PATH': os.path.join(SCRATCH_DIR, 'jobs.sqlite3'),
+    'STORAGE_MARKER_PATH': os.path.join(SCRATCH_DIR, 'storage-buckets.json'),
+    'TEMPLATE_BYTECODE_DIR': os.path.join(SCRATCH_DIR, 'jinja-bytecode'),
+    'DOWNLOAD_CACHE_DIR': os.path.join(SCRATCH_DIR, 'download-cache'),
+    'SIGNAL_TILES_DIR': os.path.join(SCRATCH_DIR, 'signal-tiles'),
+    'SLEEP_DATA_STAGING_DIR': os.path.join(SCRATCH_DIR, 'staging'),
+})
+
+class FakeSupabase:
+    """
+    Routes requests to handlers registered per (method, path).
+
+    Handlers take the httpx.Request and return an httpx.Response. Every
+    request is recorded in `requests`.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    def handle(self, request):
+        self.requests.append(request)
+        handler = self.routes.get((request.method, request.url.path))
+        if handler is None:
+            return httpx.Response(404, json={'message': f"No fake for {request.method} {request.url.path}"})
+        return handler(request)
+
+    def is_service_request(self, request):
+        """True if the request carries the service role key (RLS bypassed)."""
+        return request.headers.get('authorization') == f"Bearer {SERVICE_ROLE_KEY}"
+
+_backend = {'current': FakeSupabase()}
+
+import supabase_clients  # noqa: E402
+
+_transport = httpx.MockTransport(lambda request: _backend['current'].handle(request))
+supabase_clients.get_process_transport = lambda: _transport
+
+import app as app_module  # noqa: E402
+
+@pytest.fixture
+def supabase():
+    """Fresh fake Supabase for one test."""
+    _backend['current'] = FakeSupabase()
+    return _backend['current']
+
+@pytest.fixture(autouse=True)
+def job_store(tmp_path, monkeypatch):
+    """Empty job store per test, so jobs queued by one test never run in another."""
+    from job_queue import SQLiteJobStore
+    store = SQLiteJobStore(str(tmp_path / 'jobs.sqlite3'))
+    monkeypatch.setattr(app_module.job_queue, 'store', store)
+    return store
+
+@pytest.fixture
+def flask_app():
+    return app_module
+
+def make_access_token(user_id, expires_in=3600):
+    """HS256 access token as Supabase issues it."""
+    import jwt
+    return jwt.encode({
+        'sub': user_id,
+        'aud': 'authenticated',
+        'role': 'authenticated',
+        'exp': int(time.time()) + expires_in
+    }, JWT_SECRET, algorithm='HS256')
+
+@pytest.fixture
+def sign_in():
+    """Return sign_in(client, user_id, role) storing a signed-in session."""
+    def sign_in(client, user_id, role):
+        with client.session_transaction() as session:
+            session['user'] = {'id': user_id, 'role': role}
+            session['access_token'] = make_access_token(user_id)
+            session['refresh_token'] = f"refresh-{user_id}"
+    return sign_in
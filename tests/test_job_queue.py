@@ -0,0 +1,50 @@
+"""
+Job failures: what is stored in last_error, and which worker may record it.
+"""
+
+import pytest
+
+from job_queue import UNEXPECTED_JOB_ERROR, JobFailed, JobQueue, SQLiteJobStore
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(SQLiteJobStore(str(tmp_path / 'jobs.sqlite3')))
+
+def test_job_failed_message_is_stored(queue):
+    @queue.task('unreadable', max_attempts=1)
+    def unreadable():
+        raise JobFailed("Not an EDF file")
+
+    job_id = queue.enqueue('unreadable', {})
+    queue.run_worker(threads=1, burst=True)
+
+    assert queue.get(job_id)['last_error'] == "Not an EDF file"
+
+def test_unexpected_error_is_stored_without_traceback(queue, capsys):
+    @queue.task('broken', max_attempts=1)
+    def broken():
+        raise KeyError('secret_column')
+
+    job_id = queue.enqueue('broken', {})
+    queue.run_worker(threads=1, burst=True)
+
+    job = queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert job['last_error'] == UNEXPECTED_JOB_ERROR
+    assert 'Traceback' in capsys.readouterr().out
+
+def test_late_worker_cannot_finish_a_reclaimed_job(queue):
+    queue.task('slow')(lambda: None)
+    store = queue.store
+    job_id = queue.enqueue('slow', {})
+
+    [job] = store.claim('default', 'worker-a', 1, None, visibility=0)
+    # worker-a overran its visibility timeout; worker-b claims the job again
+    assert store.claim('default', 'worker-b', 1, None, visibility=300)[0]['id'] == job_id
+
+    assert not store.complete(job_id, 'worker-a')
+    assert not store.fail(job_id, 'worker-a', 'late', retry_delay=5)
+    assert queue.get(job_id)['status'] == 'running'
+
+    assert store.complete(job_id, 'worker-b')
+    assert queue.get(job_id) is None
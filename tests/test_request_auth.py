@@ -0,0 +1,98 @@
+"""
+Access token verification when SUPABASE_JWT_SECRET is not configured.
+"""
+
+import json
+
+import httpx
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from request_auth import AuthUnavailable, InvalidToken, TokenVerifier
+
+from conftest import make_access_token
+
+USER_ID = '44444444-4444-4444-4444-444444444444'
+JWKS_PATH = '/auth/v1/.well-known/jwks.json'
+
+def signing_key_set():
+    public_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key()
+    key = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(public_key))
+    key.update({'kid': 'key-1', 'alg': 'RS256', 'use': 'sig'})
+    return {'keys': [key]}
+
+def make_verifier():
+    return TokenVerifier('http://supabase.test', 'anon.key.test', jwt_secret=None)
+
+def test_startup_fails_for_hs256_project_without_secret(supabase):
+    supabase.route('GET', JWKS_PATH, lambda request: httpx.Response(200, json={'keys': []}))
+
+    with pytest.raises(ValueError, match='SUPABASE_JWT_SECRET'):
+        make_verifier().check_configuration()
+
+def test_startup_check_is_skipped_when_auth_is_unreachable(supabase):
+    def unreachable(request):
+        raise httpx.ConnectError('Connection refused', request=request)
+
+    supabase.route('GET', JWKS_PATH, unreachable)
+
+    make_verifier().check_configuration()
+
+def test_first_hs256_token_logs_a_missing_secret(supabase, capsys):
+    supabase.route('GET', JWKS_PATH, lambda request: httpx.Response(200, json={'keys': []}))
+    supabase.route('GET', '/auth/v1/user', lambda request: httpx.Response(200, json={'id': USER_ID}))
+    verifier = make_verifier()
+
+    assert verifier.verify(make_access_token(USER_ID))['sub'] == USER_ID
+    assert verifier.verify(make_access_token(USER_ID, expires_in=7200))['sub'] == USER_ID
+
+    assert capsys.readouterr().out.count('Missing SUPABASE_JWT_SECRET') == 1
+    assert [request.url.path for request in supabase.requests].count(JWKS_PATH) == 1
+
+def test_hs256_token_is_checked_remotely_once(supabase):
+    supabase.route('GET', JWKS_PATH, lambda request: httpx.Response(200, json=signing_key_set()))
+    supabase.route('GET', '/auth/v1/user', lambda request: httpx.Response(200, json={'id': USER_ID}))
+    verifier = make_verifier()
+    verifier.check_configuration()
+    token = make_access_token(USER_ID)
+
+    assert verifier.verify(token)['sub'] == USER_ID
+    assert verifier.verify(token)['sub'] == USER_ID
+
+    user_requests = [request for request in supabase.requests if request.url.path == '/auth/v1/user']
+    assert len(user_requests) == 1
+    assert user_requests[0].headers['authorization'] == f"Bearer {token}"
+
+def test_hs256_token_rejected_by_auth_is_invalid(supabase):
+    supabase.route('GET', '/auth/v1/user', lambda request: httpx.Response(401, json={'msg': 'invalid JWT'}))
+
+    with pytest.raises(InvalidToken):
+        make_verifier().verify(make_access_token(USER_ID))
+
+def test_hs256_token_of_another_user_is_invalid(supabase):
+    supabase.route('GET', '/auth/v1/user', lambda request: httpx.Response(200, json={'id': 'someone-else'}))
+
+    with pytest.raises(InvalidToken):
+        make_verifier().verify(make_access_token(USER_ID))
+
+def test_non_json_answer_is_an_outage_not_an_invalid_token(supabase):
+    supabase.route('GET', '/auth/v1/user', lambda request: httpx.Response(200, text='<html>Bad gateway</html>'))
+
+    with pytest.raises(AuthUnavailable):
+        make_verifier().verify(make_access_token(USER_ID))
+
+def test_auth_outage_keeps_the_session(supabase, flask_app, sign_in, monkeypatch):
+    def unreachable(request):
+        raise httpx.ConnectError('Connection refused', request=request)
+
+    supabase.route('GET', '/auth/v1/user', unreachable)
+    monkeypatch.setattr(flask_app, 'token_verifier', make_verifier())
+
+    client = flask_app.app.test_client()
+    sign_in(client, USER_ID, 'patient')
+
+    response = client.get('/htmx/patient/studies/unknown/report')
+    assert response.status_code == 503
+    with client.session_transaction() as session:
+        assert session['user']['id'] == USER_ID
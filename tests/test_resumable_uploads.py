@@ -0,0 +1,134 @@
+"""
+Chunked uploads: checksums, offsets and short streams, both towards
+Storage (TUS) and in the app's Upload-Offset protocol.
+"""
+
+import io
+
+import httpx
+import pytest
+
+import resumable_uploads
+from resumable_uploads import (ChecksumMismatch, UploadError, chunk_checksum, stream_upload,
+                               verify_chunk)
+
+STAFF_ID = '55555555-5555-5555-5555-555555555555'
+STUDY_ID = '66666666-6666-6666-6666-666666666666'
+CHUNK_SIZE = 8
+
+def test_verify_chunk_accepts_its_checksum():
+    verify_chunk(b'chunk', chunk_checksum(b'chunk'))
+
+@pytest.mark.parametrize('checksum, message', [
+    (None, 'Missing'),
+    ('md5 abc', 'unsupported'),
+    (chunk_checksum(b'other'), 'mismatch'),
+])
+def test_verify_chunk_rejects_bad_checksums(checksum, message):
+    with pytest.raises(ChecksumMismatch, match=message):
+        verify_chunk(b'chunk', checksum)
+
+def install_tus_backend(supabase):
+    """Fake Storage TUS endpoint; returns the received bytes."""
+    received = bytearray()
+    location = '/storage/v1/upload/resumable/upload-1'
+
+    supabase.route('POST', '/storage/v1/upload/resumable', lambda request: httpx.Response(
+        201, headers={'Location': f"http://supabase.test{location}"}))
+
+    def patch(request):
+        if int(request.headers['upload-offset']) != len(received):
+            return httpx.Response(409)
+        received.extend(request.content)
+        return httpx.Response(204, headers={'Upload-Offset': str(len(received))})
+
+    supabase.route('PATCH', location, patch)
+    supabase.route('HEAD', location, lambda request: httpx.Response(
+        200, headers={'Upload-Offset': str(len(received))}))
+    return received
+
+def test_stream_upload_sends_every_chunk(supabase, flask_app, monkeypatch):
+    monkeypatch.setattr(resumable_uploads, 'UPLOAD_CHUNK_SIZE', CHUNK_SIZE)
+    received = install_tus_backend(supabase)
+    body = bytes(range(30))
+
+    uploaded = stream_upload(flask_app.get_privileged_client(), 'sleep-data', 'study/night.edf',
+                             io.BytesIO(body), len(body), 'application/octet-stream')
+
+    assert uploaded == len(body)
+    assert bytes(received) == body
+    assert [request.method for request in supabase.requests].count('PATCH') == 4
+
+def test_stream_upload_fails_on_a_short_stream(supabase, flask_app, monkeypatch):
+    monkeypatch.setattr(resumable_uploads, 'UPLOAD_CHUNK_SIZE', CHUNK_SIZE)
+    install_tus_backend(supabase)
+
+    with pytest.raises(UploadError, match='ended at byte 16 of 30'):
+        stream_upload(flask_app.get_privileged_client(), 'sleep-data', 'study/night.edf',
+                      io.BytesIO(bytes(16)), 30, 'application/octet-stream')
+
+@pytest.fixture
+def upload_client(supabase, flask_app, sign_in, monkeypatch):
+    """Staff client with a started 20-byte recording upload: (client, chunk url)."""
+    monkeypatch.setattr(flask_app, 'UPLOAD_CHUNK_SIZE', CHUNK_SIZE)
+    supabase.route('GET', '/rest/v1/sleep_studies',
+                   lambda request: httpx.Response(200, json=[{'id': STUDY_ID}]))
+    client = flask_app.app.test_client()
+    sign_in(client, STAFF_ID, 'staff')
+
+    response = client.post(f"/htmx/staff/upload-data/{STUDY_ID}", data={'filename': 'night.edf', 'size': 20})
+    assert response.status_code == 200
+    assert response.json['offset'] == 0
+    assert response.json['chunk_size'] == CHUNK_SIZE
+    return client, f"/htmx/staff/upload-data/{STUDY_ID}/{response.json['upload_id']}"
+
+def send_chunk(client, url, offset, data, checksum=None):
+    return client.patch(url, data=data, headers={
+        'Upload-Offset': str(offset),
+        'Upload-Checksum': checksum or chunk_checksum(data)
+    })
+
+def test_chunks_are_staged_and_the_last_queues_ingestion(upload_client, flask_app):
+    client, url = upload_client
+    body = bytes(range(20))
+
+    response = send_chunk(client, url, 0, body[:8])
+    assert response.status_code == 204
+    assert response.headers['Upload-Offset'] == '8'
+    assert client.head(url).headers['Upload-Offset'] == '8'
+
+    assert send_chunk(client, url, 8, body[8:16]).status_code == 204
+    response = send_chunk(client, url, 16, body[16:])
+    assert response.status_code == 200
+
+    upload_id = url.rsplit('/', 1)[1]
+    assert flask_app.job_queue.get(upload_id)['status'] == 'queued'
+
+def test_wrong_checksum_is_rejected_with_460(upload_client):
+    client, url = upload_client
+
+    response = send_chunk(client, url, 0, bytes(8), checksum=chunk_checksum(b'something else'))
+    assert response.status_code == 460
+    assert client.head(url).headers['Upload-Offset'] == '0'
+
+def test_offset_mismatch_returns_the_staged_offset(upload_client):
+    client, url = upload_client
+    assert send_chunk(client, url, 0, bytes(8)).status_code == 204
+
+    # A retried first chunk after its response was lost
+    response = send_chunk(client, url, 0, bytes(8))
+    assert response.status_code == 409
+    assert response.headers['Upload-Offset'] == '8'
+
+def test_short_chunk_is_rejected(upload_client):
+    client, url = upload_client
+
+    response = send_chunk(client, url, 0, bytes(5))
+    assert response.status_code == 400
+    assert client.head(url).headers['Upload-Offset'] == '0'
+
+def test_chunk_without_offset_is_rejected(upload_client):
+    client, url = upload_client
+
+    response = client.patch(url, data=bytes(8), headers={'Upload-Checksum': chunk_checksum(bytes(8))})
+    assert response.status_code == 400
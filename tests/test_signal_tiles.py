@@ -0,0 +1,81 @@
+"""
+TileStore downloads: single-flight per file, parallel across files.
+Cached recordings are evicted as a whole.
+"""
+
+import json
+import threading
+
+import numpy as np
+
+from signal_tiles import PYRAMID_METADATA, TileStore, get_signal_filename
+
+def test_downloads_of_different_recordings_do_not_wait_for_each_other(tmp_path):
+    slow_started = threading.Event()
+    release_slow = threading.Event()
+
+    def fetch(recording_id, name, destination):
+        if recording_id == 'slow':
+            slow_started.set()
+            release_slow.wait(5)
+        with open(destination, 'w') as local_file:
+            local_file.write('{}')
+
+    store = TileStore(str(tmp_path), fetch)
+    slow = threading.Thread(target=store._ensure_local, args=('slow', 'pyramid.json'))
+    slow.start()
+    assert slow_started.wait(5)
+
+    # Not blocked behind the slow download
+    fast = threading.Thread(target=store._ensure_local, args=('fast', 'pyramid.json'))
+    fast.start()
+    fast.join(2)
+    assert not fast.is_alive()
+
+    release_slow.set()
+    slow.join(5)
+    assert store._fetch_locks == {}
+
+def test_concurrent_requests_for_one_file_download_it_once(tmp_path):
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def fetch(recording_id, name, destination):
+        calls.append((recording_id, name))
+        started.set()
+        release.wait(5)
+        with open(destination, 'w') as local_file:
+            local_file.write('{}')
+
+    store = TileStore(str(tmp_path), fetch)
+    threads = [threading.Thread(target=store._ensure_local, args=('rec', 'pyramid.json')) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [('rec', 'pyramid.json')]
+
+def write_pyramid(root, recording_id, samples):
+    directory = root / recording_id
+    directory.mkdir()
+    np.asarray(samples, dtype='<i2').tofile(directory / get_signal_filename(0))
+    (directory / PYRAMID_METADATA).write_text(json.dumps({'signals': [{
+        'index': 0, 'sample_rate': 1, 'gain': 0.5, 'digital_min': 0, 'physical_min': 0,
+        'samples': len(samples), 'levels': [{'offset': 0, 'bins': len(samples), 'bin_samples': 1}]
+    }]}))
+
+def test_recordings_are_cached_and_evicted_as_one_entry(tmp_path):
+    write_pyramid(tmp_path, 'first', [2, 4, 6])
+    write_pyramid(tmp_path, 'second', [8, 10])
+    store = TileStore(str(tmp_path), maxsize=1)
+
+    assert store.read_tile('first', 0, 0, 0)['values'] == [1, 2, 3]
+    assert list(store._entries) == ['first']
+    assert list(store._entries['first']['signals']) == [0]
+
+    assert store.read_tile('second', 0, 0, 0)['values'] == [4, 5]
+    assert list(store._entries) == ['second']
@@ -0,0 +1,41 @@
+"""
+Batched signing of private Storage links.
+"""
+
+import json
+
+import httpx
+
+from signed_urls import SignedUrlCache
+
+def test_missing_object_does_not_fail_the_batch(supabase, flask_app):
+    def sign(request):
+        body = json.loads(request.content)
+        return httpx.Response(200, json=[
+            {'path': path, 'error': 'Either the object does not exist or you do not have access to it',
+             'signedURL': None} if path == 'study/missing.pdf' else
+            {'path': path, 'error': None, 'signedURL': f"/object/sign/referrals/{path}?token=t"}
+            for path in body['paths']
+        ])
+
+    supabase.route('POST', '/storage/v1/object/sign/referrals', sign)
+
+    urls = SignedUrlCache().get_many(flask_app.get_privileged_client(), [
+        ('referrals', 'study/referral.pdf'),
+        ('referrals', 'study/missing.pdf')
+    ])
+
+    assert urls == {
+        ('referrals', 'study/referral.pdf'):
+            'http://supabase.test/storage/v1/object/sign/referrals/study/referral.pdf?token=t'
+    }
+    assert len(supabase.requests) == 1
+
+def test_failed_signing_is_not_cached(supabase, flask_app):
+    supabase.route('POST', '/storage/v1/object/sign/reports', lambda request: httpx.Response(500))
+    cache = SignedUrlCache()
+    client = flask_app.get_privileged_client()
+
+    assert cache.get(client, 'reports', 'study/report.html') is None
+    assert cache.get(client, 'reports', 'study/report.html') is None
+    assert len(supabase.requests) == 2
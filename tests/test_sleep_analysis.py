@@ -0,0 +1,41 @@
+"""
+Airflow event detection: signal loss must not be scored as apneas.
+"""
+
+import numpy as np
+
+from sleep_analysis import detect_airflow_events
+
+SAMPLE_RATE = 10
+
+def breathing(seconds, amplitude=1.0):
+    t = np.arange(seconds * SAMPLE_RATE) / SAMPLE_RATE
+    return amplitude * np.sin(2 * np.pi * t / 4)
+
+def flatline(seconds):
+    return np.zeros(seconds * SAMPLE_RATE)
+
+def test_flatline_recording_has_no_index():
+    result = detect_airflow_events(flatline(400), SAMPLE_RATE)
+
+    assert result['apnea_count'] == 0
+    assert result['ahi'] is None
+    assert result['airflow_hours'] == 0.0
+
+def test_signal_loss_is_not_an_apnea_nor_analyzed_time():
+    flow = np.concatenate([breathing(600), flatline(400), breathing(600)])
+    result = detect_airflow_events(flow, SAMPLE_RATE)
+
+    assert result['apnea_count'] == 0
+    assert result['hypopnea_count'] == 0
+    assert result['ahi'] == 0.0
+    # The 400 s flatline is left out of the denominator
+    assert result['airflow_hours'] < 1100 / 3600
+
+def test_reduced_breathing_is_still_scored():
+    flow = np.concatenate([breathing(600), breathing(20, 0.05), breathing(600),
+                           breathing(30, 0.5), breathing(600)])
+    result = detect_airflow_events(flow, SAMPLE_RATE)
+
+    assert result['apnea_count'] == 1
+    assert result['hypopnea_count'] == 1
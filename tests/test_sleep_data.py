@@ -0,0 +1,142 @@
+"""
+EDF parsing and epoch summaries against small synthetic recordings.
+"""
+
+import functools
+
+import numpy as np
+import pytest
+
+import sleep_data
+from sleep_data import ANNOTATION_LABEL, parse_edf_header, summarize_edf
+
+def edf_field(value, width):
+    return str(value).ljust(width)[:width].encode('ascii')
+
+def build_edf(signals, records, record_duration=1, record_count=None, start=('01.10.26', '22.30.00')):
+    """
+    EDF bytes for signals [(label, samples_per_record, physical_min, physical_max)]
+    with data records [{label: int16 samples}].
+    """
+    header = b''.join([
+        edf_field('0', 8), edf_field('patient', 80), edf_field('recording', 80),
+        edf_field(start[0], 8), edf_field(start[1], 8),
+        edf_field(256 * (len(signals) + 1), 8), edf_field('', 44),
+        edf_field(len(records) if record_count is None else record_count, 8),
+        edf_field(record_duration, 8), edf_field(len(signals), 4)
+    ])
+    columns = [
+        ('label', 16, lambda s: s[0]), ('transducer', 80, lambda s: ''), ('unit', 8, lambda s: 'uV'),
+        ('physical_min', 8, lambda s: s[2]), ('physical_max', 8, lambda s: s[3]),
+        ('digital_min', 8, lambda s: -32768), ('digital_max', 8, lambda s: 32767),
+        ('prefilter', 80, lambda s: ''), ('samples_per_record', 8, lambda s: s[1]),
+        ('reserved', 32, lambda s: '')
+    ]
+    for _, width, value in columns:
+        header += b''.join(edf_field(value(signal), width) for signal in signals)
+
+    data = b''.join(
+        np.asarray(record[signal[0]], dtype='<i2').tobytes()
+        for record in records for signal in signals
+    )
+    return header + data
+
+SIGNALS = [('Flow', 10, -100, 100), ('SpO2', 4, 0, 100), (ANNOTATION_LABEL, 8, -1, 1)]
+
+def make_records(count):
+    rng = np.random.default_rng(7)
+    return [{
+        'Flow': rng.integers(-30000, 30000, 10),
+        'SpO2': rng.integers(-32768, 32767, 4),
+        ANNOTATION_LABEL: np.zeros(8)
+    } for _ in range(count)]
+
+def test_header_fields_and_layout():
+    data = build_edf(SIGNALS, make_records(3))
+    header = parse_edf_header(data, len(data))
+
+    assert header['start'].isoformat() == '2026-10-01T22:30:00'
+    assert header['header_bytes'] == 256 * 4
+    assert header['record_count'] == 3
+    assert header['record_samples'] == 22
+    assert header['record_bytes'] == 44
+    assert header['duration_seconds'] == 3
+    flow, spo2, annotations = header['signals']
+    assert (flow['label'], flow['sample_rate'], flow['sample_offset']) == ('Flow', 10, 0)
+    assert (spo2['sample_rate'], spo2['sample_offset']) == (4, 10)
+    assert flow['gain'] == pytest.approx(200 / 65535)
+    assert annotations['annotation'] and not flow['annotation']
+    assert 'reserved' not in flow
+
+@pytest.mark.parametrize('data, message', [
+    (b'1' + b' ' * 300, 'Not an EDF file'),
+    (b'0' * 100, 'Not an EDF file'),
+])
+def test_non_edf_files_are_rejected(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_edf_header(data, len(data))
+
+def test_header_size_must_match_signal_count():
+    data = bytearray(build_edf(SIGNALS, make_records(1)))
+    data[184:192] = edf_field(512, 8)
+
+    with pytest.raises(ValueError, match='Corrupt EDF header'):
+        parse_edf_header(bytes(data), len(data))
+
+def test_unreadable_numeric_field_is_named():
+    data = bytearray(build_edf(SIGNALS, make_records(1)))
+    data[244:252] = edf_field('abc', 8)
+
+    with pytest.raises(ValueError, match='record duration'):
+        parse_edf_header(bytes(data), len(data))
+
+def test_record_count_past_end_of_file_is_truncated():
+    data = build_edf(SIGNALS, make_records(3), record_count=10)
+    # Half of a fourth record was written before the recorder stopped
+    data += b'\0' * 20
+
+    assert parse_edf_header(data, len(data))['record_count'] == 3
+
+def test_unknown_record_count_uses_complete_records():
+    data = build_edf(SIGNALS, make_records(5), record_count=-1)
+
+    header = parse_edf_header(data, len(data))
+    assert header['record_count'] == 5
+    assert header['duration_seconds'] == 5
+
+def expected_epochs(records, label, samples_per_epoch, physical_min, physical_max):
+    digital = np.concatenate([record[label] for record in records]).astype(np.float32)
+    physical = (digital + 32768) * ((physical_max - physical_min) / 65535) + physical_min
+    complete = len(digital) // samples_per_epoch
+    epochs = physical[:complete * samples_per_epoch].reshape(complete, samples_per_epoch)
+    return np.stack((epochs.min(axis=1), epochs.max(axis=1),
+                     epochs.mean(axis=1), epochs.std(axis=1)), axis=1)
+
+def test_epochs_span_decode_chunks(tmp_path, monkeypatch):
+    records = make_records(95)
+    path = tmp_path / 'night.edf'
+    path.write_bytes(build_edf(SIGNALS, records))
+    # One 7-record slice at a time, so 30 s epochs straddle slices
+    monkeypatch.setattr(sleep_data, 'iter_signal_chunks',
+                        functools.partial(sleep_data.iter_signal_chunks, chunk_bytes=7 * 44))
+
+    header, summary = summarize_edf(str(path), epoch_seconds=30)
+
+    assert [signal['label'] for signal in header['signals']] == ['Flow', 'SpO2']
+    assert summary.shape == (2, 3, 4)
+    np.testing.assert_allclose(summary[0], expected_epochs(records, 'Flow', 300, -100, 100), rtol=1e-4, atol=1e-3)
+    np.testing.assert_allclose(summary[1], expected_epochs(records, 'SpO2', 120, 0, 100), rtol=1e-4, atol=1e-3)
+
+def test_recording_shorter_than_one_epoch_is_rejected(tmp_path):
+    path = tmp_path / 'short.edf'
+    path.write_bytes(build_edf(SIGNALS, make_records(10)))
+
+    with pytest.raises(ValueError, match='shorter than one 30-second epoch'):
+        summarize_edf(str(path), epoch_seconds=30)
+
+def test_annotation_only_recording_is_rejected(tmp_path):
+    path = tmp_path / 'annotations.edf'
+    path.write_bytes(build_edf([(ANNOTATION_LABEL, 8, -1, 1)], [{ANNOTATION_LABEL: np.zeros(8)}]))
+
+    with pytest.raises(ValueError, match='no signal channels'):
+        summarize_edf(str(path))
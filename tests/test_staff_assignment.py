@@ -0,0 +1,55 @@
+"""
+Assignment roster: open-study counts come grouped from the database.
+"""
+
+import json
+
+import httpx
+
+from staff_assignment import OPEN_STUDY_STATES, AssignmentEngine, OrganizationRoster
+
+ORG_ID = 'org-1'
+MEMBERSHIPS = [
+    {'user_id': 'staff-busy', 'organization_id': ORG_ID, 'app_users': {'role': 'staff'}},
+    {'user_id': 'staff-free', 'organization_id': ORG_ID, 'app_users': {'role': 'staff'}},
+    {'user_id': 'doctor-1', 'organization_id': ORG_ID, 'app_users': {'role': 'doctor'}},
+    {'user_id': 'patient-1', 'organization_id': ORG_ID, 'app_users': {'role': 'patient'}},
+]
+
+def test_least_loaded_members_are_assigned(supabase, flask_app):
+    rpc_bodies = []
+
+    def open_counts(request):
+        rpc_bodies.append(json.loads(request.content))
+        return httpx.Response(200, json=[
+            {'user_id': 'staff-busy', 'open_count': 7},
+            {'user_id': 'doctor-1', 'open_count': 3}
+        ])
+
+    supabase.route('GET', '/rest/v1/organization_memberships', lambda request: httpx.Response(200, json=MEMBERSHIPS))
+    supabase.route('POST', '/rest/v1/rpc/assignee_open_study_counts', open_counts)
+
+    engine = AssignmentEngine(flask_app.get_privileged_client)
+
+    assert engine.assign() == {'organization_id': ORG_ID, 'manager_id': 'staff-free', 'doctor_id': 'doctor-1'}
+    assert rpc_bodies == [{'states': OPEN_STUDY_STATES}]
+    assert not any(request.url.path == '/rest/v1/sleep_studies' for request in supabase.requests)
+
+def test_roster_totals_follow_picks_and_releases():
+    roster = OrganizationRoster(ORG_ID)
+    assert not roster.has_role('doctor')
+
+    roster.add_member('staff-1', 'staff', 4)
+    roster.add_member('doctor-1', 'doctor', 2)
+    roster.add_member('doctor-2', 'doctor', 1)
+    roster.add_member('doctor-2', 'doctor', 9)  # Duplicate membership row
+    assert roster.has_role('staff') and roster.has_role('doctor')
+    assert roster.total_open() == 3
+
+    assert roster.pick('doctor') == 'doctor-2'
+    assert roster.pick('staff') == 'staff-1'
+    assert roster.total_open() == 4
+
+    roster.release('doctor-1')
+    roster.release('staff-1')
+    assert roster.total_open() == 3
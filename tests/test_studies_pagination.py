@@ -0,0 +1,47 @@
+"""
+Keyset pagination of study lists: the generated PostgREST query.
+"""
+
+from urllib.parse import parse_qs
+
+import httpx
+
+STUDIES = [
+    {'id': f"00000000-0000-0000-0000-00000000000{index}", 'patient_id': None,
+     'current_state': 'booked', 'start_date': None,
+     'created_at': '2026-10-01T10:00:00+00:00'}
+    for index in (3, 2, 1)
+]
+
+def get_query(request):
+    return parse_qs(request.url.query.decode(), keep_blank_values=True)
+
+def test_pages_are_ordered_by_one_order_param(supabase, flask_app):
+    supabase.route('GET', '/rest/v1/sleep_studies', lambda request: httpx.Response(200, json=STUDIES))
+
+    query = flask_app.shaped_query(flask_app.get_privileged_client(), 'study_list')
+    studies, cursor = flask_app.fetch_studies_page(query, page_size=2)
+
+    assert [study['id'] for study in studies] == [row['id'] for row in STUDIES[:2]]
+    assert cursor
+
+    params = get_query(supabase.requests[-1])
+    assert params['order'] == ['created_at.desc,id.desc']
+    assert params['limit'] == ['3']
+
+def test_next_page_starts_after_the_cursor(supabase, flask_app):
+    supabase.route('GET', '/rest/v1/sleep_studies', lambda request: httpx.Response(200, json=STUDIES[2:]))
+    cursor = flask_app.encode_study_cursor(STUDIES[1])
+
+    query = flask_app.shaped_query(flask_app.get_privileged_client(), 'study_list')
+    studies, next_cursor = flask_app.fetch_studies_page(query, cursor, page_size=2)
+
+    assert [study['id'] for study in studies] == [STUDIES[2]['id']]
+    assert next_cursor is None
+
+    params = get_query(supabase.requests[-1])
+    created_at, study_id = STUDIES[1]['created_at'], STUDIES[1]['id']
+    assert params['order'] == ['created_at.desc,id.desc']
+    assert params['or'] == [
+        f'(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{study_id}))'
+    ]
@@ -0,0 +1,132 @@
+"""
+Study reports: the patient's request and the worker must agree on the
+content hash, although only the worker's client can read the recording.
+"""
+
+import json
+import re
+from urllib.parse import parse_qs
+
+import httpx
+
+PATIENT_ID = '11111111-1111-1111-1111-111111111111'
+STUDY_ID = '22222222-2222-2222-2222-222222222222'
+
+def study_row(with_recording):
+    row = {
+        'id': STUDY_ID,
+        'patient_id': PATIENT_ID,
+        'current_state': 'completed',
+        'start_date': '2026-10-01',
+        'created_at': '2026-09-20T10:00:00+00:00',
+        'patient': {'patient_profiles': {'full_name': 'Pat Example', 'date_of_birth': '1970-01-01'}},
+        'survey_responses': [{'type': 'epworth', 'score': 12, 'created_at': '2026-09-20T10:00:00+00:00'}],
+        'sleep_data_files': []
+    }
+    if with_recording:
+        row['sleep_data_files'] = [{
+            'id': '33333333-3333-3333-3333-333333333333',
+            'created_at': '2026-10-02T08:00:00+00:00',
+            'sleep_data_summaries': {
+                'duration_seconds': 28800,
+                'recording_start': '2026-10-01T22:00:00',
+                'signals': [{'label': 'Flow'}, {'label': 'SpO2'}]
+            },
+            'sleep_study_analyses': {
+                'ahi': 18.4, 'odi': 15.1, 'apnea_count': 80, 'hypopnea_count': 67,
+                'desaturation_count': 120, 'min_spo2': 82.0, 'mean_spo2': 94.2,
+                't90_minutes': 12.5, 'analyzed_hours': 8.0, 'algorithm_version': 'test'
+            }
+        }]
+    return row
+
+def install_report_backend(supabase):
+    """Fake PostgREST/Storage in which patients cannot read recordings (RLS)."""
+    reports = []
+
+    def sleep_studies(request):
+        # Recordings, summaries and analyses are only visible to the service role
+        return httpx.Response(200, json=[study_row(supabase.is_service_request(request))])
+
+    def doctor_reports(request):
+        if request.method == 'POST':
+            body = json.loads(request.content)
+            reports.extend(body if isinstance(body, list) else [body])
+            return httpx.Response(201, json=[])
+        params = parse_qs(request.url.query.decode())
+        content_hash = params.get('content_hash', ['eq.'])[0][len('eq.'):]
+        rows = [dict(row, id=f"report-{index}", created_at='2026-10-03T00:00:00+00:00')
+                for index, row in enumerate(reports) if row['content_hash'] == content_hash]
+        return httpx.Response(200, json=rows)
+
+    def sign(request):
+        paths = json.loads(request.content)['paths']
+        return httpx.Response(200, json=[
+            {'path': path, 'error': None, 'signedURL': f"/object/sign/reports/{path}?token=t"}
+            for path in paths
+        ])
+
+    supabase.route('GET', '/rest/v1/sleep_studies', sleep_studies)
+    supabase.route('GET', '/rest/v1/doctor_reports', doctor_reports)
+    supabase.route('POST', '/rest/v1/doctor_reports', doctor_reports)
+    supabase.route('POST', '/storage/v1/object/sign/reports', sign)
+    return reports
+
+def test_report_of_study_with_analysis_becomes_ready(supabase, flask_app, sign_in):
+    reports = install_report_backend(supabase)
+    upload_paths = []
+
+    def upload(request):
+        upload_paths.append(request.url.path)
+        return httpx.Response(200, json={'Key': request.url.path})
+
+    original_handle = supabase.handle
+
+    def handle(request):
+        if request.url.path.startswith('/storage/v1/object/reports/'):
+            return upload(request)
+        return original_handle(request)
+
+    supabase.handle = handle
+
+    client = flask_app.app.test_client()
+    sign_in(client, PATIENT_ID, 'patient')
+
+    response = client.get(f"/htmx/patient/studies/{STUDY_ID}/report")
+    assert response.status_code == 200
+    status_url = re.search(r'hx-get="([^"]+)"', response.get_data(as_text=True)).group(1)
+
+    assert flask_app.job_queue.run_worker(burst=True) == 1
+
+    # The worker rendered the recording's analysis under the requested hash
+    content_hash = status_url.rsplit('/', 1)[1]
+    assert [row['content_hash'] for row in reports] == [content_hash]
+    assert len(upload_paths) == 1
+
+    response = client.get(status_url)
+    assert response.status_code == 200
+    assert 'Open Report' in response.get_data(as_text=True)
+
+def test_status_poll_does_not_queue_unknown_hashes(supabase, flask_app, sign_in):
+    install_report_backend(supabase)
+    client = flask_app.app.test_client()
+    sign_in(client, PATIENT_ID, 'patient')
+
+    response = client.get(f"/htmx/patient/studies/{STUDY_ID}/report/{'0' * 64}")
+    assert response.status_code == 200
+    assert 'no longer available' in response.get_data(as_text=True)
+    assert flask_app.job_queue.get(flask_app.get_report_job_id(STUDY_ID, '0' * 64)) is None
+
+def test_job_for_a_stale_hash_stores_nothing(supabase, flask_app):
+    reports = install_report_backend(supabase)
+    stale_hash = 'f' * 64
+    job_id = flask_app.job_queue.enqueue('render_study_report',
+                                         {'study_id': STUDY_ID, 'content_hash': stale_hash},
+                                         job_id=flask_app.get_report_job_id(STUDY_ID, stale_hash))
+
+    flask_app.job_queue.run_worker(burst=True)
+
+    assert reports == []
+    job = flask_app.job_queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert job['last_error'] == "Report version is no longer current"